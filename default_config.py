@@ -11,6 +11,8 @@ def get_default_config():
     cfg.model.load_weights = ''  # path to model weights
     cfg.model.resume = ''  # path to checkpoint for resume training
     cfg.model.with_attention = True
+    cfg.model.heads = ['global', 'a', 'b', 'c']  # embedding heads of pfh_osnet, branches of other heads are not run
+    cfg.model.head_weights = []  # weight of each head in the eval descriptor (empty means all ones)
 
     # data
     cfg.data = CN()
@@ -70,6 +72,9 @@ def get_default_config():
     cfg.train.seed = 1  # random seed
     cfg.train.warmup_total_epoch = 10
     cfg.train.warmup_multiplier = 100
+    cfg.train.amp = False  # automatic mixed precision, 'fp16', 'bf16' or True (float16 with gradient scaling on gpu, bfloat16 on cpu)
+    cfg.train.channels_last = False  # channels_last memory format for the model and the images
+    cfg.train.loss_timing = False  # log the time of each loss to tensorboard (synchronizes the gpu around each loss)
 
     # optimizer
     cfg.sgd = CN()
@@ -89,20 +94,43 @@ def get_default_config():
     cfg.loss.softmax.label_smooth = True  # use label smoothing regularizer
     cfg.loss.triplet = CN()
     cfg.loss.triplet.margin = 0.3  # distance margin
+    cfg.loss.triplet.mining = 'batch_hard'  # triplet mining, ['batch_hard', 'batch_all']
     cfg.loss.triplet.weight_t = 1.  # weight to balance hard triplet loss
     cfg.loss.triplet.weight_x = 0.  # weight to balance cross entropy loss
     cfg.loss.triplet.weight_c = 0.  # weight to balance center loss
+    cfg.loss.triplet.weight_r = 0.  # weight to balance range loss
+    cfg.loss.triplet.micro_batch_size = 0  # run the forward in chunks of this many images and backpropagate the batch loss through each chunk (gradient cache), 0 means the whole batch at once
 
     # test
     cfg.test = CN()
     cfg.test.batch_size = 100
-    cfg.test.dist_metric = 'euclidean'  # distance metric, ['euclidean', 'cosine']
+    cfg.test.dist_metric = 'euclidean'  # distance metric, ['euclidean', 'cosine', 'pq'] ('pq' encodes the gallery with a product quantizer trained on training features)
     cfg.test.normalize_feature = False  # normalize feature vectors before computing distance
     cfg.test.ranks = [1, 5, 10, 20]  # cmc ranks
     cfg.test.evaluate = False  # test only
     cfg.test.eval_freq = -1  # evaluation frequency (-1 means to only test after training)
     cfg.test.start_eval = 0  # start to evaluate after a specific epoch
     cfg.test.rerank = False  # use person re-ranking
+    cfg.test.rerank_method = 'sparse'  # re-ranking implementation, ['dense', 'sparse', 'torch'] (same output, 'sparse' only keeps top-k neighbors, 'torch' works on features on the gpu)
+    cfg.test.dist_block_memory = 0  # memory budget (MB) of a distance matrix block, 0 means computing the full matrix at once
+    cfg.test.partial_rank = False  # compute cmc and mAP from the ranks of true matches instead of sorting the gallery
+    cfg.test.eval_threads = 1  # number of threads for cython evaluation (0 means all cores)
+    cfg.test.rank_backend = 'numpy'  # backend to compute cmc and mAP, ['numpy', 'torch'] ('torch' keeps the distance matrix on the feature device)
+    cfg.test.feature_cache_dir = ''  # directory to cache extracted test features, reused while the model weights are unchanged ('' disables the cache)
+    cfg.test.ann_lists = 0  # number of lists of an IVF index for approximate nearest neighbor search (0 means exact search)
+    cfg.test.ann_probes = 8  # number of IVF lists visited by each query
+    cfg.test.ann_topk = 100  # number of neighbors retrieved for each query with approximate search, CMC and mAP are computed on them (CMC@k, mAP@k)
+    cfg.test.pq_subspaces = 32  # number of bytes per gallery sample with dist_metric='pq' (must divide the feature dimension)
+    cfg.test.pq_opq = False  # learn an OPQ rotation for dist_metric='pq'
+    cfg.test.feature_precision = 'fp32'  # storage precision of test features and cached features, ['fp32', 'fp16', 'bf16', 'int8'] (distances are accumulated in fp32)
+    cfg.test.precision_report = False  # print memory, distance time and rank-1/mAP drift of each precision on each test dataset
+    cfg.test.cpu_inference = False  # extract test features with bn folded into convs, channels_last and inference mode when running on cpu
+    cfg.test.cpu_threads = 0  # intra-op threads of cpu inference (0 means the torch default)
+    cfg.test.cpu_workers = 0  # number of processes each test batch is split over with cpu inference (0 means no process pool)
+    cfg.test.cascade_stage = ''  # cascade retrieval: rank the gallery with cheap stage embeddings ('a' or 'b' of pfh_osnet), then recompute full descriptors of the top candidates ('' disables)
+    cfg.test.cascade_topk = 100  # number of candidates of each query recomputed with full descriptors in cascade retrieval
+    cfg.test.heads = []  # heads of pfh_osnet forming the test descriptor, e.g. ['global'] for a 512-d one (empty means cfg.model.heads)
+    cfg.test.head_weights = []  # weight of each test head in the descriptor (empty means all ones)
     cfg.test.visrank = False  # visualize ranked results (only available when cfg.test.evaluate=True)
     cfg.test.visrank_topk = 10  # top-k ranks to visualize
     cfg.test.visactmap = False  # visualize CNN activation maps
@@ -189,7 +217,7 @@ def lr_scheduler_kwargs(cfg):
 
 
 def engine_run_kwargs(cfg):
-    return {
+    kwargs = {
         'save_dir': cfg.data.save_dir,
         'max_epoch': cfg.train.max_epoch,
         'start_epoch': cfg.train.start_epoch,
@@ -198,12 +226,41 @@ def engine_run_kwargs(cfg):
         'start_eval': cfg.test.start_eval,
         'eval_freq': cfg.test.eval_freq,
         'test_only': cfg.test.evaluate,
-        'print_freq': cfg.train.print_freq,
+        'print_freq': cfg.train.print_freq
+    }
+    kwargs.update(eval_kwargs(cfg))
+    return kwargs
+
+
+def eval_kwargs(cfg):
+    """Evaluation options of ``Engine.run`` and ``Engine.test``, see
+    ``torchreid.engine.EvalOptions``."""
+    return {
         'dist_metric': cfg.test.dist_metric,
         'normalize_feature': cfg.test.normalize_feature,
         'visrank': cfg.test.visrank,
         'visrank_topk': cfg.test.visrank_topk,
         'use_metric_cuhk03': cfg.cuhk03.use_metric_cuhk03,
         'ranks': cfg.test.ranks,
-        'rerank': cfg.test.rerank
+        'rerank': cfg.test.rerank,
+        'dist_block_memory': cfg.test.dist_block_memory,
+        'partial_rank': cfg.test.partial_rank,
+        'eval_threads': cfg.test.eval_threads,
+        'rank_backend': cfg.test.rank_backend,
+        'rerank_method': cfg.test.rerank_method,
+        'feature_cache_dir': cfg.test.feature_cache_dir,
+        'ann_lists': cfg.test.ann_lists,
+        'ann_probes': cfg.test.ann_probes,
+        'ann_topk': cfg.test.ann_topk,
+        'pq_subspaces': cfg.test.pq_subspaces,
+        'pq_opq': cfg.test.pq_opq,
+        'feature_precision': cfg.test.feature_precision,
+        'precision_report': cfg.test.precision_report,
+        'cpu_inference': cfg.test.cpu_inference,
+        'cpu_threads': cfg.test.cpu_threads,
+        'cpu_workers': cfg.test.cpu_workers,
+        'cascade_stage': cfg.test.cascade_stage,
+        'cascade_topk': cfg.test.cascade_topk,
+        'heads': cfg.test.heads,
+        'head_weights': cfg.test.head_weights
     }
@@ -32,7 +32,9 @@ def build_engine(cfg, datamanager, model, optimizer, scheduler):
                 optimizer=optimizer,
                 scheduler=scheduler,
                 use_gpu=cfg.use_gpu,
-                label_smooth=cfg.loss.softmax.label_smooth)
+                label_smooth=cfg.loss.softmax.label_smooth,
+                amp=cfg.train.amp,
+                channels_last=cfg.train.channels_last)
 
         else:
             engine = torchreid.engine.ImageTripletEngine(
@@ -40,12 +42,19 @@ def build_engine(cfg, datamanager, model, optimizer, scheduler):
                 model,
                 optimizer=optimizer,
                 margin=cfg.loss.triplet.margin,
+                mining=cfg.loss.triplet.mining,
                 weight_t=cfg.loss.triplet.weight_t,
                 weight_x=cfg.loss.triplet.weight_x,
                 weight_c=cfg.loss.triplet.weight_c,
+                weight_r=cfg.loss.triplet.weight_r,
+                num_instances=cfg.sampler.num_instances,
                 scheduler=scheduler,
                 use_gpu=cfg.use_gpu,
-                label_smooth=cfg.loss.softmax.label_smooth)
+                label_smooth=cfg.loss.softmax.label_smooth,
+                amp=cfg.train.amp,
+                channels_last=cfg.train.channels_last,
+                micro_batch_size=cfg.loss.triplet.micro_batch_size,
+                loss_timing=cfg.train.loss_timing)
 
     else:
         if cfg.loss.name == 'softmax':
@@ -146,7 +155,9 @@ def main():
         loss=cfg.loss.name,
         pretrained=cfg.model.pretrained,
         with_attention=cfg.model.with_attention,
-        use_gpu=cfg.use_gpu)
+        use_gpu=cfg.use_gpu,
+        heads=cfg.model.heads,
+        head_weights=cfg.model.head_weights)
     #num_params, flops = compute_model_complexity(
     #    model, (1, 3, cfg.data.height, cfg.data.width))
     print(model)
@@ -0,0 +1,91 @@
+"""Images/sec and latency of cpu feature extraction for the osnet variants.
+
+Compares the eager model with the variants of ``torchreid.models.inference``:
+throughput on a batch, latency on a single image, and the largest
+difference of their embeddings. Parity itself is checked by
+tests/test_inference.py.
+
+Usage:
+    python scripts/benchmark_inference.py --batch-size 32 --num-threads 4
+"""
+from __future__ import division, print_function, absolute_import
+import argparse
+import torch
+from torch import nn
+from torch.utils import benchmark
+
+from torchreid import models
+
+
+def build_model(name):
+    model = models.build_model(
+        name, 751, loss='softmax', pretrained=False, use_gpu=False
+    ).eval()
+    # random bn statistics, so that folding is not a no-op
+    for m in model.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.1, 0.1)
+            m.running_var.uniform_(0.5, 1.5)
+    return model
+
+
+def seconds_per_call(model, imgs, min_run_time):
+    with torch.no_grad():
+        model(imgs)  # warm up
+        timer = benchmark.Timer(stmt='model(imgs)',
+                                globals={'model': model, 'imgs': imgs})
+        return timer.blocked_autorange(min_run_time=min_run_time).median
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', nargs='+',
+                        default=['pfh_osnet', 'osnet_x1_0', 'osnet_ain_x1_0'])
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--height', type=int, default=256)
+    parser.add_argument('--width', type=int, default=128)
+    parser.add_argument('--num-threads', type=int, default=0)
+    parser.add_argument('--num-workers', type=int, default=0)
+    parser.add_argument('--min-run-time', type=float, default=2.)
+    args = parser.parse_args()
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    imgs = torch.randn(args.batch_size, 3, args.height, args.width)
+    img = imgs[:1].clone()
+
+    print('{:<15} {:<15} {:>10} {:>8} {:>12} {:>8} {:>10}'.format(
+        'model', 'variant', 'img/s', 'speedup', 'latency', 'speedup',
+        'max diff'))
+    for name in args.models:
+        model = build_model(name)
+        with torch.no_grad():
+            reference = model(imgs)
+        variants = [
+            ('eager', model),
+            ('fused', models.fuse_conv_bn(model)),
+            ('traced', models.optimize_for_inference(
+                model, example_input=img)),
+            ('cpu inference', models.CPUInferenceModel(
+                model, num_threads=args.num_threads,
+                num_workers=args.num_workers)),
+        ]
+        baseline = baseline_latency = None
+        for label, variant in variants:
+            elapsed = seconds_per_call(variant, imgs, args.min_run_time)
+            latency = seconds_per_call(variant, img, args.min_run_time)
+            baseline = baseline or elapsed
+            baseline_latency = baseline_latency or latency
+            with torch.no_grad():
+                max_diff = (variant(imgs) - reference).abs().max().item()
+            print('{:<15} {:<15} {:>10.1f} {:>7.2f}x {:>10.2f}ms {:>7.2f}x '
+                  '{:>10.1e}'.format(name, label, args.batch_size / elapsed,
+                                     baseline / elapsed, latency * 1000,
+                                     baseline_latency / latency, max_diff))
+            if isinstance(variant, models.CPUInferenceModel):
+                variant.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Forward + backward time of the vectorized losses against their loops.
+
+Parity of each pair is checked by tests/test_losses.py.
+
+Usage:
+    python scripts/benchmark_losses.py --feat-dim 512
+"""
+from __future__ import division, print_function, absolute_import
+import argparse
+import torch
+from torch.utils import benchmark
+
+from torchreid.losses import RangeLoss, TripletLoss
+
+PK_SIZES = [(8, 4), (16, 4), (32, 4), (64, 4), (32, 8)]
+
+
+def seconds_per_step(loss_fn, inputs, targets, min_run_time):
+    """Median time of ``loss_fn(inputs, targets).backward()``."""
+    inputs = inputs.detach().requires_grad_()
+    timer = benchmark.Timer(
+        stmt='loss_fn(inputs, targets).backward()',
+        globals={'loss_fn': loss_fn, 'inputs': inputs, 'targets': targets})
+    return timer.blocked_autorange(min_run_time=min_run_time).median
+
+
+def batch_hard_loop(criterion, inputs, targets):
+    """Batch-hard triplet loss with a loop over the anchors."""
+    n = inputs.size(0)
+    dist = torch.pow(inputs, 2).sum(dim=1, keepdim=True).expand(n, n)
+    dist = dist + dist.t()
+    dist = dist.addmm(inputs, inputs.t(), beta=1, alpha=-2)
+    dist = dist.clamp(min=1e-12).sqrt()
+    mask = targets.expand(n, n).eq(targets.expand(n, n).t())
+    dist_ap, dist_an = [], []
+    for i in range(n):
+        dist_ap.append(dist[i][mask[i]].max().unsqueeze(0))
+        dist_an.append(dist[i][mask[i] == 0].min().unsqueeze(0))
+    dist_ap = torch.cat(dist_ap)
+    dist_an = torch.cat(dist_an)
+    return criterion.ranking_loss(dist_an, dist_ap, torch.ones_like(dist_an))
+
+
+def benchmark_triplet(args, device):
+    hard = TripletLoss(margin=0.3)
+    batch_all = TripletLoss(margin=0.3, mining='batch_all')
+    print('TripletLoss')
+    print('{:>8} {:>10} {:>12} {:>8} {:>12}'.format(
+        'PxK', 'loop', 'batch_hard', 'speedup', 'batch_all'))
+    for num_pids, num_instances in PK_SIZES:
+        inputs = torch.randn(num_pids * num_instances, args.feat_dim,
+                             device=device)
+        targets = torch.arange(num_pids,
+                               device=device).repeat_interleave(num_instances)
+        loop_time = seconds_per_step(
+            lambda x, t: batch_hard_loop(hard, x, t), inputs, targets,
+            args.min_run_time)
+        hard_time = seconds_per_step(hard, inputs, targets,
+                                     args.min_run_time)
+        all_time = seconds_per_step(batch_all, inputs, targets,
+                                    args.min_run_time)
+        print('{:>8} {:>8.2f}ms {:>10.2f}ms {:>7.1f}x {:>10.2f}ms'.format(
+            '{}x{}'.format(num_pids, num_instances), loop_time * 1000,
+            hard_time * 1000, loop_time / hard_time, all_time * 1000))
+
+
+def benchmark_range(args, device):
+    print('RangeLoss')
+    print('{:>8} {:>10} {:>10} {:>8}'.format('PxK', 'loop', 'pxk',
+                                            'speedup'))
+    for num_pids, num_instances in PK_SIZES:
+        inputs = torch.rand(num_pids * num_instances, args.feat_dim,
+                            device=device)
+        targets = torch.arange(num_pids,
+                               device=device).repeat_interleave(num_instances)
+        times = []
+        # the per-id loop (ordered=False) and the PxK reductions
+        for ordered in [False, True]:
+            criterion = RangeLoss(use_gpu=device == 'cuda', ordered=ordered,
+                                  ids_per_batch=num_pids,
+                                  imgs_per_id=num_instances)
+            times.append(seconds_per_step(
+                lambda x, t: criterion(x, t)[0], inputs, targets,
+                args.min_run_time))
+        print('{:>8} {:>8.2f}ms {:>8.2f}ms {:>7.1f}x'.format(
+            '{}x{}'.format(num_pids, num_instances), times[0] * 1000,
+            times[1] * 1000, times[0] / times[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--feat-dim', type=int, default=512)
+    parser.add_argument('--min-run-time', type=float, default=1.)
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() and not args.cpu else 'cpu'
+    torch.manual_seed(0)
+    benchmark_triplet(args, device)
+    benchmark_range(args, device)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""mAP and rank-1 of product-quantized galleries against fp32 distances.
+
+The features are synthetic identities with noise, split into a training
+set for the codebooks, queries and a gallery. The quantizer itself is
+checked by tests/test_quantization.py.
+
+Usage:
+    python scripts/benchmark_pq.py --feat-dim 512 --subspaces 16 32 64
+"""
+from __future__ import division, print_function, absolute_import
+import argparse
+import time
+import numpy as np
+import torch
+
+from torchreid import metrics
+
+
+def clustered_features(centers, pids, noise, generator):
+    features = centers[torch.from_numpy(pids)]
+    return features + noise * torch.randn(features.shape, generator=generator)
+
+
+def evaluate(distmat, q_pids, g_pids, q_camids, g_camids):
+    cmc, mAP = metrics.evaluate_rank(distmat.numpy(), q_pids, g_pids,
+                                     q_camids, g_camids)[:2]
+    return mAP, cmc[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--feat-dim', type=int, default=512)
+    parser.add_argument('--num-pids', type=int, default=500)
+    parser.add_argument('--num-train', type=int, default=10000)
+    parser.add_argument('--num-query', type=int, default=1000)
+    parser.add_argument('--num-gallery', type=int, default=10000)
+    parser.add_argument('--noise', type=float, default=1.)
+    parser.add_argument('--subspaces', type=int, nargs='+',
+                        default=[16, 32, 64])
+    args = parser.parse_args()
+
+    generator = torch.Generator().manual_seed(0)
+    rs = np.random.RandomState(0)
+    centers = torch.randn(args.num_pids, args.feat_dim, generator=generator)
+    tf = clustered_features(centers, rs.randint(0, args.num_pids,
+                                                args.num_train),
+                            args.noise, generator)
+    q_pids = rs.randint(0, args.num_pids, args.num_query)
+    g_pids = rs.randint(0, args.num_pids, args.num_gallery)
+    qf = clustered_features(centers, q_pids, args.noise, generator)
+    gf = clustered_features(centers, g_pids, args.noise, generator)
+    q_camids = np.zeros(args.num_query, dtype=np.int64)
+    g_camids = np.ones(args.num_gallery, dtype=np.int64)
+
+    start = time.time()
+    distmat = metrics.compute_distance_matrix(qf, gf)
+    elapsed = time.time() - start
+    mAP, rank1 = evaluate(distmat, q_pids, g_pids, q_camids, g_camids)
+    print('{:<10} {:>8} {:>8} {:>9} {:>8} {:>9} {:>10} {:>10}'.format(
+        'variant', 'bytes', 'mAP', 'delta', 'rank-1', 'delta', 'train',
+        'distance'))
+    print('{:<10} {:>8} {:>7.2%} {:>9} {:>7.2%} {:>9} {:>10} {:>8.1f}ms'.
+          format('fp32', args.feat_dim * 4, mAP, '', rank1, '', '',
+                 elapsed * 1000))
+    for num_subspaces in args.subspaces:
+        for opq in [False, True]:
+            quantizer = metrics.ProductQuantizer(num_subspaces, opq=opq)
+            start = time.time()
+            quantizer.train(tf)
+            train_time = time.time() - start
+            codes = quantizer.encode(gf)
+            start = time.time()
+            pq_distmat = metrics.compute_distance_matrix(qf, codes, 'pq',
+                                                         quantizer)
+            elapsed = time.time() - start
+            pq_mAP, pq_rank1 = evaluate(pq_distmat, q_pids, g_pids, q_camids,
+                                        g_camids)
+            print('{:<10} {:>8} {:>7.2%} {:>+8.2%} {:>7.2%} {:>+8.2%} '
+                  '{:>9.1f}s {:>8.1f}ms'.format(
+                      '{}pq{}'.format('o' if opq else '', num_subspaces),
+                      codes.size(1), pq_mAP, pq_mAP - mAP, pq_rank1,
+                      pq_rank1 - rank1, train_time, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+from __future__ import absolute_import
+import numpy as np
+import pytest
+import torch
+
+from torchreid import metrics
+
+
+def _clustered(num_g=2000, num_q=100, feat_dim=32):
+    generator = torch.Generator().manual_seed(0)
+    centers = torch.randn(num_g // 10, feat_dim, generator=generator)
+    gallery = centers[torch.randint(0, centers.size(0), (num_g, ),
+                                    generator=generator)] + \
+        0.5 * torch.randn(num_g, feat_dim, generator=generator)
+    queries = centers[torch.randint(0, centers.size(0), (num_q, ),
+                                    generator=generator)] + \
+        0.5 * torch.randn(num_q, feat_dim, generator=generator)
+    return queries, gallery
+
+
+@pytest.mark.parametrize('metric', ['euclidean', 'cosine'])
+def test_recall(metric):
+    queries, gallery = _clustered()
+    index = metrics.IVFIndex(num_lists=32, metric=metric)
+    index.train(gallery)
+    index.add(gallery)
+
+    # visiting every list is exact search
+    recall = metrics.evaluate_recall(index, queries, gallery, k=10,
+                                     num_probes=32)[0]
+    assert recall == 1
+    recalls = [
+        metrics.evaluate_recall(index, queries, gallery, k=10,
+                                num_probes=num_probes)[0]
+        for num_probes in [1, 4, 16]
+    ]
+    assert recalls == sorted(recalls)
+    assert recalls[-1] > 0.9
+
+
+def test_rank_topk_of_whole_gallery_matches_evaluate_rank():
+    rs = np.random.RandomState(0)
+    num_q, num_g = 40, 300
+    distmat = rs.rand(num_q, num_g)
+    q_pids, g_pids = rs.randint(0, 30, num_q), rs.randint(0, 30, num_g)
+    q_camids, g_camids = rs.randint(0, 3, num_q), rs.randint(0, 3, num_g)
+    # queries without a true match are skipped by both
+    cmc, mAP, mINP = metrics.evaluate_rank(distmat, q_pids, g_pids, q_camids,
+                                           g_camids, use_cython=False)
+    cmc_k, mAP_k, mINP_k = metrics.evaluate_rank_topk(
+        np.argsort(distmat, axis=1), q_pids, g_pids, q_camids, g_camids)
+
+    np.testing.assert_allclose(cmc_k, cmc, rtol=1e-6)
+    np.testing.assert_allclose([mAP_k, mINP_k], [mAP, mINP], rtol=1e-6)
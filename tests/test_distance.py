@@ -0,0 +1,91 @@
+from __future__ import absolute_import
+import numpy as np
+import pytest
+import torch
+
+from torchreid import metrics
+from torchreid.metrics import distance
+
+
+def _features(num_q=30, num_g=101, feat_dim=16):
+    generator = torch.Generator().manual_seed(0)
+    return torch.randn(num_q, feat_dim, generator=generator), \
+        torch.randn(num_g, feat_dim, generator=generator)
+
+
+@pytest.mark.parametrize('metric', ['euclidean', 'cosine'])
+@pytest.mark.parametrize('block_shape', [(7, 13), (30, 101), (1, 1),
+                                         (4, 100)])
+def test_blockwise_matches_dense(metric, block_shape, monkeypatch):
+    # blocks and tiles that do not divide the query and gallery sizes
+    monkeypatch.setattr(distance, '_block_shape', lambda *args: block_shape)
+    qf, gf = _features()
+    expected = metrics.compute_distance_matrix(qf, gf, metric)
+    blocks = list(metrics.compute_distance_matrix_blockwise(qf, gf, metric))
+
+    assert [(start, end) for start, end, _ in blocks] == [
+        (start, min(start + block_shape[0], 30))
+        for start in range(0, 30, block_shape[0])
+    ]
+    torch.testing.assert_close(torch.cat([d for _, _, d in blocks]), expected,
+                               rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('max_memory', [1e-3, 0.01, 256])
+def test_blockwise_memory_budget(max_memory):
+    qf, gf = _features()
+    expected = metrics.compute_distance_matrix(qf, gf)
+    blocks = list(metrics.compute_distance_matrix_blockwise(
+        qf, gf, max_memory=max_memory))
+    budget = max_memory * 1024**2 / 4
+    # the block is half of the budget, unless a single row exceeds it
+    assert all(d.numel() <= max(budget / 2, gf.size(0)) for _, _, d in blocks)
+    torch.testing.assert_close(torch.cat([d for _, _, d in blocks]), expected,
+                               rtol=1e-5, atol=1e-5)
+
+
+def _ids(num_q=30, num_g=101, seed=0):
+    # pids beyond those of the gallery give queries without a valid match
+    rs = np.random.RandomState(seed)
+    return rs.randint(0, 25, num_q), rs.randint(0, 20, num_g), \
+        rs.randint(0, 3, num_q), rs.randint(0, 3, num_g)
+
+
+@pytest.mark.parametrize('metric', ['euclidean', 'cosine'])
+@pytest.mark.parametrize('rows', [7, 30])
+@pytest.mark.parametrize('use_cython', [False, True])
+def test_evaluate_rank_blockwise_matches_dense(metric, rows, use_cython,
+                                               monkeypatch):
+    monkeypatch.setattr(distance, '_block_shape', lambda *args: (rows, 13))
+    qf, gf = _features()
+    ids = _ids()
+    expected = metrics.evaluate_rank(
+        metrics.compute_distance_matrix(qf, gf, metric).numpy(), *ids,
+        max_rank=10, use_cython=use_cython)
+    results = metrics.evaluate_rank_blockwise(
+        metrics.compute_distance_matrix_blockwise(qf, gf, metric), *ids,
+        max_rank=10, use_cython=use_cython)
+
+    np.testing.assert_allclose(results[0], expected[0], rtol=1e-5)
+    for r, e in zip(results[1:], expected[1:]):
+        assert r == pytest.approx(e, rel=1e-5)
+
+
+@pytest.mark.parametrize('metric', ['euclidean', 'cosine'])
+@pytest.mark.parametrize('k', [1, 10, 101, 200])
+def test_rank_topk_matches_argsort(metric, k):
+    qf, gf = _features()
+    q_pids, g_pids, q_camids, g_camids = _ids()
+    distmat = metrics.compute_distance_matrix(qf, gf, metric).numpy()
+    topk = metrics.rank_topk(distmat, q_pids, g_pids, q_camids, g_camids, k)
+
+    # junk samples, same pid and camid, come last
+    junk = (g_pids == q_pids[:, np.newaxis]) & \
+        (g_camids == q_camids[:, np.newaxis])
+    expected = np.argsort(np.where(junk, np.inf, distmat), axis=1)
+    expected = expected[:, :min(k, distmat.shape[1])]
+    assert topk.shape == expected.shape
+    kept = ~np.take_along_axis(junk, expected, axis=1)
+    np.testing.assert_array_equal(topk[kept], expected[kept])
+    np.testing.assert_array_equal(np.take_along_axis(junk, topk, axis=1),
+                                  ~kept)
@@ -0,0 +1,382 @@
+from __future__ import absolute_import
+import numpy as np
+import pytest
+import torch
+from torch import nn
+from torch.utils.data import DataLoader, Dataset
+
+from torchreid.engine import Engine, EvalOptions
+from torchreid.utils import AverageMeter
+
+
+class _Model(nn.Module):
+    """Linear model with one cheap stage embedding."""
+
+    def __init__(self):
+        super(_Model, self).__init__()
+        torch.manual_seed(0)
+        self.fc = nn.Linear(48, 32)
+        self.stage = nn.Linear(48, 8)
+
+    def forward(self, x):
+        return self.fc(x.flatten(1))
+
+    def stage_embeddings(self, x, stage, with_descriptor=False):
+        embeddings = self.stage(x.flatten(1))
+        if with_descriptor:
+            return embeddings, self.forward(x)
+        return embeddings
+
+
+class _Dataset(Dataset):
+    """Images around one center per identity."""
+
+    def __init__(self, num, seed, camid=None):
+        rs = np.random.RandomState(seed)
+        centers = np.random.RandomState(42).randn(20, 3, 4, 4)
+        self.pids = rs.randint(0, 20, num)
+        self.imgs = (centers[self.pids] +
+                     0.8 * rs.randn(num, 3, 4, 4)).astype(np.float32)
+        self.camids = np.full(num, camid) if camid is not None \
+            else rs.randint(0, 3, num)
+        self.transform = None
+
+    def __len__(self):
+        return len(self.pids)
+
+    def __getitem__(self, index):
+        return torch.from_numpy(self.imgs[index]), int(self.pids[index]), \
+            int(self.camids[index]), 'img{}.jpg'.format(index)
+
+
+class _DataManager(object):
+
+    def __init__(self):
+        self.train_loader = DataLoader(_Dataset(64, 3), batch_size=16)
+        self.test_loader = {
+            'toy': {
+                'query': DataLoader(_Dataset(30, 1, camid=0), batch_size=8),
+                'gallery': DataLoader(_Dataset(120, 2, camid=1), batch_size=8)
+            }
+        }
+        self.sources = ['toy']
+        self.height, self.width = 4, 4
+        self.transform_te = None
+        self.data_type = 'image'
+
+
+@pytest.fixture
+def engine():
+    return Engine(_DataManager(), _Model(), use_gpu=False)
+
+
+@pytest.mark.parametrize('normalize_feature', [False, True])
+def test_cascade_matches_full_evaluation(engine, normalize_feature):
+    query_loader = engine.test_loader['toy']['query']
+    gallery_loader = engine.test_loader['toy']['gallery']
+    # every gallery sample is a candidate
+    cascade = engine._evaluate_cascade(
+        EvalOptions(cascade_stage='x',
+                    cascade_topk=len(gallery_loader.dataset),
+                    normalize_feature=normalize_feature), query_loader,
+        gallery_loader, AverageMeter())
+
+    options = EvalOptions(normalize_feature=normalize_feature)
+    features = engine._eval_features(options, 'toy', query_loader,
+                                     gallery_loader, AverageMeter())
+    full = engine._rank_dense(*features[:6], options=options)
+
+    np.testing.assert_allclose(cascade[3], full[3], rtol=1e-5, atol=1e-5)
+    np.testing.assert_array_equal(np.argsort(cascade[3], axis=1),
+                                  np.argsort(full[3], axis=1))
+    np.testing.assert_allclose(cascade[0], full[0])
+    np.testing.assert_allclose(cascade[1:3], full[1:3])
+
+
+@pytest.mark.parametrize('option', [
+    {'feature_cache_dir': 'cache'},
+    {'rank_backend': 'torch'},
+    {'dist_block_memory': 64},
+    {'feature_precision': 'fp16'},
+])
+def test_cascade_rejects_unsupported_options(option):
+    with pytest.raises(ValueError):
+        EvalOptions(cascade_stage='a', **option)
+
+
+def test_ann_results_are_labeled_and_not_best_rank(engine, capsys):
+    rank1 = engine.test(0, eval_options=EvalOptions(ann_lists=4, ann_probes=4,
+                                                    ann_topk=10))
+    out = capsys.readouterr().out
+
+    assert 'mAP@10: ' in out and 'CMC@10 curve' in out and 'mINP@10: ' in out
+    assert '\nmAP: ' not in out
+    assert rank1 > 0
+    assert engine.best_rank == 0
+
+    engine.test(0, eval_options=EvalOptions())
+    assert engine.best_rank > 0
+
+
+def test_feature_extraction_returns_right_sized_features(engine):
+    # 30 samples in batches of 8, the buffers hold 32
+    query_loader = engine.test_loader['toy']['query']
+    qf, q_pids, q_camids, _ = engine._feature_extraction(query_loader,
+                                                         AverageMeter())
+
+    assert qf.size(0) == q_pids.shape[0] == q_camids.shape[0] == 30
+    assert qf.untyped_storage().nbytes() == qf.numel() * qf.element_size()
+    assert q_pids.base is None and q_camids.base is None
+
+
+def test_model_is_hashed_once_per_evaluation(engine, tmp_path, monkeypatch):
+    from torchreid.engine import engine as engine_module
+    hashes = []
+
+    def _hash(model):
+        hashes.append(model)
+        return 'hash'
+
+    monkeypatch.setattr(engine_module, 'state_dict_hash', _hash)
+    engine.test_loader['toy2'] = engine.test_loader['toy']
+    engine.test(0, eval_options=EvalOptions(feature_cache_dir=str(tmp_path),
+                                            ann_lists=4))
+    assert len(hashes) == 1
+
+
+def test_quantizer_is_trained_once_per_checkpoint(engine, monkeypatch):
+    extracted = []
+    feature_extraction = engine._feature_extraction
+
+    def _feature_extraction(data_loader, *args, **kwargs):
+        extracted.append(data_loader.dataset)
+        return feature_extraction(data_loader, *args, **kwargs)
+
+    monkeypatch.setattr(engine, '_feature_extraction', _feature_extraction)
+    options = EvalOptions(dist_metric='pq', pq_subspaces=4)
+    engine.test(0, eval_options=options)
+    engine.test(0, eval_options=options)
+    # query, gallery and training set, then query and gallery
+    assert len(extracted) == 5
+    quantizer = engine._quantizer[1]
+
+    with torch.no_grad():
+        engine.model.fc.bias.add_(1)
+    engine.test(0, eval_options=options)
+    assert len(extracted) == 8
+    assert engine._quantizer[1] is not quantizer
+
+
+class _HeadModel(_Model):
+
+    def __init__(self, head_dims):
+        super(_HeadModel, self).__init__()
+        self.head_dims = head_dims
+
+
+@pytest.mark.parametrize('head_dims', [(64, 96), (512, 64, 96, 128)])
+def test_triplet_center_loss_follows_model_heads(head_dims):
+    from torchreid.engine import ImageTripletEngine
+    datamanager = _DataManager()
+    datamanager.num_train_pids = 20
+    model = _HeadModel(head_dims)
+    engine = ImageTripletEngine(datamanager, model,
+                                torch.optim.SGD(model.parameters(), lr=0.1),
+                                weight_c=0.1, use_gpu=False)
+    assert engine.criterion_c.feat_dims == list(head_dims)
+
+
+def test_triplet_center_loss_requires_heads():
+    from torchreid.engine import ImageTripletEngine
+    datamanager = _DataManager()
+    datamanager.num_train_pids = 20
+    model = _Model()
+    with pytest.raises(ValueError):
+        ImageTripletEngine(datamanager, model,
+                           torch.optim.SGD(model.parameters(), lr=0.1),
+                           weight_c=0.1, use_gpu=False)
+
+
+class _TrainModel(nn.Module):
+    """Conv model with BatchNorm and dropout, returning logits and
+    features in training mode."""
+
+    def __init__(self):
+        super(_TrainModel, self).__init__()
+        torch.manual_seed(0)
+        self.conv = nn.Conv2d(3, 16, 3, padding=1)
+        self.bn = nn.BatchNorm2d(16)
+        self.dropout = nn.Dropout(0.3)
+        self.classifier = nn.Linear(16, 20)
+
+    def forward(self, x):
+        f = torch.relu(self.bn(self.conv(x))).mean((2, 3))
+        f = self.dropout(f)
+        if not self.training:
+            return f
+        return self.classifier(f), f
+
+
+def _triplet_engine(model, **kwargs):
+    from torchreid.engine import ImageTripletEngine
+    datamanager = _DataManager()
+    datamanager.num_train_pids = 20
+    # lr=0 keeps the parameters, so the gradients can be compared
+    optimizer = torch.optim.SGD(model.parameters(), lr=0)
+    return ImageTripletEngine(datamanager, model, optimizer, use_gpu=False,
+                              **kwargs)
+
+
+def _train_batch():
+    rs = np.random.RandomState(0)
+    imgs = torch.from_numpy(rs.randn(16, 3, 4, 4).astype(np.float32))
+    pids = torch.arange(4).repeat_interleave(4)
+    return imgs, pids
+
+
+def test_micro_batch_step_matches_backward_step():
+    imgs, pids = _train_batch()
+    engine = _triplet_engine(_TrainModel(), micro_batch_size=6)
+    engine.model.train()
+    model = engine.model
+    buffers = [b.clone() for b in model.buffers()]
+
+    # reference: the same chunks, but backpropagated through the full graph
+    torch.manual_seed(1)
+    outputs = [engine._forward_train(chunk) for chunk in imgs.split(6)]
+    outputs, features = [torch.cat(o) for o in zip(*outputs)]
+    loss = engine._compute_losses(outputs, features, pids)[0]
+    engine._backward_step(loss)
+    grads = [p.grad.clone() for p in model.parameters()]
+    reference_buffers = [b.clone() for b in model.buffers()]
+    reference_rng_state = torch.get_rng_state()
+
+    for b, saved in zip(model.buffers(), buffers):
+        b.copy_(saved)
+    engine.optimizer.zero_grad(set_to_none=True)
+    torch.manual_seed(1)
+    engine._micro_batch_step(imgs, pids)
+
+    for p, grad in zip(model.parameters(), grads):
+        torch.testing.assert_close(p.grad, grad, rtol=0, atol=1e-5)
+    # the running statistics are updated once per chunk
+    for b, reference in zip(model.buffers(), reference_buffers):
+        torch.testing.assert_close(b, reference)
+    torch.testing.assert_close(torch.get_rng_state(), reference_rng_state)
+
+
+def test_micro_batch_step_matches_full_batch():
+    imgs, pids = _train_batch()
+    # without batch statistics and dropout, the chunks give the same outputs
+    # as the full batch
+    engine = _triplet_engine(_TrainModel(), micro_batch_size=5)
+    engine.model.train()
+    engine.model.bn.eval()
+    engine.model.dropout.p = 0
+
+    outputs, features = engine._forward_train(imgs)
+    loss = engine._compute_losses(outputs, features, pids)[0]
+    engine._backward_step(loss)
+    grads = [p.grad.clone() for p in engine.model.parameters()]
+
+    engine.optimizer.zero_grad(set_to_none=True)
+    engine._micro_batch_step(imgs, pids)
+    for p, grad in zip(engine.model.parameters(), grads):
+        torch.testing.assert_close(p.grad, grad, rtol=0, atol=1e-5)
+
+
+def test_bf16_channels_last_training_step():
+    imgs, pids = _train_batch()
+    model = _TrainModel()
+    engine = _triplet_engine(model, amp='bf16', channels_last=True)
+    engine.optimizer.param_groups[0]['lr'] = 0.1
+    engine.model.train()
+    before = [p.detach().clone() for p in model.parameters()]
+
+    assert engine.scaler is None
+    assert model.conv.weight.is_contiguous(memory_format=torch.channels_last)
+    outputs, features = engine._forward_train(imgs)
+    assert outputs.dtype == features.dtype == torch.float32
+    loss = engine._compute_losses(outputs, features, pids)[0]
+    assert torch.isfinite(loss)
+    engine._backward_step(loss)
+
+    for p, old in zip(model.parameters(), before):
+        assert torch.isfinite(p).all()
+        assert not torch.equal(p, old)
+
+
+@pytest.mark.parametrize('amp, use_gpu, scaled', [
+    (True, True, True),
+    ('fp16', True, True),
+    ('bf16', True, False),
+    (True, False, False),
+    ('fp16', False, False),
+    ('bf16', False, False),
+    (False, True, False),
+])
+def test_grad_scaler_only_for_fp16_on_gpu(amp, use_gpu, scaled, monkeypatch):
+    # the scaler is only created, never used, so no gpu is needed
+    monkeypatch.setattr(torch.cuda, 'is_available', lambda: use_gpu)
+    engine = Engine(_DataManager(), _Model(), use_gpu=True, amp=amp)
+    assert (engine.scaler is not None) == scaled
+
+
+def test_invalid_amp_raises():
+    with pytest.raises(ValueError):
+        Engine(_DataManager(), _Model(), use_gpu=False, amp='fp8')
+
+
+@pytest.fixture
+def evaluations(engine, monkeypatch):
+    """Records the options and save_dir of each evaluation of ``engine``."""
+    calls = []
+
+    def _evaluate(epoch, options, save_dir='', **kwargs):
+        calls.append((options, save_dir))
+        return 0.5
+
+    monkeypatch.setattr(engine, '_evaluate', _evaluate)
+    return calls
+
+
+def test_test_positional_arguments(engine, evaluations):
+    # the order of the arguments before EvalOptions
+    engine.test(0, 'cosine', True, False, 5, 'vis', True, [1, 3], True)
+    options, save_dir = evaluations[0]
+    assert save_dir == 'vis'
+    assert (options.dist_metric, options.normalize_feature, options.visrank,
+            options.visrank_topk, options.use_metric_cuhk03, options.ranks,
+            options.rerank) == ('cosine', True, False, 5, True, [1, 3], True)
+
+    engine.test(0, 'cosine', save_dir='vis', rerank_method='dense')
+    options, save_dir = evaluations[1]
+    assert save_dir == 'vis'
+    assert options.dist_metric == 'cosine'
+    assert options.rerank_method == 'dense'
+
+
+def test_run_positional_arguments(engine, evaluations):
+    engine.run('log', 0, 0, 10, 0, None, 0, -1, True, 'cosine', True, False,
+               5, True)
+    options, save_dir = evaluations[0]
+    assert save_dir == 'log'
+    assert (options.dist_metric, options.normalize_feature, options.visrank,
+            options.visrank_topk, options.use_metric_cuhk03) == \
+        ('cosine', True, False, 5, True)
+
+
+def test_eval_options_is_keyword_only(engine, evaluations):
+    options = EvalOptions(dist_metric='cosine')
+    engine.test(0, eval_options=options, save_dir='vis')
+    engine.run(test_only=True, eval_options=options)
+    assert evaluations == [(options, 'vis'), (options, 'log')]
+
+    with pytest.raises(TypeError):
+        engine.test(0, options)
+    with pytest.raises(TypeError):
+        engine.test(0, 'cosine', dist_metric='cosine')
+    with pytest.raises(TypeError):
+        engine.test(0, eval_options=options, dist_metric='cosine')
+    with pytest.raises(TypeError):
+        engine.test(0, *range(9))
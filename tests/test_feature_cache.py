@@ -0,0 +1,29 @@
+from __future__ import absolute_import
+import numpy as np
+import torch
+
+from torchreid.utils import FeatureCache
+
+
+def _roundtrip(tmp_path, paths):
+    cache = FeatureCache(str(tmp_path))
+    key = cache.make_key('hash', 'toy', 'query', (4, 4), None)
+    features = torch.randn(len(paths), 8)
+    cache.save(key, features, np.arange(len(paths)), np.zeros(len(paths)),
+               paths)
+    cached = cache.load(key)
+    torch.testing.assert_close(cached[0], features)
+    return cached[3]
+
+
+def test_image_paths(tmp_path):
+    paths = ['a.jpg', 'b.jpg', 'c.jpg']
+    assert _roundtrip(tmp_path, paths) == paths
+
+
+def test_tracklet_paths(tmp_path):
+    # tracklets of the same and of different lengths
+    paths = [('a0.jpg', 'a1.jpg'), ('b0.jpg', 'b1.jpg'), ('c0.jpg', )]
+    assert _roundtrip(tmp_path, paths) == paths
+    paths = [['a0.jpg', 'a1.jpg'], ['b0.jpg', 'b1.jpg']]
+    assert _roundtrip(tmp_path / 'lists', paths) == paths
@@ -0,0 +1,67 @@
+from __future__ import absolute_import
+import pytest
+import torch
+from torch import nn
+
+from torchreid import models
+
+MODELS = ['pfh_osnet', 'osnet_x1_0', 'osnet_ain_x1_0']
+
+
+def _model(name):
+    torch.manual_seed(0)
+    model = models.build_model(name, 10, loss='softmax', pretrained=False,
+                               use_gpu=False).eval()
+    # random bn statistics, so that folding is not a no-op
+    for m in model.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.1, 0.1)
+            m.running_var.uniform_(0.5, 1.5)
+    return model
+
+
+def _imgs():
+    generator = torch.Generator().manual_seed(1)
+    return torch.randn(4, 3, 64, 32, generator=generator)
+
+
+@pytest.mark.parametrize('name, num_workers',
+                         [(name, 0) for name in MODELS] + [(MODELS[0], 2)])
+def test_cpu_inference_model(name, num_workers):
+    model, imgs = _model(name), _imgs()
+    with torch.no_grad():
+        reference = model(imgs)
+    cpu_model = models.CPUInferenceModel(model, num_threads=1,
+                                         num_workers=num_workers)
+    try:
+        torch.testing.assert_close(cpu_model(imgs), reference, rtol=1e-4,
+                                   atol=1e-4)
+    finally:
+        cpu_model.close()
+    assert cpu_model._pool is None
+
+
+@pytest.mark.parametrize('name', MODELS)
+def test_fuse_conv_bn(name):
+    model, imgs = _model(name), _imgs()
+    fused = models.fuse_conv_bn(model)
+    # the bn of the basic layers is folded
+    assert not any(
+        isinstance(getattr(m, 'bn', None), nn.BatchNorm2d)
+        for m in fused.modules()
+        if type(m).__name__ in ('ConvLayer', 'Conv1x1', 'Conv1x1Linear',
+                                'Conv3x3', 'LightConv3x3'))
+    with torch.no_grad():
+        torch.testing.assert_close(fused(imgs), model(imgs), rtol=1e-4,
+                                   atol=1e-4)
+
+
+@pytest.mark.parametrize('name', MODELS)
+@pytest.mark.parametrize('channels_last', [True, False])
+def test_optimize_for_inference(name, channels_last):
+    model, imgs = _model(name), _imgs()
+    optimized = models.optimize_for_inference(
+        model, example_input=imgs[:1].clone(), channels_last=channels_last)
+    with torch.no_grad():
+        torch.testing.assert_close(optimized(imgs), model(imgs), rtol=1e-4,
+                                   atol=1e-4)
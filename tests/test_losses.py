@@ -0,0 +1,300 @@
+from __future__ import absolute_import
+import pytest
+import torch
+from torch.nn import functional as F
+
+from torchreid.losses import hard_mine_triplet_loss, loss_context
+from torchreid.losses import (CenterLoss, CrossEntropyLoss, DeepSupervision,
+                              LossContext, MultiHeadCenterLoss, RangeLoss,
+                              TripletLoss, pairwise_distances)
+
+
+def _batch_all_reference(inputs, targets, margin):
+    """Loss over the explicit list of valid triplets."""
+    dist = torch.cdist(inputs, inputs)
+    losses = []
+    for a in range(len(targets)):
+        for p in range(len(targets)):
+            for n in range(len(targets)):
+                if p != a and targets[p] == targets[a] \
+                        and targets[n] != targets[a]:
+                    losses.append(dist[a, p] - dist[a, n])
+    diff = torch.stack(losses)
+    if margin > 0:
+        losses = F.relu(diff + margin)
+        return losses.sum() / (losses > 0).sum().clamp(min=1)
+    return F.softplus(diff).mean()
+
+
+@pytest.mark.parametrize('margin', [0.3, 0.])
+@pytest.mark.parametrize('chunk_triplets', [2**24, 300])
+def test_batch_all_matches_reference(margin, chunk_triplets, monkeypatch):
+    # a small budget reduces the anchors in several chunks
+    monkeypatch.setattr(hard_mine_triplet_loss, '_CHUNK_TRIPLETS',
+                        chunk_triplets)
+    torch.manual_seed(0)
+    # identities with 1 to 4 instances
+    targets = torch.tensor([0, 0, 0, 0, 1, 1, 2, 3, 3, 3])
+    inputs = torch.randn(len(targets), 16, dtype=torch.float64)
+    criterion = TripletLoss(margin=margin, mining='batch_all')
+    torch.testing.assert_close(criterion(inputs, targets),
+                               _batch_all_reference(inputs, targets, margin))
+
+    # heads are averaged
+    heads = [inputs, inputs[:, :8]]
+    expected = sum(
+        _batch_all_reference(x, targets, margin) for x in heads) / 2
+    torch.testing.assert_close(criterion.forward_heads(heads, targets),
+                               expected)
+
+
+@pytest.mark.parametrize('targets', [
+    [0, 0, 1, 1, 2, 2],  # p*k batch
+    [0, 0, 1, 1, 0, 0],  # an id in two runs
+    [0, 1, 0, 1, 2, 2],  # runs of mixed ids
+])
+def test_range_loss_ordered_matches_unordered(targets):
+    torch.manual_seed(0)
+    targets = torch.tensor(targets)
+    features = torch.randn(len(targets), 8, dtype=torch.float64)
+    ordered = RangeLoss(use_gpu=False, ids_per_batch=3, imgs_per_id=2)
+    unordered = RangeLoss(use_gpu=False, ordered=False)
+    for output, expected in zip(ordered(features, targets),
+                                unordered(features, targets)):
+        torch.testing.assert_close(output.double(), expected.double())
+
+
+def _batch_hard_loop(criterion, inputs, targets):
+    """Hardest positive and negative of each anchor, one anchor at a time."""
+    dist = torch.cdist(inputs, inputs)
+    dist_ap, dist_an = [], []
+    for i in range(len(targets)):
+        dist_ap.append(dist[i][targets == targets[i]].max())
+        dist_an.append(dist[i][targets != targets[i]].min())
+    dist_ap, dist_an = torch.stack(dist_ap), torch.stack(dist_an)
+    return criterion.ranking_loss(dist_an, dist_ap, torch.ones_like(dist_an))
+
+
+@pytest.mark.parametrize('num_pids, num_instances', [(8, 4), (4, 8)])
+def test_batch_hard_matches_loop(num_pids, num_instances):
+    torch.manual_seed(0)
+    targets = torch.arange(num_pids).repeat_interleave(num_instances)
+    criterion = TripletLoss(margin=0.3)
+    grads = []
+    for loss_fn in [criterion, lambda x, t: _batch_hard_loop(criterion, x, t)]:
+        torch.manual_seed(1)
+        inputs = torch.randn(len(targets), 64, dtype=torch.float64,
+                             requires_grad=True)
+        loss_fn(inputs, targets).backward()
+        grads.append(inputs.grad)
+    torch.testing.assert_close(grads[0], grads[1])
+
+
+def _class_matrix_loss(criterion, x, labels):
+    """Center loss from the batch x num_classes distance matrix."""
+    distmat = torch.cdist(x, criterion.centers).pow(2)
+    dist = distmat.gather(1, labels.unsqueeze(1)).clamp(min=1e-12, max=1e+12)
+    return dist.mean()
+
+
+def test_center_loss_matches_class_matrix():
+    torch.manual_seed(0)
+    feat_dims, num_classes = [512, 64, 96, 128], 20
+    criteria = [CenterLoss(num_classes, d, use_gpu=False) for d in feat_dims]
+    fused = MultiHeadCenterLoss(num_classes, feat_dims, use_gpu=False)
+    with torch.no_grad():
+        fused.centers.copy_(torch.cat([c.centers for c in criteria], dim=1))
+    xs = [torch.randn(32, d) for d in feat_dims]
+    labels = torch.randint(num_classes, (32, ))
+
+    expected = sum(
+        _class_matrix_loss(c, x, labels) for c, x in zip(criteria, xs))
+    for c, x in zip(criteria, xs):
+        torch.testing.assert_close(c(x, labels),
+                                   _class_matrix_loss(c, x, labels),
+                                   rtol=1e-4, atol=1e-3)
+    torch.testing.assert_close(fused(xs, labels), expected, rtol=1e-4,
+                               atol=1e-3)
+
+    # the fused centers receive the gradients of the per-head centers
+    expected.backward()
+    fused(xs, labels).backward()
+    torch.testing.assert_close(
+        fused.centers.grad,
+        torch.cat([c.centers.grad for c in criteria], dim=1))
+
+
+@pytest.mark.parametrize('ids_per_batch, imgs_per_id', [(4, 4), (16, 4),
+                                                         (8, 8)])
+def test_range_loss_pk_gradients(ids_per_batch, imgs_per_id):
+    torch.manual_seed(0)
+    targets = torch.arange(ids_per_batch).repeat_interleave(imgs_per_id)
+    features = torch.rand(len(targets), 256)
+    outputs = []
+    for ordered in [True, False]:
+        criterion = RangeLoss(use_gpu=False, ordered=ordered,
+                              ids_per_batch=ids_per_batch,
+                              imgs_per_id=imgs_per_id)
+        inputs = features.clone().requires_grad_()
+        losses = criterion(inputs, targets)
+        losses[0].backward()
+        outputs.append(losses + (inputs.grad, ))
+    for pk, loop in zip(*outputs):
+        torch.testing.assert_close(pk, loop, rtol=1e-4, atol=1e-6)
+
+
+def _per_head_mean(criterion, xs, targets):
+    return sum(criterion(x, targets) for x in xs) / len(xs)
+
+
+@pytest.mark.parametrize('num_classes', [[10, 10, 10], [10, 12, 10]])
+def test_cross_entropy_forward_heads(num_classes):
+    # logits of different shapes fall back to one loss per head
+    torch.manual_seed(0)
+    targets = torch.randint(10, (8, ))
+    xs = [torch.randn(8, c) for c in num_classes]
+    criterion = CrossEntropyLoss(num_classes=10, use_gpu=False)
+    torch.testing.assert_close(criterion.forward_heads(xs, targets),
+                               _per_head_mean(criterion, xs, targets))
+
+
+@pytest.mark.parametrize('mining', ['batch_hard', 'batch_all'])
+@pytest.mark.parametrize('feat_dims', [[16, 16], [16, 8, 12]])
+def test_triplet_forward_heads(mining, feat_dims):
+    # features of different dimensions are zero-padded
+    torch.manual_seed(0)
+    targets = torch.arange(4).repeat_interleave(3)
+    xs = [torch.randn(12, d, dtype=torch.float64) for d in feat_dims]
+    criterion = TripletLoss(margin=0.3, mining=mining)
+    torch.testing.assert_close(criterion.forward_heads(xs, targets),
+                               _per_head_mean(criterion, xs, targets))
+
+
+class _CountingCrossEntropyLoss(CrossEntropyLoss):
+
+    def __init__(self, *args, **kwargs):
+        super(_CountingCrossEntropyLoss, self).__init__(*args, **kwargs)
+        self.fused_calls = 0
+
+    def forward_heads(self, inputs, targets):
+        self.fused_calls += 1
+        return super(_CountingCrossEntropyLoss,
+                     self).forward_heads(inputs, targets)
+
+
+def test_deep_supervision():
+    torch.manual_seed(0)
+    targets = torch.arange(4).repeat_interleave(3)
+    xs = [torch.randn(12, 10), torch.randn(12, 10)]
+    # criteria with forward_heads are fused
+    criterion = _CountingCrossEntropyLoss(num_classes=10, use_gpu=False)
+    torch.testing.assert_close(DeepSupervision(criterion, xs, targets),
+                               _per_head_mean(criterion, xs, targets))
+    assert criterion.fused_calls == 1
+
+    # the others are applied to each input
+    def criterion(x, y):
+        return x.sum() * y.sum()
+
+    torch.testing.assert_close(DeepSupervision(criterion, xs, targets),
+                               _per_head_mean(criterion, xs, targets))
+
+
+@pytest.mark.parametrize('targets', [
+    [0, 0, 1, 1, 0, 0],  # p*k sized, an id in two runs
+    [0, 0, 1, 1, 2],  # not p*k sized
+    [0, 0, 0, 1, 1, 1, 2, 2],  # runs of other lengths
+])
+def test_range_loss_ordered_non_pk_batch(targets):
+    # ordered batches that are not p*k are computed over their actual ids
+    torch.manual_seed(0)
+    targets = torch.tensor(targets)
+    features = torch.randn(len(targets), 8, dtype=torch.float64)
+    ordered = RangeLoss(use_gpu=False, ids_per_batch=3, imgs_per_id=2)
+    assert not ordered._is_pk_batch(targets, 3, 2)
+    expected = RangeLoss(use_gpu=False)._range_loss(features, targets, False,
+                                                    3, 2)
+    for output, expected in zip(ordered(features, targets), expected):
+        torch.testing.assert_close(output.double(), expected.double())
+
+
+def _context(feat_dims=(16, 8, 12), targets=None, timed=False):
+    torch.manual_seed(0)
+    if targets is None:
+        targets = torch.arange(4).repeat_interleave(3)
+    features = [torch.randn(len(targets), d, dtype=torch.float64)
+                for d in feat_dims]
+    return LossContext(features, targets, timed=timed)
+
+
+def test_loss_context_distances_are_shared(monkeypatch):
+    calls = []
+
+    def _pairwise_distances(inputs):
+        calls.append(inputs)
+        return pairwise_distances(inputs)
+
+    monkeypatch.setattr(loss_context, 'pairwise_distances',
+                        _pairwise_distances)
+    context = _context()
+    TripletLoss(margin=0.3).forward_context(context)
+    RangeLoss(use_gpu=False, ids_per_batch=4,
+              imgs_per_id=3).forward_context(context)
+    TripletLoss(margin=0.3, mining='batch_all').forward_context(context)
+    assert len(calls) == 1
+    assert context.distances() is context.distances()
+
+
+def test_loss_context_time(monkeypatch):
+    clock = iter([0., 1., 10., 12., 20., 24.])
+    monkeypatch.setattr(loss_context, 'time',
+                        type('_Time', (), {'time': lambda: next(clock)}))
+    context = _context(timed=True)
+    with context.time('distance'):
+        pass
+    with context.time('triplet'):
+        pass
+    # the times of a name are summed
+    with context.time('distance'):
+        pass
+    assert list(context.timings.items()) == [('distance', 5.), ('triplet', 2.)]
+
+    # untimed contexts do not read the clock
+    context = _context()
+    with context.time('distance'):
+        pass
+    assert context.timings == {}
+    assert next(clock, None) is None
+
+
+@pytest.mark.parametrize('mining', ['batch_hard', 'batch_all'])
+def test_triplet_forward_context(mining):
+    context = _context()
+    criterion = TripletLoss(margin=0.3, mining=mining)
+    torch.testing.assert_close(
+        criterion.forward_context(context),
+        _per_head_mean(criterion, context.features, context.targets))
+
+
+@pytest.mark.parametrize('targets', [
+    [0, 0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3],  # p*k
+    [0, 0, 0, 1, 1, 1, 0, 0, 0, 3, 3, 3],  # p*k sized, an id in two runs
+    [0, 1, 2, 3, 0, 1, 2, 3, 0, 1, 2, 3],  # not ordered
+])
+def test_range_forward_context(targets):
+    context = _context(targets=torch.tensor(targets))
+    criterion = RangeLoss(use_gpu=False, ids_per_batch=4, imgs_per_id=3)
+    losses = [criterion(x, context.targets) for x in context.features]
+    for output, expected in zip(criterion.forward_context(context),
+                                zip(*losses)):
+        torch.testing.assert_close(output.double(),
+                                   (sum(expected) / len(expected)).double())
+
+
+def test_center_forward_context():
+    context = _context()
+    criterion = MultiHeadCenterLoss(num_classes=4, feat_dims=[16, 8, 12],
+                                    use_gpu=False).double()
+    torch.testing.assert_close(
+        criterion.forward_context(context),
+        criterion(context.features, context.targets))
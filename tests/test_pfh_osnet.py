@@ -0,0 +1,165 @@
+from __future__ import absolute_import
+import copy
+import pytest
+import torch
+from torch import nn
+
+from torchreid import models
+from torchreid.models.pfh_osnet import HEAD_DIMS, HEADS, ChannelGate, OSBlock
+
+
+def _block(momentum=0.1):
+    torch.manual_seed(0)
+    block = OSBlock(32, 64)
+    for m in block.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.momentum = momentum
+            m.running_mean.uniform_(-0.1, 0.1)
+            m.running_var.uniform_(0.5, 1.5)
+    return block
+
+
+def _streams(block, x1):
+    return (block.conv2a(x1), block.conv2b(x1), block.conv2c(x1),
+            block.conv2d(x1))
+
+
+def _x1():
+    generator = torch.Generator().manual_seed(1)
+    return torch.randn(4, 16, 16, 8, generator=generator)
+
+
+@pytest.mark.parametrize('fused', [False, True])
+def test_grouped_streams_match_streams_in_eval(fused):
+    block = _block().eval()
+    if fused:
+        block = models.fuse_conv_bn(block)
+    x1 = _x1()
+    with torch.no_grad():
+        for grouped, stream in zip(block._grouped_streams(x1),
+                                   _streams(block, x1)):
+            torch.testing.assert_close(grouped, stream, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('momentum', [0.1, None])
+def test_grouped_streams_match_streams_in_train(momentum):
+    block = _block(momentum).train()
+    reference = copy.deepcopy(block)
+    # twice, so that the running statistics are used after an update
+    for seed in [1, 2]:
+        x1 = torch.randn(4, 16, 16, 8,
+                         generator=torch.Generator().manual_seed(seed))
+        for grouped, stream in zip(block._grouped_streams(x1),
+                                   _streams(reference, x1)):
+            torch.testing.assert_close(grouped, stream, rtol=1e-5, atol=1e-5)
+
+    for (name, grouped), stream in zip(block.named_buffers(),
+                                       reference.buffers()):
+        torch.testing.assert_close(grouped, stream, rtol=1e-5, atol=1e-6,
+                                   msg=name)
+
+
+def test_grouped_streams_gradients():
+    block = _block().train()
+    reference = copy.deepcopy(block)
+    x1 = _x1()
+    sum(s.square().sum() for s in block._grouped_streams(x1)).backward()
+    sum(s.square().sum() for s in _streams(reference, x1)).backward()
+    for (name, grouped), stream in zip(block.named_parameters(),
+                                       reference.parameters()):
+        if stream.grad is None:
+            assert grouped.grad is None
+            continue
+        torch.testing.assert_close(grouped.grad, stream.grad, rtol=1e-4,
+                                   atol=1e-4, msg=name)
+
+
+@pytest.mark.parametrize('return_gates', [False, True])
+def test_gate_forward_streams(return_gates):
+    torch.manual_seed(0)
+    gate = ChannelGate(32, return_gates=return_gates)
+    streams = torch.randn(4, 2, 32, 8, 4).unbind()
+    torch.testing.assert_close(gate.forward_streams(streams),
+                               sum(gate(x) for x in streams))
+
+
+@pytest.mark.parametrize('training', [False, True])
+def test_osblock_grouped_forward(training):
+    block = _block().train(training)
+    reference = copy.deepcopy(block)
+    x = torch.randn(2, 32, 16, 8, generator=torch.Generator().manual_seed(3))
+    with torch.no_grad():
+        # OSBlock.forward with the grouped streams it runs on gpu
+        x2 = block.gate.forward_streams(
+            list(block._grouped_streams(block.conv1(x))))
+        out = nn.functional.relu(block.conv3(x2) + block.downsample(x))
+        expected, expected_x2 = reference(x)
+
+    torch.testing.assert_close(x2, expected_x2, rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(out, expected, rtol=1e-5, atol=1e-5)
+    for grouped, stream in zip(block.buffers(), reference.buffers()):
+        torch.testing.assert_close(grouped, stream, rtol=1e-5, atol=1e-6)
+
+
+@pytest.fixture(scope='module')
+def model():
+    torch.manual_seed(0)
+    return models.build_model('pfh_osnet', 10, loss='triplet',
+                              pretrained=False, use_gpu=False)
+
+
+def _imgs():
+    return torch.randn(2, 3, 64, 32,
+                       generator=torch.Generator().manual_seed(4))
+
+
+@pytest.mark.parametrize('heads, expected', [
+    (('global', ), ('global', )),
+    (('c', 'a'), ('a', 'c')),  # ordered as HEADS
+    (('b', ), ('b', )),
+    (HEADS, HEADS),
+])
+def test_set_heads_output_dims(model, heads, expected):
+    model.set_heads(heads)
+    assert model.heads == expected
+    assert model.head_dims == tuple(HEAD_DIMS[h] for h in expected)
+
+    imgs = _imgs()
+    model.train()
+    y, v = model(imgs)
+    assert [f.shape for f in v] == [(2, d) for d in model.head_dims]
+    assert [logits.shape for logits in y] == [(2, 10)] * len(expected)
+    model.eval()
+    with torch.no_grad():
+        assert model(imgs).shape == (2, sum(model.head_dims))
+
+
+def test_set_heads_weights(model):
+    model.set_heads(('b', 'a'), (2., 0.5))
+    model.eval()
+    assert model.head_weights == (0.5, 2.)
+    with torch.no_grad():
+        descriptor = model(_imgs())
+    norms = [part.norm(dim=1)
+             for part in descriptor.split(list(model.head_dims), dim=1)]
+    torch.testing.assert_close(torch.stack(norms),
+                               torch.tensor([[0.5] * 2, [2.] * 2]))
+
+
+@pytest.mark.parametrize('heads, head_weights', [
+    (('d', ), None),
+    (('a', 'global_'), None),
+    ((), None),
+    (('a', 'b'), (1., )),
+])
+def test_set_heads_rejects_invalid_heads(model, heads, head_weights):
+    model.set_heads(('a', 'b'))
+    with pytest.raises(ValueError):
+        model.set_heads(heads, head_weights)
+    assert model.heads == ('a', 'b') and model.head_dims == (64, 96)
+
+
+def test_build_model_rejects_invalid_heads():
+    with pytest.raises(ValueError):
+        models.build_model('pfh_osnet', 10, pretrained=False, use_gpu=False,
+                           heads=('global', 'x'))
@@ -0,0 +1,63 @@
+from __future__ import absolute_import
+import numpy as np
+import pytest
+import torch
+
+from torchreid import metrics
+
+DEVICES = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
+
+def _features(device):
+    torch.manual_seed(0)
+    qf = torch.randn(64, 256, device=device)
+    gf = torch.randn(96, 256, device=device)
+    return qf, gf
+
+
+@pytest.mark.parametrize('device', DEVICES)
+@pytest.mark.parametrize('precision', ['fp16', 'bf16', 'int8'])
+@pytest.mark.parametrize('metric', ['euclidean', 'cosine'])
+def test_reduced_precision_distances(device, precision, metric):
+    qf, gf = _features(device)
+    q_encoded = metrics.encode_features(qf, precision)
+    g_encoded = metrics.encode_features(gf, precision)
+    distmat = metrics.compute_distance_matrix(q_encoded, g_encoded, metric)
+    assert distmat.dtype == torch.float32
+
+    # the stored values are multiplied as accurately as float32 features
+    decoded = metrics.compute_distance_matrix(
+        metrics.decode_features(q_encoded), metrics.decode_features(g_encoded),
+        metric
+    )
+    scale = decoded.abs().max()
+    assert (distmat - decoded).abs().max() <= 1e-5 * scale
+
+    # and stay close to the float32 distances
+    reference = metrics.compute_distance_matrix(qf, gf, metric)
+    tolerance = {'fp16': 1e-3, 'bf16': 1e-2, 'int8': 2e-2}[precision]
+    assert (distmat - reference).abs().max() <= tolerance * scale
+
+
+@pytest.mark.parametrize('metric', ['euclidean', 'cosine'])
+def test_precision_report(metric):
+    # clustered features, so that rank-1 and mAP are meaningful
+    torch.manual_seed(0)
+    num_pids, num_q, num_g, feat_dim = 50, 100, 1000, 128
+    centers = torch.randn(num_pids, feat_dim)
+    q_pids = np.random.RandomState(0).randint(0, num_pids, num_q)
+    g_pids = np.random.RandomState(1).randint(0, num_pids, num_g)
+    qf = centers[torch.from_numpy(q_pids)] + 2 * torch.randn(num_q, feat_dim)
+    gf = centers[torch.from_numpy(g_pids)] + 2 * torch.randn(num_g, feat_dim)
+    q_camids = np.zeros(num_q, dtype=np.int64)
+    g_camids = np.ones(num_g, dtype=np.int64)
+
+    rows = metrics.precision_report(qf, gf, q_pids, g_pids, q_camids,
+                                    g_camids, metric=metric)
+    assert [row['precision'] for row in rows] == list(metrics.PRECISIONS)
+    ref = rows[0]
+    for row in rows[1:]:
+        assert row['bytes'] < ref['bytes']
+        assert abs(row['rank1'] - ref['rank1']) <= 0.02
+        assert abs(row['mAP'] - ref['mAP']) <= 0.01
+    metrics.print_precision_report(rows)
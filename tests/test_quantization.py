@@ -0,0 +1,74 @@
+from __future__ import absolute_import
+import pytest
+import torch
+
+from torchreid import metrics
+from torchreid.metrics import distance
+
+
+def _features(num, feat_dim=32, seed=0):
+    # correlated dimensions, which the OPQ rotation decorrelates
+    generator = torch.Generator().manual_seed(seed)
+    mixing = torch.randn(feat_dim, feat_dim,
+                         generator=torch.Generator().manual_seed(42))
+    return torch.randn(num, feat_dim, generator=generator).mm(mixing)
+
+
+def _quantizer(opq=False):
+    quantizer = metrics.ProductQuantizer(num_subspaces=8, num_centroids=16,
+                                         opq=opq, num_iters=5, opq_iters=3)
+    quantizer.train(_features(500))
+    return quantizer
+
+
+@pytest.mark.parametrize('opq', [False, True])
+def test_encode_decode_shapes(opq):
+    quantizer = _quantizer(opq)
+    features = _features(37, seed=1)
+    codes = quantizer.encode(features)
+    assert codes.shape == (37, 8) and codes.dtype == torch.uint8
+    assert codes.max() < 16
+    reconstructions = quantizer.decode(codes)
+    assert reconstructions.shape == features.shape
+    # the reconstructions, back from the rotated space, have the same codes
+    if opq:
+        reconstructions = reconstructions.mm(quantizer.rotation.t())
+    torch.testing.assert_close(quantizer.encode(reconstructions), codes,
+                               rtol=0, atol=0)
+
+
+def test_opq_rotation_is_orthogonal():
+    assert _quantizer().rotation is None
+    rotation = _quantizer(opq=True).rotation
+    assert rotation.shape == (32, 32)
+    torch.testing.assert_close(rotation.t().mm(rotation), torch.eye(32),
+                               rtol=0, atol=1e-4)
+
+
+@pytest.mark.parametrize('opq', [False, True])
+def test_asymmetric_distance(opq):
+    # the distance to the reconstruction, in the rotated space with OPQ
+    quantizer = _quantizer(opq)
+    qf, gf = _features(20, seed=1), _features(50, seed=2)
+    codes = quantizer.encode(gf)
+    if opq:
+        qf_rotated = qf.mm(quantizer.rotation)
+    else:
+        qf_rotated = qf
+    expected = torch.cdist(qf_rotated, quantizer.decode(codes)).pow(2)
+    torch.testing.assert_close(quantizer.asymmetric_distance(qf, codes),
+                               expected, rtol=1e-4, atol=1e-2)
+
+
+@pytest.mark.parametrize('block_shape', [(7, 13), (20, 50), (1, 1)])
+def test_pq_metric_blockwise(block_shape, monkeypatch):
+    monkeypatch.setattr(distance, '_block_shape', lambda *args: block_shape)
+    quantizer = _quantizer(opq=True)
+    qf, codes = _features(20, seed=1), quantizer.encode(_features(50, seed=2))
+    expected = quantizer.asymmetric_distance(qf, codes)
+    torch.testing.assert_close(
+        metrics.compute_distance_matrix(qf, codes, 'pq', quantizer), expected)
+    blocks = metrics.compute_distance_matrix_blockwise(
+        qf, codes, 'pq', quantizer=quantizer)
+    torch.testing.assert_close(torch.cat([d for _, _, d in blocks]),
+                               expected, rtol=1e-5, atol=1e-4)
@@ -0,0 +1,148 @@
+from __future__ import absolute_import
+import numpy as np
+import pytest
+
+from torchreid import metrics
+from torchreid.metrics import rank
+
+requires_cython = pytest.mark.skipif(not rank.IS_CYTHON_AVAI,
+                                     reason='rank_cy is not built')
+
+
+def _inputs(num_q=30, num_g=200, num_pids=20, seed=0):
+    """Random distances; pids beyond those of the gallery and shared camids
+    give queries without a valid match."""
+    rs = np.random.RandomState(seed)
+    distmat = rs.rand(num_q, num_g).astype(np.float32)
+    q_pids = rs.randint(0, num_pids + 5, num_q)
+    g_pids = rs.randint(0, num_pids, num_g)
+    q_camids = rs.randint(0, 3, num_q)
+    g_camids = rs.randint(0, 3, num_g)
+    return distmat, q_pids, g_pids, q_camids, g_camids
+
+
+def _single_shot_inputs(num_q=30, num_pids=40, seed=0):
+    """One gallery image per identity, so that the cuhk03 sampling is
+    deterministic."""
+    rs = np.random.RandomState(seed)
+    distmat = rs.rand(num_q, num_pids).astype(np.float32)
+    q_pids = rs.randint(0, num_pids + 5, num_q)
+    g_pids = rs.permutation(num_pids)
+    return distmat, q_pids, g_pids, np.zeros(num_q, dtype=np.int64), \
+        np.ones(num_pids, dtype=np.int64)
+
+
+def _assert_results_equal(results, expected):
+    assert len(results) == len(expected)
+    np.testing.assert_allclose(results[0], expected[0], rtol=1e-6, atol=1e-6)
+    for r, e in zip(results[1:], expected[1:]):
+        assert r == pytest.approx(e, rel=1e-6, abs=1e-6)
+
+
+@requires_cython
+@pytest.mark.parametrize('partial_rank', [False, True])
+@pytest.mark.parametrize('num_threads', [1, 2, 0])
+@pytest.mark.parametrize('max_rank', [10, 500])
+def test_cython_matches_python_market1501(partial_rank, num_threads,
+                                          max_rank):
+    inputs = _inputs()
+    expected = metrics.evaluate_rank(*inputs, max_rank=max_rank,
+                                     use_cython=False,
+                                     partial_rank=partial_rank)
+    results = metrics.evaluate_rank(*inputs, max_rank=max_rank,
+                                    partial_rank=partial_rank,
+                                    num_threads=num_threads)
+    _assert_results_equal(results, expected)
+
+
+@requires_cython
+@pytest.mark.parametrize('partial_rank', [False, True])
+@pytest.mark.parametrize('num_threads', [1, 2, 0])
+def test_cython_matches_python_cuhk03(partial_rank, num_threads):
+    inputs = _single_shot_inputs()
+    expected = metrics.evaluate_rank(*inputs, max_rank=20,
+                                     use_metric_cuhk03=True,
+                                     use_cython=False,
+                                     partial_rank=partial_rank)
+    results = metrics.evaluate_rank(*inputs, max_rank=20,
+                                    use_metric_cuhk03=True,
+                                    partial_rank=partial_rank,
+                                    num_threads=num_threads)
+    _assert_results_equal(results, expected)
+
+
+@requires_cython
+def test_cython_cuhk03_map_matches_python():
+    # the gallery sampling of cmc differs, ap does not depend on it
+    inputs = _inputs()
+    expected = metrics.evaluate_rank(*inputs, max_rank=10,
+                                     use_metric_cuhk03=True,
+                                     use_cython=False)[1]
+    for partial_rank in [False, True]:
+        for num_threads in [1, 2]:
+            mAP = metrics.evaluate_rank(*inputs, max_rank=10,
+                                        use_metric_cuhk03=True,
+                                        partial_rank=partial_rank,
+                                        num_threads=num_threads)[1]
+            assert mAP == pytest.approx(expected, rel=1e-6)
+
+
+def _tied(distmat):
+    """Distances on a coarse grid, negative ones included, so that many
+    tie, and the same distances with the ties broken by gallery index."""
+    tied = (np.floor(distmat * 8) - 4 + 0.5).astype(np.float32) / 4
+    num_g = distmat.shape[1]
+    ordered = tied + np.arange(num_g, dtype=np.float32) * (0.1 / num_g)
+    return tied, ordered
+
+
+@requires_cython
+@pytest.mark.parametrize('tied', [False, True])
+def test_sorted_ranks_match_argsort_market1501(tied):
+    # the threaded evaluation sorts each row with a stable radix sort
+    distmat, q_pids, g_pids, q_camids, g_camids = _inputs()
+    reference = distmat
+    if tied:
+        distmat, reference = _tied(distmat)
+    expected = metrics.evaluate_rank(reference, q_pids, g_pids, q_camids,
+                                     g_camids, max_rank=50)
+    results = metrics.evaluate_rank(distmat, q_pids, g_pids, q_camids,
+                                    g_camids, max_rank=50, num_threads=2)
+    _assert_results_equal(results, expected)
+    _assert_results_equal(
+        metrics.evaluate_rank(reference, q_pids, g_pids, q_camids, g_camids,
+                              max_rank=50, use_cython=False), expected)
+
+
+@requires_cython
+@pytest.mark.parametrize('tied', [False, True])
+def test_sorted_ranks_match_argsort_cuhk03(tied):
+    distmat, q_pids, g_pids, q_camids, g_camids = _single_shot_inputs()
+    reference = distmat
+    if tied:
+        distmat, reference = _tied(distmat)
+    expected = metrics.evaluate_rank(reference, q_pids, g_pids, q_camids,
+                                     g_camids, max_rank=20,
+                                     use_metric_cuhk03=True)
+    results = metrics.evaluate_rank(distmat, q_pids, g_pids, q_camids,
+                                    g_camids, max_rank=20,
+                                    use_metric_cuhk03=True, num_threads=2)
+    _assert_results_equal(results, expected)
+
+
+@pytest.mark.parametrize('max_rank', [10, 200, 500])
+@pytest.mark.parametrize('block_size', [None, 1, 7])
+def test_vectorized_matches_loop(max_rank, block_size):
+    # queries without a valid match, and max_rank beyond the kept gallery
+    inputs = _inputs()
+    expected = rank.eval_market1501(*inputs, max_rank=max_rank)
+    results = rank.eval_market1501_vectorized(*inputs, max_rank=max_rank,
+                                              block_size=block_size)
+    _assert_results_equal(results, expected)
+
+
+def test_vectorized_without_valid_queries():
+    distmat, q_pids, g_pids, q_camids, g_camids = _inputs()
+    with pytest.raises(AssertionError):
+        rank.eval_market1501_vectorized(distmat, q_pids + 100, g_pids,
+                                        q_camids, g_camids, max_rank=10)
@@ -0,0 +1,85 @@
+from __future__ import absolute_import
+import numpy as np
+import pytest
+import torch
+
+from torchreid import metrics
+from torchreid.metrics import rank_torch
+
+
+def _inputs(num_q=30, num_g=200, num_pids=20, seed=0):
+    """Random distances; pids beyond those of the gallery and shared camids
+    give queries without a valid match."""
+    rs = np.random.RandomState(seed)
+    distmat = rs.rand(num_q, num_g).astype(np.float32)
+    q_pids = rs.randint(0, num_pids + 5, num_q)
+    g_pids = rs.randint(0, num_pids, num_g)
+    q_camids = rs.randint(0, 3, num_q)
+    g_camids = rs.randint(0, 3, num_g)
+    return distmat, q_pids, g_pids, q_camids, g_camids
+
+
+def _blocks(distmat, rows):
+    distmat = torch.from_numpy(distmat)
+    for start in range(0, distmat.size(0), rows):
+        yield start, min(start + rows, distmat.size(0)), \
+            distmat[start:start + rows]
+
+
+@pytest.mark.parametrize('max_rank', [10, 500])
+def test_market1501(max_rank):
+    distmat, q_pids, g_pids, q_camids, g_camids = _inputs()
+    expected = metrics.evaluate_rank(distmat, q_pids, g_pids, q_camids,
+                                     g_camids, max_rank=max_rank,
+                                     use_cython=False)
+    for dist, block_size in [(torch.from_numpy(distmat), None),
+                             (torch.from_numpy(distmat), 7),
+                             (_blocks(distmat, 11), 4)]:
+        cmc, mAP, mINP = metrics.evaluate_rank_torch(
+            dist, q_pids, g_pids, q_camids, g_camids, max_rank=max_rank,
+            block_size=block_size)
+        np.testing.assert_allclose(cmc, expected[0], rtol=1e-6)
+        np.testing.assert_allclose([mAP, mINP], expected[1:], rtol=1e-6)
+
+
+def test_cuhk03_single_shot():
+    # one gallery image per identity, so that sampling is deterministic
+    distmat, q_pids, _, q_camids, g_camids = _inputs()
+    g_pids = np.random.RandomState(1).permutation(distmat.shape[1])
+    q_pids = q_pids * 8
+    expected = metrics.evaluate_rank(distmat, q_pids, g_pids, q_camids,
+                                     g_camids, use_metric_cuhk03=True,
+                                     use_cython=False)
+    for dist in [torch.from_numpy(distmat), _blocks(distmat, 11)]:
+        cmc, mAP = metrics.evaluate_rank_torch(dist, q_pids, g_pids,
+                                               q_camids, g_camids,
+                                               use_metric_cuhk03=True,
+                                               block_size=4)
+        np.testing.assert_allclose(cmc, expected[0], rtol=1e-6)
+        np.testing.assert_allclose(mAP, expected[1], rtol=1e-6)
+
+
+def test_cuhk03():
+    # mAP is exact, the cmc of sampled galleries only close
+    distmat, q_pids, g_pids, q_camids, g_camids = _inputs(num_q=200)
+    np.random.seed(0)
+    torch.manual_seed(0)
+    expected = metrics.evaluate_rank(distmat, q_pids, g_pids, q_camids,
+                                     g_camids, use_metric_cuhk03=True,
+                                     use_cython=False)
+    cmc, mAP = metrics.evaluate_rank_torch(torch.from_numpy(distmat), q_pids,
+                                           g_pids, q_camids, g_camids,
+                                           use_metric_cuhk03=True)
+    np.testing.assert_allclose(mAP, expected[1], rtol=1e-6)
+    # the python cmc stops at the number of gallery identities, beyond which
+    # every valid query has found its match
+    num_ids = len(expected[0])
+    np.testing.assert_allclose(cmc[:num_ids], expected[0], atol=0.05)
+    np.testing.assert_allclose(cmc[num_ids:], 1)
+
+
+def test_accumulation_dtype():
+    assert rank_torch._accumulation_dtype(
+        torch.device('cpu')) == torch.float64
+    assert rank_torch._accumulation_dtype(
+        torch.device('mps')) == torch.float32
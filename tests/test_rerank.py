@@ -0,0 +1,105 @@
+from __future__ import absolute_import
+import numpy as np
+import pytest
+import torch
+
+from torchreid.metrics import compute_distance_matrix, evaluate_rank
+from torchreid.utils import (ReRanker, re_ranking, re_ranking_sparse,
+                             re_ranking_torch)
+
+
+def _features(num_q, num_g, feat_dim=16):
+    torch.manual_seed(0)
+    return torch.randn(num_q, feat_dim), torch.randn(num_g, feat_dim)
+
+
+def _distances(num_q, num_g):
+    qf, gf = _features(num_q, num_g)
+    return (
+        compute_distance_matrix(qf, gf).numpy(),
+        compute_distance_matrix(qf, qf).numpy(),
+        compute_distance_matrix(gf, gf).numpy(),
+    )
+
+
+def test_sparse_matches_dense():
+    q_g_dist, q_q_dist, g_g_dist = _distances(20, 100)
+    np.testing.assert_allclose(
+        re_ranking_sparse(q_g_dist, q_q_dist, g_g_dist),
+        re_ranking(q_g_dist, q_q_dist, g_g_dist),
+        atol=1e-5
+    )
+
+
+def test_sparse_fewer_samples_than_neighbors():
+    # query + gallery < k1 + 1
+    q_g_dist, q_q_dist, g_g_dist = _distances(5, 15)
+    for k2 in [6, 30]:
+        np.testing.assert_allclose(
+            re_ranking_sparse(q_g_dist, q_q_dist, g_g_dist, k2=k2),
+            re_ranking(q_g_dist, q_q_dist, g_g_dist, k2=k2),
+            atol=1e-5
+        )
+
+
+def test_torch_matches_dense():
+    # the second size has fewer samples than k1 + 1
+    for num_q, num_g in [(20, 100), (5, 15)]:
+        qf, gf = _features(num_q, num_g)
+        q_g_dist, q_q_dist, g_g_dist = _distances(num_q, num_g)
+        np.testing.assert_allclose(
+            re_ranking_torch(qf, gf).numpy(),
+            re_ranking(q_g_dist, q_q_dist, g_g_dist),
+            atol=1e-4
+        )
+
+
+def _clustered(num_q, num_g, num_pids=100, feat_dim=128):
+    torch.manual_seed(0)
+    centers = torch.randn(num_pids, feat_dim)
+    q_pids = np.random.RandomState(0).randint(0, num_pids, num_q)
+    g_pids = np.random.RandomState(1).randint(0, num_pids, num_g)
+    qf = centers[torch.from_numpy(q_pids)] + 1.5 * torch.randn(num_q, feat_dim)
+    gf = centers[torch.from_numpy(g_pids)] + 1.5 * torch.randn(num_g, feat_dim)
+    return qf, gf, q_pids, g_pids
+
+
+@pytest.mark.parametrize('k2', [6, 1])
+def test_reranker_drift_after_gallery_additions(k2):
+    qf, gf, q_pids, g_pids = _clustered(200, 2000)
+    q_camids = np.zeros(len(q_pids), dtype=np.int64)
+    g_camids = np.ones(len(g_pids), dtype=np.int64)
+    reference = re_ranking(
+        compute_distance_matrix(qf, gf).numpy(),
+        compute_distance_matrix(qf, qf).numpy(),
+        compute_distance_matrix(gf, gf).numpy(),
+        k2=k2
+    )
+
+    reranker = ReRanker(k2=k2, block_size=64)
+    for chunk in gf.split([1200, 500, 300]):
+        reranker.add(chunk)
+    distmat = reranker.rerank(qf)
+
+    # the queries do not enter the neighbor lists of the gallery, so the
+    # distances only approximate re_ranking
+    assert np.abs(distmat - reference).mean() < 0.01
+    mAP = evaluate_rank(distmat, q_pids, g_pids, q_camids, g_camids,
+                        use_cython=False)[1]
+    reference_mAP = evaluate_rank(reference, q_pids, g_pids, q_camids,
+                                  g_camids, use_cython=False)[1]
+    assert abs(mAP - reference_mAP) < 0.01
+
+
+@pytest.mark.parametrize('k2', [6, 1])
+def test_reranker_additions_match_one_addition(k2):
+    qf, gf, _, _ = _clustered(50, 300)
+    reranker = ReRanker(k2=k2, block_size=64)
+    reranker.add(gf)
+    expected = reranker.rerank(qf)
+
+    reranker = ReRanker(k2=k2, block_size=64)
+    for chunk in gf.split([130, 1, 100, 69]):
+        reranker.add(chunk)
+        assert len(reranker) == reranker.features.size(0)
+    np.testing.assert_allclose(reranker.rerank(qf), expected, atol=1e-5)
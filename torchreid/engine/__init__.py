@@ -3,3 +3,4 @@ from __future__ import print_function, absolute_import
 from .image import ImageSoftmaxEngine, ImageTripletEngine
 from .video import VideoSoftmaxEngine, VideoTripletEngine
 from .engine import Engine
+from .eval_options import EvalOptions
@@ -1,34 +1,122 @@
 from __future__ import division, print_function, absolute_import
+import copy
 import time
 import numpy as np
 import os.path as osp
 import datetime
 import torch
 from torch.nn import functional as F
+from torch.utils.data import DataLoader, Subset
 from torch.utils.tensorboard import SummaryWriter
 
 from torchreid import metrics
-from torchreid.utils import (AverageMeter, re_ranking, save_checkpoint,
-                             visualize_ranked_results, tsne)
+from torchreid.models import CPUInferenceModel
+from torchreid.utils import (AverageMeter, re_ranking, re_ranking_sparse,
+                             re_ranking_torch, save_checkpoint,
+                             visualize_ranked_results, tsne, FeatureCache,
+                             state_dict_hash)
 from torchreid.losses import DeepSupervision
+from .eval_options import EvalOptions
+
+
+# positional evaluation arguments of run and test, kept from before
+# EvalOptions
+_RUN_EVAL_ARGS = ('dist_metric', 'normalize_feature', 'visrank',
+                  'visrank_topk', 'use_metric_cuhk03', 'ranks', 'rerank')
+_TEST_EVAL_ARGS = ('dist_metric', 'normalize_feature', 'visrank',
+                   'visrank_topk', 'save_dir', 'use_metric_cuhk03', 'ranks',
+                   'rerank')
+
+
+def _to_float(outputs):
+    if isinstance(outputs, (tuple, list)):
+        return type(outputs)(_to_float(output) for output in outputs)
+    return outputs.float()
+
+
+def _positional_kwargs(method, names, args, kwargs):
+    """Adds positional arguments to kwargs under the names of their
+    positions."""
+    if any(isinstance(arg, EvalOptions) for arg in args):
+        raise TypeError(
+            '{}() takes eval_options as a keyword argument'.format(method))
+    if len(args) > len(names):
+        raise TypeError(
+            '{}() takes at most {} positional evaluation arguments ({} '
+            'given)'.format(method, len(names), len(args)))
+    kwargs = dict(kwargs)
+    for name, arg in zip(names, args):
+        if name in kwargs:
+            raise TypeError(
+                "{}() got multiple values for argument '{}'".format(method,
+                                                                    name))
+        kwargs[name] = arg
+    return kwargs
+
+
+def _eval_options(eval_options, kwargs):
+    if eval_options is None:
+        return EvalOptions(**kwargs)
+    if kwargs:
+        raise TypeError('Give either eval_options or evaluation keyword '
+                        'arguments, not both')
+    return eval_options
 
 
 class Engine(object):
+    r"""Base engine.
+
+    Args:
+        datamanager (DataManager): an instance of ``torchreid.data.ImageDataManager``
+            or ``torchreid.data.VideoDataManager``.
+        model (nn.Module): model instance.
+        optimizer (Optimizer, optional): an Optimizer.
+        scheduler (LRScheduler, optional): if None, no learning rate decay will be performed.
+        use_gpu (bool, optional): use gpu. Default is True.
+        amp (bool or str, optional): train with automatic mixed precision.
+            ``'fp16'`` or ``'bf16'`` choose the precision, True uses float16
+            on gpu and bfloat16 on cpu. float16 on gpu uses a gradient
+            scaler. Losses are computed in float32. Default is False.
+        channels_last (bool, optional): train with the channels_last memory
+            format for the model and the images. Default is False.
+    """
+
     def __init__(self,
                  datamanager,
                  model,
                  optimizer=None,
                  scheduler=None,
-                 use_gpu=True):
+                 use_gpu=True,
+                 amp=False,
+                 channels_last=False):
         self.datamanager = datamanager
         self.model = model
         self.optimizer = optimizer
         self.scheduler = scheduler
         self.use_gpu = (torch.cuda.is_available() and use_gpu)
+        if amp not in (False, True, 'fp16', 'bf16'):
+            raise ValueError(
+                'amp must be a bool, "fp16" or "bf16", but got {}'.format(amp))
+        self.amp = bool(amp)
+        if amp == 'bf16' or (amp is True and not self.use_gpu):
+            self.amp_dtype = torch.bfloat16
+        else:
+            self.amp_dtype = torch.float16
+        # bfloat16 has the range of float32, only float16 needs loss scaling
+        self.scaler = None
+        if self.amp and self.amp_dtype == torch.float16 and self.use_gpu:
+            self.scaler = torch.amp.GradScaler('cuda')
+        self.channels_last = channels_last
+        if channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
         self.writer = None
         self.train_loader = self.datamanager.train_loader
         self.test_loader = self.datamanager.test_loader
         self.best_rank = 0
+        # dataset name -> (key, index) of approximate search, see _ann_index
+        self._ann_indexes = {}
+        # (key, quantizer) of dist_metric="pq", see _train_quantizer
+        self._quantizer = None
 
     def run(self,
             save_dir='log',
@@ -40,27 +128,26 @@ class Engine(object):
             start_eval=0,
             eval_freq=-1,
             test_only=False,
-            dist_metric='euclidean',
-            normalize_feature=False,
-            visrank=False,
-            visrank_topk=10,
-            use_metric_cuhk03=False,
-            ranks=[1, 5, 10, 20],
-            rerank=False):
-        if visrank and not test_only:
+            *args,
+            eval_options=None,
+            **kwargs):
+        """Trains and evaluates the model.
+
+        Evaluation options are given either as an ``EvalOptions`` through the
+        keyword argument ``eval_options``, or as arguments, e.g.
+        ``dist_metric='cosine'``. Positional arguments after ``test_only``
+        are, in order, dist_metric, normalize_feature, visrank, visrank_topk,
+        use_metric_cuhk03, ranks and rerank.
+        """
+        eval_options = _eval_options(
+            eval_options, _positional_kwargs('run', _RUN_EVAL_ARGS, args,
+                                             kwargs))
+        if eval_options.visrank and not test_only:
             raise ValueError(
                 'visrank can be set to True only if test_only=True')
 
         if test_only:
-            self.test(0,
-                      dist_metric=dist_metric,
-                      normalize_feature=normalize_feature,
-                      visrank=visrank,
-                      visrank_topk=visrank_topk,
-                      save_dir=save_dir,
-                      use_metric_cuhk03=use_metric_cuhk03,
-                      ranks=ranks,
-                      rerank=rerank)
+            self.test(0, eval_options=eval_options, save_dir=save_dir)
             return
 
         if self.writer is None:
@@ -81,26 +168,14 @@ class Engine(object):
                and eval_freq > 0 \
                and (epoch+1) % eval_freq == 0 \
                and (epoch + 1) != max_epoch:
-                rank1 = self.test(epoch,
-                                  dist_metric=dist_metric,
-                                  normalize_feature=normalize_feature,
-                                  visrank=visrank,
-                                  visrank_topk=visrank_topk,
-                                  save_dir=save_dir,
-                                  use_metric_cuhk03=use_metric_cuhk03,
-                                  ranks=ranks)
+                rank1 = self.test(epoch, eval_options=eval_options,
+                                  save_dir=save_dir)
                 self._save_checkpoint(epoch, rank1, save_dir)
 
         if max_epoch > 0:
             print('=> Final test')
-            rank1 = self.test(epoch,
-                              dist_metric=dist_metric,
-                              normalize_feature=normalize_feature,
-                              visrank=visrank,
-                              visrank_topk=visrank_topk,
-                              save_dir=save_dir,
-                              use_metric_cuhk03=use_metric_cuhk03,
-                              ranks=ranks)
+            rank1 = self.test(epoch, eval_options=eval_options,
+                                  save_dir=save_dir)
             self._save_checkpoint(epoch, rank1, save_dir)
 
         elapsed = round(time.time() - time_start)
@@ -112,102 +187,503 @@ class Engine(object):
     def train(self):
         raise NotImplementedError
 
-    def test(self,
-             epoch,
-             dist_metric='euclidean',
-             normalize_feature=False,
-             visrank=False,
-             visrank_topk=10,
-             save_dir='',
-             use_metric_cuhk03=False,
-             ranks=[1, 5, 10, 20],
-             rerank=False):
+    def test(self, epoch, *args, eval_options=None, **kwargs):
+        """Evaluates the model on every target dataset.
+
+        Args:
+            epoch (int): current epoch.
+            *args: dist_metric, normalize_feature, visrank, visrank_topk,
+                save_dir, use_metric_cuhk03, ranks and rerank, in the order
+                of the arguments of ``test`` before ``EvalOptions``.
+            eval_options (EvalOptions, optional): evaluation options, keyword
+                only. Default is None, which builds them from the arguments.
+            save_dir (str, optional): directory of the visualized ranks.
+            **kwargs: evaluation options, see ``EvalOptions``.
+
+        Returns:
+            float: rank-1 of the last target dataset, CMC@k rank-1 with
+            approximate search, which does not update ``best_rank``.
+        """
+        kwargs = _positional_kwargs('test', _TEST_EVAL_ARGS, args, kwargs)
+        save_dir = kwargs.pop('save_dir', '')
+        eval_options = _eval_options(eval_options, kwargs)
         targets = list(self.test_loader.keys())
 
-        for name in targets:
-            domain = 'source' if name in self.datamanager.sources else 'target'
-            print('##### Evaluating {} ({}) #####'.format(name, domain))
-            query_loader = self.test_loader[name]['query']
-            gallery_loader = self.test_loader[name]['gallery']
-            rank1 = self._evaluate(epoch,
-                                   dataset_name=name,
-                                   query_loader=query_loader,
-                                   gallery_loader=gallery_loader,
-                                   dist_metric=dist_metric,
-                                   normalize_feature=normalize_feature,
-                                   visrank=visrank,
-                                   visrank_topk=visrank_topk,
-                                   save_dir=save_dir,
-                                   use_metric_cuhk03=use_metric_cuhk03,
-                                   ranks=ranks,
-                                   rerank=rerank)
-
+        model = self._unwrapped_model()
+        if eval_options.heads:
+            # descriptor of the given heads instead of the training ones
+            train_heads = (model.heads, model.head_weights)
+            model.set_heads(eval_options.heads, eval_options.head_weights)
+
+        # the weights stay the same while evaluating, they are hashed once
+        model_hash = None
+        if (eval_options.feature_cache_dir or eval_options.ann_lists > 0
+                or eval_options.dist_metric == 'pq'):
+            model_hash = state_dict_hash(self.model)
+
+        try:
+            for name in targets:
+                domain = 'source' if name in self.datamanager.sources \
+                    else 'target'
+                print('##### Evaluating {} ({}) #####'.format(name, domain))
+                query_loader = self.test_loader[name]['query']
+                gallery_loader = self.test_loader[name]['gallery']
+                rank1 = self._evaluate(epoch,
+                                       eval_options,
+                                       dataset_name=name,
+                                       query_loader=query_loader,
+                                       gallery_loader=gallery_loader,
+                                       save_dir=save_dir,
+                                       model_hash=model_hash)
+        finally:
+            if eval_options.heads:
+                model.set_heads(*train_heads)
         return rank1
 
     @torch.no_grad()
     def _evaluate(self,
                   epoch,
+                  options,
                   dataset_name='',
                   query_loader=None,
                   gallery_loader=None,
-                  dist_metric='euclidean',
-                  normalize_feature=False,
-                  visrank=False,
-                  visrank_topk=10,
                   save_dir='',
-                  use_metric_cuhk03=False,
-                  ranks=[1, 5, 10, 20],
-                  rerank=False):
+                  model_hash=None):
         batch_time = AverageMeter()
 
-        def _feature_extraction(data_loader):
-            f_, pids_, camids_, imgs_paths = [], [], [], []
-            for batch_idx, data in enumerate(data_loader):
-                imgs, pids, camids, imgs_path = self._parse_data_for_eval(data)
-                if self.use_gpu:
-                    imgs = imgs.cuda()
-                end = time.time()
-                features = self._extract_features(imgs)
-                batch_time.update(time.time() - end)
-                features = features.data.cpu()
-                f_.append(features)
-                pids_.extend(pids)
-                camids_.extend(camids)
-                imgs_paths.append(imgs_path)
-            f_ = torch.cat(f_, 0)
-            pids_ = np.asarray(pids_)
-            camids_ = np.asarray(camids_)
-            return f_, pids_, camids_, imgs_paths
+        cpu_model = None
+        if options.cpu_inference and not self.use_gpu:
+            cpu_model = CPUInferenceModel(self.model,
+                                          num_threads=options.cpu_threads,
+                                          num_workers=options.cpu_workers)
+
+        try:
+            if options.cascade_stage:
+                cmc, mAP, mINP, distmat, ranked_indices = \
+                    self._evaluate_cascade(options, query_loader,
+                                           gallery_loader, batch_time,
+                                           cpu_model)
+            else:
+                qf, gf, q_pids, g_pids, q_camids, g_camids, quantizer = \
+                    self._eval_features(options, dataset_name, query_loader,
+                                        gallery_loader, batch_time, cpu_model,
+                                        model_hash)
+                rank = self._rank_function(options)
+                cmc, mAP, mINP, distmat, ranked_indices = rank(
+                    qf,
+                    gf,
+                    q_pids,
+                    g_pids,
+                    q_camids,
+                    g_camids,
+                    options,
+                    dataset_name=dataset_name,
+                    quantizer=quantizer,
+                    model_hash=model_hash)
+        finally:
+            # the cascade extracts candidate features while ranking
+            if cpu_model is not None:
+                cpu_model.close()
+
+        # approximate search only ranks the top-k neighbors, its metrics are
+        # not comparable to those of exact search
+        suffix = '@{}'.format(options.ann_topk) if options.ann_lists > 0 \
+            else ''
+        if not suffix and cmc[0] > self.best_rank:
+            self.best_rank = cmc[0]
+            best_step = epoch + 1
+
+        print('** Results **')
+        print('mAP{}: {:.1%}'.format(suffix, mAP))
+        print('CMC{} curve'.format(suffix))
+        for r in options.ranks:
+            print('Rank-{:<3}: {:.1%}'.format(r, cmc[r - 1]))
+        print('mINP{}: {:.1%}'.format(suffix, mINP))
+
+        if options.visrank:
+            visualize_ranked_results(
+                distmat,
+                self.datamanager.return_query_and_gallery_by_name(
+                    dataset_name),
+                self.datamanager.data_type,
+                width=self.datamanager.width,
+                height=self.datamanager.height,
+                save_dir=osp.join(save_dir, 'visrank_' + dataset_name),
+                topk=options.visrank_topk,
+                indices=ranked_indices)
+
+        return cmc[0]
+
+    def _feature_extraction(self,
+                            data_loader,
+                            batch_time,
+                            model=None,
+                            precision='fp32',
+                            stage=None,
+                            with_descriptor=False):
+        """Returns the features, pids, camids and image paths of a loader.
+
+        Args:
+            data_loader (DataLoader): test loader.
+            batch_time (AverageMeter): meter of the time per batch.
+            model (nn.Module, optional): model to run instead of ``self.model``.
+            precision (str, optional): storage precision of the features, see
+                ``metrics.encode_features``. Default is "fp32".
+            stage (str, optional): returns the embeddings of this stage of
+                ``stage_embeddings`` instead of the features.
+            with_descriptor (bool, optional): concatenates the features to the
+                stage embeddings. Default is False.
+        """
+        # samplers may yield more samples than the dataset holds, e.g.
+        # RandomIdentitySampler pads the identities, so the buffers are
+        # sized from the batches
+        try:
+            num = len(data_loader) * data_loader.batch_size
+        except TypeError:
+            # unknown number or size of the batches
+            num = None
+        f_ = None
+        if num is None:
+            f_list, pids_, camids_, imgs_paths = [], [], [], []
+        else:
+            pids_ = np.empty(num, dtype=np.int64)
+            camids_ = np.empty(num, dtype=np.int64)
+            imgs_paths = [None] * num
+        start = 0
+        for imgs, pids, camids, imgs_path in self._prefetch_for_eval(
+                data_loader):
+            end = time.time()
+            if with_descriptor:
+                features = torch.cat(
+                    self._extract_stage_features(imgs, stage, True), 1)
+            elif stage is not None:
+                features = self._extract_stage_features(imgs, stage)
+            else:
+                features = self._extract_features(imgs, model=model)
+            batch_time.update(time.time() - end)
+            features = metrics.encode_features(features.data, precision)
+            if num is None:
+                f_list.append(features.cpu())
+                pids_.extend(np.asarray(pids))
+                camids_.extend(np.asarray(camids))
+                imgs_paths.extend(imgs_path)
+                continue
+            if f_ is None:
+                # pinned memory lets device-to-host copies run
+                # asynchronously while the next batch is processed
+                f_ = torch.empty((num, features.size(1)),
+                                 dtype=features.dtype,
+                                 pin_memory=self.use_gpu)
+            stop = start + features.size(0)
+            f_[start:stop].copy_(features, non_blocking=True)
+            pids_[start:stop] = np.asarray(pids)
+            camids_[start:stop] = np.asarray(camids)
+            imgs_paths[start:stop] = imgs_path
+            start = stop
+        if num is None:
+            return torch.cat(f_list, 0), np.asarray(pids_), \
+                np.asarray(camids_), imgs_paths
+        if self.use_gpu:
+            torch.cuda.synchronize()
+        if start < num:
+            # slices would keep the whole over-allocated buffers alive
+            return f_[:start].clone(), pids_[:start].copy(), \
+                camids_[:start].copy(), imgs_paths[:start]
+        return f_, pids_, camids_, imgs_paths
+
+    def _cached_feature_extraction(self,
+                                   data_loader,
+                                   batch_time,
+                                   feature_cache,
+                                   model_hash,
+                                   name,
+                                   split,
+                                   precision='fp32',
+                                   model=None):
+        """Returns the output of ``_feature_extraction``, read from and
+        written to ``feature_cache`` unless it is None."""
+        if feature_cache is None:
+            return self._feature_extraction(data_loader, batch_time, model,
+                                            precision)
+        extractor = self.__class__.__name__
+        if hasattr(self._unwrapped_model(), 'heads'):
+            unwrapped = self._unwrapped_model()
+            extractor += repr((unwrapped.heads, unwrapped.head_weights))
+        key = feature_cache.make_key(
+            model_hash, name, split,
+            (self.datamanager.height, self.datamanager.width),
+            getattr(data_loader.dataset, 'transform', None), extractor,
+            precision)
+        cached = feature_cache.load(key)
+        if cached is not None:
+            print('Loaded cached features "{}"'.format(key))
+            return cached
+        outputs = self._feature_extraction(data_loader, batch_time, model,
+                                           precision)
+        feature_cache.save(key, *outputs)
+        return outputs
+
+    def _eval_features(self, options, dataset_name, query_loader,
+                       gallery_loader, batch_time, model=None,
+                       model_hash=None):
+        """Returns the query and gallery features, pids and camids ready for
+        ranking, and the product quantizer of the gallery if
+        ``dist_metric`` is "pq", else None."""
+        feature_cache = None
+        if options.feature_cache_dir:
+            feature_cache = FeatureCache(options.feature_cache_dir)
+        if model_hash is None and (options.feature_cache_dir
+                                   or options.dist_metric == 'pq'):
+            model_hash = state_dict_hash(self.model)
+
+        # the precision report compares all precisions to float32 features
+        storage_precision = 'fp32' if options.precision_report \
+            else options.feature_precision
 
         print('Extracting features from query set ...')
-        qf, q_pids, q_camids, q_img_paths = _feature_extraction(query_loader)
-        print('Done, obtained {}-by-{} matrix'.format(qf.size(0), qf.size(1)))
+        qf, q_pids, q_camids, _ = self._cached_feature_extraction(
+            query_loader, batch_time, feature_cache, model_hash, dataset_name,
+            'query', storage_precision, model)
+        print('Done, obtained {}-by-{} matrix'.format(qf.size(0),
+                                                      metrics.feature_dim(qf)))
 
         print('Extracting features from gallery set ...')
-        gf, g_pids, g_camids, g_img_paths = _feature_extraction(gallery_loader)
-        print('Done, obtained {}-by-{} matrix'.format(gf.size(0), gf.size(1)))
+        gf, g_pids, g_camids, _ = self._cached_feature_extraction(
+            gallery_loader, batch_time, feature_cache, model_hash,
+            dataset_name, 'gallery', storage_precision, model)
+        print('Done, obtained {}-by-{} matrix'.format(gf.size(0),
+                                                      metrics.feature_dim(gf)))
         # time1 = time.time()
         # tsne(gf, g_pids)
         # print(f'time passed {time.time() - time1} ...')
 
         print('Speed: {:.4f} sec/batch'.format(batch_time.avg))
 
-        if normalize_feature:
+        if options.normalize_feature:
             print('Normalzing features with L2 norm ...')
-            qf = F.normalize(qf, p=2, dim=1)
-            gf = F.normalize(gf, p=2, dim=1)
+            qf = metrics.encode_features(
+                F.normalize(metrics.decode_features(qf), p=2, dim=1),
+                storage_precision)
+            gf = metrics.encode_features(
+                F.normalize(metrics.decode_features(gf), p=2, dim=1),
+                storage_precision)
+
+        if options.precision_report:
+            print('Comparing feature precisions ...')
+            metrics.print_precision_report(
+                metrics.precision_report(
+                    qf,
+                    gf,
+                    q_pids,
+                    g_pids,
+                    q_camids,
+                    g_camids,
+                    # product quantization approximates euclidean distances
+                    metric='euclidean' if options.dist_metric == 'pq' else
+                    options.dist_metric,
+                    use_metric_cuhk03=options.use_metric_cuhk03))
+            qf = metrics.encode_features(qf, options.feature_precision)
+            gf = metrics.encode_features(gf, options.feature_precision)
+
+        if options.feature_precision != 'fp32':
+            print('Stored features in {}: {:.1f} MB instead of {:.1f} MB'.format(
+                options.feature_precision,
+                (qf.numel() * qf.element_size() +
+                 gf.numel() * gf.element_size()) / 1024**2,
+                (qf.size(0) + gf.size(0)) * metrics.feature_dim(qf) * 4 /
+                1024**2))
+            if (options.rerank or options.ann_lists > 0
+                    or options.dist_metric == 'pq'):
+                # these work on float32 features, the precision only reduces
+                # the storage and the cache
+                qf = metrics.decode_features(qf)
+                gf = metrics.decode_features(gf)
+
+        quantizer = None
+        if options.dist_metric == 'pq':
+            quantizer = self._train_quantizer(options, query_loader.batch_size,
+                                              batch_time, feature_cache,
+                                              model_hash, model)
+            gallery_bytes = gf.numel() * gf.element_size()
+            gf = quantizer.encode(gf)
+            print('Encoded gallery into {} bytes per sample ({:.0f}x '
+                  'smaller)'.format(gf.size(1), gallery_bytes / gf.numel()))
+
+        return qf, gf, q_pids, g_pids, q_camids, g_camids, quantizer
+
+    def _train_quantizer(self, options, batch_size, batch_time, feature_cache,
+                         model_hash, model=None):
+        """Returns a product quantizer trained on the training set.
+
+        The quantizer is trained once and reused as long as the model
+        weights, heads and quantization options stay the same.
+        """
+        extractor = ''
+        if hasattr(self._unwrapped_model(), 'heads'):
+            unwrapped = self._unwrapped_model()
+            extractor = repr((unwrapped.heads, unwrapped.head_weights))
+        key = (model_hash, extractor, options.normalize_feature,
+               options.pq_subspaces, options.pq_opq)
+        if self._quantizer is not None and self._quantizer[0] == key:
+            print('Reusing the product quantizer of these weights')
+            return self._quantizer[1]
+
+        # the codebooks are trained on each training image once, with the
+        # test transform, rather than on augmented identity batches
+        train_set = copy.copy(self.train_loader.dataset)
+        train_set.transform = self.datamanager.transform_te
+        train_loader = DataLoader(train_set,
+                                  batch_size=batch_size,
+                                  shuffle=False,
+                                  num_workers=self.train_loader.num_workers,
+                                  pin_memory=self.train_loader.pin_memory)
+        print('Extracting features from training set ...')
+        tf = self._cached_feature_extraction(
+            train_loader, batch_time, feature_cache, model_hash,
+            '+'.join(self.datamanager.sources), 'train', model=model)[0]
+        if options.normalize_feature:
+            tf = F.normalize(tf, p=2, dim=1)
+        print('Training product quantizer on {} samples ...'.format(
+            tf.size(0)))
+        quantizer = metrics.ProductQuantizer(options.pq_subspaces,
+                                             opq=options.pq_opq)
+        quantizer.train(tf)
+        self._quantizer = (key, quantizer)
+        return quantizer
+
+    def _rank_function(self, options):
+        """Returns the method that ranks the gallery for ``options``.
+
+        Each takes the query and gallery features, pids and camids and the
+        options, and returns ``(cmc, mAP, mINP, distmat, ranked_indices)``,
+        where ``distmat`` or ``ranked_indices`` feed ``visrank``.
+        """
+        if options.ann_lists > 0:
+            return self._rank_ann
+        if not options.rerank and (options.dist_block_memory > 0
+                                   or options.rank_backend == 'torch'):
+            return self._rank_blockwise
+        if options.rerank and options.rerank_method == 'torch':
+            return self._rank_rerank_torch
+        return self._rank_dense
+
+    def _rank_ann(self, qf, gf, q_pids, g_pids, q_camids, g_camids, options,
+                  dataset_name='', quantizer=None, model_hash=None):
+        """Ranks the top-k neighbors returned by an IVF index."""
+        if options.rank_backend == 'torch' and self.use_gpu:
+            qf, gf = qf.cuda(), gf.cuda()
+        index = self._ann_index(dataset_name, gf, options, model_hash)
+        print('Searching top-{} neighbors with metric={} in an IVF '
+              'index of {} lists ...'.format(options.ann_topk,
+                                             options.dist_metric,
+                                             index.num_lists))
+        indices = index.search(qf,
+                               options.ann_topk,
+                               num_probes=options.ann_probes)[1]
+        indices = indices.cpu().numpy()
+
+        print('Computing CMC@{0} and mAP@{0} ...'.format(options.ann_topk))
+        cmc, mAP, mINP = metrics.evaluate_rank_topk(indices, q_pids, g_pids,
+                                                    q_camids, g_camids)
+        return cmc, mAP, mINP, None, indices if options.visrank else None
+
+    def _rank_blockwise(self, qf, gf, q_pids, g_pids, q_camids, g_camids,
+                        options, dataset_name='', quantizer=None,
+                        model_hash=None):
+        """Ranks the gallery one block of the distance matrix at a time,
+        with the numpy or the torch evaluation."""
+        if options.rank_backend == 'torch' and self.use_gpu:
+            qf, gf = qf.cuda(), gf.cuda()
+        if options.dist_block_memory > 0:
+            print('Computing distance matrix with metric={} in blocks of '
+                  'at most {} MB ...'.format(options.dist_metric,
+                                             options.dist_block_memory))
+            dist_blocks = metrics.compute_distance_matrix_blockwise(
+                qf, gf, options.dist_metric, options.dist_block_memory,
+                quantizer)
+        else:
+            print('Computing distance matrix with metric={} ...'.format(
+                options.dist_metric))
+            dist_blocks = [(0, qf.size(0),
+                            metrics.compute_distance_matrix(
+                                qf, gf, options.dist_metric, quantizer))]
+        ranked_indices = []
+
+        def _dist_blocks():
+            for start, end, block in dist_blocks:
+                if options.visrank:
+                    ranked_indices.append(
+                        metrics.rank_topk(block.cpu().numpy(),
+                                          q_pids[start:end], g_pids,
+                                          q_camids[start:end], g_camids,
+                                          options.visrank_topk))
+                if options.rank_backend != 'torch':
+                    block = block.numpy()
+                yield start, end, block
 
-        print(
-            'Computing distance matrix with metric={} ...'.format(dist_metric))
-        distmat = metrics.compute_distance_matrix(qf, gf, dist_metric)
+        print('Computing CMC and mAP ...')
+        if options.rank_backend == 'torch':
+            cmc, mAP, mINP = metrics.evaluate_rank_torch(
+                _dist_blocks(),
+                q_pids,
+                g_pids,
+                q_camids,
+                g_camids,
+                use_metric_cuhk03=options.use_metric_cuhk03)
+        else:
+            cmc, mAP, mINP = metrics.evaluate_rank_blockwise(
+                _dist_blocks(),
+                q_pids,
+                g_pids,
+                q_camids,
+                g_camids,
+                use_metric_cuhk03=options.use_metric_cuhk03,
+                partial_rank=options.partial_rank,
+                num_threads=options.eval_threads)
+        if options.visrank:
+            ranked_indices = np.concatenate(ranked_indices, axis=0)
+        else:
+            ranked_indices = None
+        return cmc, mAP, mINP, None, ranked_indices
+
+    def _rank_rerank_torch(self, qf, gf, q_pids, g_pids, q_camids, g_camids,
+                           options, dataset_name='', quantizer=None,
+                           model_hash=None):
+        """Ranks the gallery by the distances of ``re_ranking_torch``."""
+        print('Applying person re-ranking with metric={} ...'.format(
+            options.dist_metric))
+        if self.use_gpu:
+            qf, gf = qf.cuda(), gf.cuda()
+        distmat = re_ranking_torch(qf, gf, metric=options.dist_metric)
+        distmat = distmat.cpu().numpy()
+        return self._evaluate_distmat(distmat, q_pids, g_pids, q_camids,
+                                      g_camids, options)
+
+    def _rank_dense(self, qf, gf, q_pids, g_pids, q_camids, g_camids, options,
+                    dataset_name='', quantizer=None, model_hash=None):
+        """Ranks the gallery by the full distance matrix, re-ranked with
+        ``re_ranking`` or ``re_ranking_sparse`` if ``rerank`` is set."""
+        print('Computing distance matrix with metric={} ...'.format(
+            options.dist_metric))
+        distmat = metrics.compute_distance_matrix(qf, gf, options.dist_metric,
+                                                  quantizer)
         distmat = distmat.numpy()
 
-        if rerank:
+        if options.rerank:
             print('Applying person re-ranking ...')
-            distmat_qq = metrics.compute_distance_matrix(qf, qf, dist_metric)
-            distmat_gg = metrics.compute_distance_matrix(gf, gf, dist_metric)
-            distmat = re_ranking(distmat, distmat_qq, distmat_gg)
-
+            distmat_qq = metrics.compute_distance_matrix(
+                qf, qf, options.dist_metric).numpy()
+            distmat_gg = metrics.compute_distance_matrix(
+                gf, gf, options.dist_metric).numpy()
+            if options.rerank_method == 'sparse':
+                distmat = re_ranking_sparse(distmat, distmat_qq, distmat_gg)
+            else:
+                distmat = re_ranking(distmat, distmat_qq, distmat_gg)
+        return self._evaluate_distmat(distmat, q_pids, g_pids, q_camids,
+                                      g_camids, options)
+
+    def _evaluate_distmat(self, distmat, q_pids, g_pids, q_camids, g_camids,
+                          options):
         print('Computing CMC and mAP ...')
         cmc, mAP, mINP = metrics.evaluate_rank(
             distmat,
@@ -215,31 +691,124 @@ class Engine(object):
             g_pids,
             q_camids,
             g_camids,
-            use_metric_cuhk03=use_metric_cuhk03)
+            use_metric_cuhk03=options.use_metric_cuhk03,
+            partial_rank=options.partial_rank,
+            num_threads=options.eval_threads)
+        return cmc, mAP, mINP, distmat, None
+
+    def _evaluate_cascade(self, options, query_loader, gallery_loader,
+                          batch_time, model=None):
+        """Ranks the gallery with the cheap stage embeddings, then computes
+        the full descriptors of the top candidates only.
+
+        Prints the accuracy and estimated extraction time for growing numbers
+        of re-ranked candidates, and returns the results of all of them as
+        the other rank methods.
+        """
+        # a single pass gives each query its stage embeddings, which select
+        # the candidates, followed by its features, which rank them
+        print('Extracting stage-{} embeddings and features from query '
+              'set ...'.format(options.cascade_stage))
+        qf, q_pids, q_camids, _ = self._feature_extraction(
+            query_loader, batch_time, stage=options.cascade_stage,
+            with_descriptor=True)
+        print('Done, obtained {}-by-{} matrix'.format(qf.size(0), qf.size(1)))
 
-        if cmc[0] > self.best_rank:
-            self.best_rank = cmc[0]
-            best_step = epoch + 1
+        print('Extracting stage-{} embeddings from gallery set ...'.format(
+            options.cascade_stage))
+        start_time = time.time()
+        gf, g_pids, g_camids, _ = self._feature_extraction(
+            gallery_loader, batch_time, stage=options.cascade_stage)
+        cheap_time = time.time() - start_time
+        print('Done, obtained {}-by-{} matrix'.format(gf.size(0), gf.size(1)))
 
-        print('** Results **')
-        print('mAP: {:.1%}'.format(mAP))
-        print('CMC curve')
-        for r in ranks:
-            print('Rank-{:<3}: {:.1%}'.format(r, cmc[r - 1]))
-        print('mINP: {:.1%}'.format(mINP))
+        print('Speed: {:.4f} sec/batch'.format(batch_time.avg))
 
-        if visrank:
-            visualize_ranked_results(
-                distmat,
-                self.datamanager.return_query_and_gallery_by_name(
-                    dataset_name),
-                self.datamanager.data_type,
-                width=self.datamanager.width,
-                height=self.datamanager.height,
-                save_dir=osp.join(save_dir, 'visrank_' + dataset_name),
-                topk=visrank_topk)
+        q_cheap, qf = qf[:, :gf.size(1)], qf[:, gf.size(1):]
+        if options.normalize_feature:
+            q_cheap = F.normalize(q_cheap, p=2, dim=1)
+            gf = F.normalize(gf, p=2, dim=1)
+        cheap_dist = metrics.compute_distance_matrix(q_cheap, gf,
+                                                     options.dist_metric)
+        topk = min(options.cascade_topk, gf.size(0))
+        candidates = torch.topk(cheap_dist, topk, dim=1, largest=False)[1]
+        candidate_ids = torch.unique(candidates)
+        print('Extracting features of {} candidates ({:.1%} of the '
+              'gallery) ...'.format(candidate_ids.numel(),
+                                    candidate_ids.numel() / gf.size(0)))
+        candidate_loader = DataLoader(
+            Subset(gallery_loader.dataset, candidate_ids.tolist()),
+            batch_size=gallery_loader.batch_size,
+            num_workers=gallery_loader.num_workers,
+            pin_memory=gallery_loader.pin_memory)
+        start_time = time.time()
+        cf = self._feature_extraction(candidate_loader, batch_time, model)[0]
+        full_time = time.time() - start_time
+        if options.normalize_feature:
+            qf = F.normalize(qf, p=2, dim=1)
+            cf = F.normalize(cf, p=2, dim=1)
+        full_dist = metrics.compute_distance_matrix(qf, cf, options.dist_metric)
+
+        def _cascade_distmat(k):
+            # the top-k candidates of each query are ranked by their full
+            # distances, the other samples follow by their cheap distances
+            distmat = cheap_dist - cheap_dist.min() + full_dist.max() + 1
+            cols = candidates[:, :k]
+            rows = torch.arange(cols.size(0)).unsqueeze(1).expand_as(cols)
+            distmat[rows, cols] = full_dist[
+                rows, torch.searchsorted(candidate_ids, cols)]
+            return distmat.numpy()
 
-        return cmc[0]
+        print('Computing CMC and mAP ...')
+        print('{:>6} {:>10} {:>10} {:>8} {:>8}'.format(
+            'top-k', 'recomputed', 'est. time', 'Rank-1', 'mAP'))
+        for k in sorted(set([0, topk // 8, topk // 4, topk // 2, topk])):
+            distmat = _cascade_distmat(k)
+            cmc, mAP, mINP = metrics.evaluate_rank(
+                distmat,
+                q_pids,
+                g_pids,
+                q_camids,
+                g_camids,
+                use_metric_cuhk03=options.use_metric_cuhk03,
+                partial_rank=options.partial_rank,
+                num_threads=options.eval_threads)
+            num_recomputed = torch.unique(candidates[:, :k]).numel()
+            print('{:>6} {:>10} {:>9.1f}s {:>8.1%} {:>8.1%}'.format(
+                k, num_recomputed,
+                cheap_time + full_time * num_recomputed / candidate_ids.numel(),
+                cmc[0], mAP))
+        print('Full descriptors of the whole gallery would take about '
+              '{:.1f}s'.format(full_time * gf.size(0) / candidate_ids.numel()))
+        return cmc, mAP, mINP, distmat, None
+
+    def _ann_index(self, dataset_name, gf, options, model_hash=None):
+        """Returns the IVF index of the gallery features of a dataset.
+
+        The index is trained once and reused as long as the model weights,
+        heads and evaluation options that change the gallery features stay
+        the same.
+        """
+        extractor = ''
+        if hasattr(self._unwrapped_model(), 'heads'):
+            model = self._unwrapped_model()
+            extractor = repr((model.heads, model.head_weights))
+        if model_hash is None:
+            model_hash = state_dict_hash(self.model)
+        key = (model_hash, extractor, gf.size(0),
+               str(gf.device), options.normalize_feature,
+               options.feature_precision, options.dist_metric,
+               options.ann_lists)
+        cached = self._ann_indexes.get(dataset_name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        print('Building an IVF index of {} lists on the gallery ...'.format(
+            options.ann_lists))
+        index = metrics.IVFIndex(options.ann_lists, metric=options.dist_metric)
+        index.train(gf)
+        index.add(gf)
+        self._ann_indexes[dataset_name] = (key, index)
+        return index
 
     def _compute_loss(self, criterion, outputs, targets):
         if isinstance(outputs, (tuple, list)):
@@ -248,9 +817,68 @@ class Engine(object):
             loss = criterion(outputs, targets)
         return loss
 
-    def _extract_features(self, input):
+    def _extract_features(self, input, model=None):
+        """Returns the features of a batch.
+
+        Args:
+            input (torch.Tensor): batch of images.
+            model (nn.Module, optional): model to run instead of
+                ``self.model``, e.g. a ``CPUInferenceModel``. Default is None.
+        """
+        if model is None:
+            model = self.model
+        model.eval()
+        return model(input)
+
+    def _forward_train(self, imgs):
+        """Runs the training forward pass, under autocast if ``amp`` is set.
+
+        Outputs are returned in float32, so that losses are not computed in
+        reduced precision.
+        """
+        if self.channels_last:
+            imgs = imgs.contiguous(memory_format=torch.channels_last)
+        if not self.amp:
+            return self.model(imgs)
+        with torch.autocast('cuda' if self.use_gpu else 'cpu',
+                            dtype=self.amp_dtype):
+            outputs = self.model(imgs)
+        return _to_float(outputs)
+
+    def _backward_step(self, loss):
+        """Backpropagates ``loss`` and updates the parameters.
+
+        With float16 the loss is scaled, and the step is skipped if the
+        gradients overflowed.
+        """
+        self._scale_loss(loss).backward()
+        self._optimizer_step()
+
+    def _scale_loss(self, loss):
+        if self.scaler is None:
+            return loss
+        return self.scaler.scale(loss)
+
+    def _optimizer_step(self):
+        if self.scaler is None:
+            self.optimizer.step()
+            return
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+
+    def _unwrapped_model(self):
+        if isinstance(self.model, torch.nn.DataParallel):
+            return self.model.module
+        return self.model
+
+    def _extract_stage_features(self, input, stage, with_descriptor=False):
         self.model.eval()
-        return self.model(input)
+        model = self._unwrapped_model()
+        if not hasattr(model, 'stage_embeddings'):
+            raise ValueError(
+                '{} has no stage_embeddings, cascade retrieval is not '
+                'supported'.format(model.__class__.__name__))
+        return model.stage_embeddings(input, stage, with_descriptor)
 
     def _parse_data_for_train(self, data):
         imgs = data[0]
@@ -264,6 +892,33 @@ class Engine(object):
         imgs_path = data[3]
         return imgs, pids, camids, imgs_path
 
+    def _prefetch_for_eval(self, data_loader):
+        """Yields the parsed batches of ``data_loader`` with images on the gpu.
+
+        The next batch is fetched and copied to the gpu on a side stream
+        while the current one is processed.
+        """
+        if not self.use_gpu:
+            for data in data_loader:
+                yield self._parse_data_for_eval(data)
+            return
+
+        stream = torch.cuda.Stream()
+        pending = None
+        for data in data_loader:
+            imgs, pids, camids, imgs_path = self._parse_data_for_eval(data)
+            with torch.cuda.stream(stream):
+                imgs = imgs.cuda(non_blocking=True)
+            if pending is not None:
+                yield pending
+            pending = (imgs, pids, camids, imgs_path)
+            torch.cuda.current_stream().wait_stream(stream)
+            # the caching allocator must not reuse the memory of imgs before
+            # the default stream is done with it
+            imgs.record_stream(torch.cuda.current_stream())
+        if pending is not None:
+            yield pending
+
     def _save_checkpoint(self, epoch, rank1, save_dir, is_best=False):
         save_checkpoint(
             {
@@ -0,0 +1,126 @@
+from __future__ import absolute_import
+from collections import OrderedDict
+
+from torchreid.metrics import PRECISIONS
+
+__all__ = ['EvalOptions']
+
+# name -> default of every evaluation option
+_DEFAULTS = OrderedDict([
+    ('dist_metric', 'euclidean'),
+    ('normalize_feature', False),
+    ('visrank', False),
+    ('visrank_topk', 10),
+    ('use_metric_cuhk03', False),
+    ('ranks', (1, 5, 10, 20)),
+    ('rerank', False),
+    ('rerank_method', 'sparse'),
+    ('dist_block_memory', 0),
+    ('partial_rank', False),
+    ('eval_threads', 1),
+    ('rank_backend', 'numpy'),
+    ('feature_cache_dir', ''),
+    ('ann_lists', 0),
+    ('ann_probes', 8),
+    ('ann_topk', 100),
+    ('pq_subspaces', 32),
+    ('pq_opq', False),
+    ('feature_precision', 'fp32'),
+    ('precision_report', False),
+    ('cpu_inference', False),
+    ('cpu_threads', 0),
+    ('cpu_workers', 0),
+    ('cascade_stage', ''),
+    ('cascade_topk', 100),
+    ('heads', ()),
+    ('head_weights', ()),
+])
+
+_CHOICES = {
+    'dist_metric': ('euclidean', 'cosine', 'pq'),
+    'rerank_method': ('dense', 'sparse', 'torch'),
+    'rank_backend': ('numpy', 'torch'),
+    'feature_precision': PRECISIONS,
+}
+
+
+class EvalOptions(object):
+    """Options of ``Engine.test``, validated together.
+
+    Every option is an attribute. Options that are not given keep their
+    default, see ``default_config.py`` for their meaning. A new option only
+    needs an entry in ``_DEFAULTS`` and, if it excludes others, a check in
+    ``validate``.
+
+    Args:
+        **kwargs: evaluation options, e.g. ``dist_metric='cosine'``.
+
+    Raises:
+        TypeError: for an unknown option.
+        ValueError: for an invalid value or combination of options.
+
+    Examples::
+        >>> options = EvalOptions(dist_metric='cosine', rerank=True)
+        >>> engine.test(0, eval_options=options)
+    """
+
+    def __init__(self, **kwargs):
+        unknown = sorted(set(kwargs) - set(_DEFAULTS))
+        if unknown:
+            raise TypeError(
+                'Unknown evaluation options: {}'.format(', '.join(unknown))
+            )
+        for name, default in _DEFAULTS.items():
+            setattr(self, name, kwargs.get(name, default))
+        self.validate()
+
+    def validate(self):
+        for name, choices in _CHOICES.items():
+            if getattr(self, name) not in choices:
+                raise ValueError(
+                    'Unknown {}: {}. Please choose from {}'.format(
+                        name, getattr(self, name), choices
+                    )
+                )
+        if self.cascade_stage and (
+            self.rerank or self.ann_lists > 0 or self.dist_metric == 'pq'
+            or self.feature_precision != 'fp32' or self.precision_report
+            or self.feature_cache_dir or self.rank_backend != 'numpy'
+            or self.dist_block_memory > 0
+        ):
+            raise ValueError(
+                'Cascade retrieval supports neither re-ranking, approximate '
+                'search, product quantization, reduced precision, the '
+                'feature cache, the torch rank backend nor blockwise '
+                'distances'
+            )
+        if self.dist_metric == 'pq' and (self.rerank or self.ann_lists > 0):
+            raise ValueError(
+                'dist_metric="pq" supports neither re-ranking nor approximate '
+                'nearest neighbor search'
+            )
+        if self.rerank and self.ann_lists > 0:
+            raise ValueError(
+                'Approximate nearest neighbor search does not support '
+                're-ranking'
+            )
+        if self.ann_lists > 0 and self.use_metric_cuhk03:
+            raise ValueError(
+                'Approximate nearest neighbor search does not support the '
+                'cuhk03 metric'
+            )
+        if len(self.head_weights) > 0 and not self.heads:
+            raise ValueError('head_weights requires heads')
+
+    def as_dict(self):
+        return OrderedDict(
+            (name, getattr(self, name)) for name in _DEFAULTS
+        )
+
+    def __repr__(self):
+        return 'EvalOptions({})'.format(
+            ', '.join(
+                '{}={!r}'.format(name, value)
+                for name, value in self.as_dict().items()
+            )
+        )
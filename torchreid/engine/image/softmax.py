@@ -22,6 +22,11 @@ class ImageSoftmaxEngine(Engine):
         scheduler (LRScheduler, optional): if None, no learning rate decay will be performed.
         use_gpu (bool, optional): use gpu. Default is True.
         label_smooth (bool, optional): use label smoothing regularizer. Default is True.
+        amp (bool or str, optional): train with automatic mixed precision,
+            ``'fp16'`` or ``'bf16'``, or True for the default of the device.
+            Default is False.
+        channels_last (bool, optional): train with the channels_last memory
+            format. Default is False.
 
     Examples::
         
@@ -65,10 +70,19 @@ class ImageSoftmaxEngine(Engine):
         optimizer,
         scheduler=None,
         use_gpu=True,
-        label_smooth=True
+        label_smooth=True,
+        amp=False,
+        channels_last=False
     ):
-        super(ImageSoftmaxEngine, self
-              ).__init__(datamanager, model, optimizer, scheduler, use_gpu)
+        super(ImageSoftmaxEngine, self).__init__(
+            datamanager,
+            model,
+            optimizer,
+            scheduler,
+            use_gpu,
+            amp=amp,
+            channels_last=channels_last
+        )
 
         self.criterion = CrossEntropyLoss(
             num_classes=self.datamanager.num_train_pids,
@@ -111,11 +125,10 @@ class ImageSoftmaxEngine(Engine):
                 imgs = imgs.cuda()
                 pids = pids.cuda()
 
-            self.optimizer.zero_grad()
-            outputs = self.model(imgs)
+            self.optimizer.zero_grad(set_to_none=True)
+            outputs = self._forward_train(imgs)
             loss = self._compute_loss(self.criterion, outputs, pids)
-            loss.backward()
-            self.optimizer.step()
+            self._backward_step(loss)
 
             batch_time.update(time.time() - end)
 
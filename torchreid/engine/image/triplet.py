@@ -1,11 +1,13 @@
 from __future__ import division, print_function, absolute_import
 import time
 import datetime
+from collections import defaultdict
 
 from torchreid import metrics
 from torchreid.utils import (AverageMeter, open_all_layers,
                              open_specified_layers)
-from torchreid.losses import TripletLoss, CrossEntropyLoss, CenterLoss, RangeLoss
+from torchreid.losses import (TripletLoss, CrossEntropyLoss,
+                              MultiHeadCenterLoss, RangeLoss, LossContext)
 
 from ..engine import Engine
 import torch
@@ -17,37 +19,58 @@ class ImageTripletEngine(Engine):
                  model,
                  optimizer,
                  margin=0.3,
+                 mining='batch_hard',
                  weight_t=1,
                  weight_x=1,
                  weight_c=0,
+                 weight_r=0,
+                 num_instances=4,
                  scheduler=None,
                  use_gpu=True,
-                 label_smooth=True):
-        super(ImageTripletEngine, self).__init__(datamanager, model, optimizer,
-                                                 scheduler, use_gpu)
+                 label_smooth=True,
+                 amp=False,
+                 channels_last=False,
+                 micro_batch_size=0,
+                 loss_timing=False):
+        super(ImageTripletEngine, self).__init__(datamanager,
+                                                 model,
+                                                 optimizer,
+                                                 scheduler,
+                                                 use_gpu,
+                                                 amp=amp,
+                                                 channels_last=channels_last)
 
         self.weight_t = weight_t
         self.weight_x = weight_x
         self.weight_c = weight_c
+        self.weight_r = weight_r
+        self.micro_batch_size = micro_batch_size
+        self.loss_timing = loss_timing
 
-        self.criterion_t = TripletLoss(margin=margin)
+        self.criterion_t = TripletLoss(margin=margin, mining=mining)
         self.criterion_x = CrossEntropyLoss(
             num_classes=self.datamanager.num_train_pids,
             use_gpu=self.use_gpu,
             label_smooth=label_smooth)
 
         if self.weight_c != 0:
-            self.criterion_c = CenterLoss(
-                num_classes=self.datamanager.num_train_pids, feat_dim=512)
+            # the center losses of all embedding heads of the model
+            head_dims = getattr(self._unwrapped_model(), 'head_dims', None)
+            if head_dims is None:
+                raise ValueError(
+                    'weight_c requires a model with embedding heads, whose '
+                    'dimensions are given by its head_dims attribute')
+            self.criterion_c = MultiHeadCenterLoss(
+                num_classes=self.datamanager.num_train_pids,
+                feat_dims=list(head_dims),
+                use_gpu=self.use_gpu)
 
-            self.criterion_ca = CenterLoss(
-                num_classes=self.datamanager.num_train_pids, feat_dim=64)
-
-            self.criterion_cb = CenterLoss(
-                num_classes=self.datamanager.num_train_pids, feat_dim=96)
-
-            self.criterion_cc = CenterLoss(
-                num_classes=self.datamanager.num_train_pids, feat_dim=128)
+        if self.weight_r != 0:
+            batch_size = self.train_loader.batch_size
+            self.criterion_r = RangeLoss(
+                use_gpu=self.use_gpu,
+                ids_per_batch=batch_size // num_instances,
+                imgs_per_id=num_instances)
 
     def train(self,
               epoch,
@@ -61,6 +84,7 @@ class ImageTripletEngine(Engine):
         accs = AverageMeter()
         batch_time = AverageMeter()
         data_time = AverageMeter()
+        loss_times = defaultdict(AverageMeter)
 
         self.model.train()
         if (epoch + 1) <= fixbase_epoch and open_layers is not None:
@@ -80,28 +104,18 @@ class ImageTripletEngine(Engine):
                 imgs = imgs.cuda()
                 pids = pids.cuda()
 
-            self.optimizer.zero_grad()
+            self.optimizer.zero_grad(set_to_none=True)
 
-            outputs, features = self.model(imgs)
-            loss_t = self._compute_loss(self.criterion_t, features, pids)
-            loss_x = self._compute_loss(self.criterion_x, outputs, pids)
-            if self.weight_c != 0:
-                loss_c = self._compute_loss(self.criterion_c, features[0],
-                                            pids)
-                loss_ca = self._compute_loss(self.criterion_ca, features[1],
-                                             pids)
-                loss_cb = self._compute_loss(self.criterion_cb, features[2],
-                                             pids)
-                loss_cc = self._compute_loss(self.criterion_cc, features[3],
-                                             pids)
-                loss_c = loss_c + loss_ca + loss_cb + loss_cc
+            if 0 < self.micro_batch_size < imgs.size(0):
+                outputs, features, loss_t, loss_x, timings = \
+                    self._micro_batch_step(imgs, pids)
             else:
-                self.weight_c = 0
-                loss_c = 0
-
-            loss = self.weight_t * loss_t + self.weight_x * loss_x + self.weight_c * loss_c
-            loss.backward()
-            self.optimizer.step()
+                outputs, features = self._forward_train(imgs)
+                loss, loss_t, loss_x, timings = self._compute_losses(
+                    outputs, features, pids)
+                self._backward_step(loss)
+            for name, elapsed in timings.items():
+                loss_times[name].update(elapsed)
 
             batch_time.update(time.time() - end)
 
@@ -140,8 +154,120 @@ class ImageTripletEngine(Engine):
                 writer.add_scalar('Train/Acc', accs.avg, n_iter)
                 writer.add_scalar('Train/Lr',
                                   self.optimizer.param_groups[0]['lr'], n_iter)
+                for name, loss_time in loss_times.items():
+                    writer.add_scalar('Train/LossTime_' + name,
+                                      loss_time.avg, n_iter)
 
             end = time.time()
 
         if self.scheduler is not None:
             self.scheduler.step()
+
+    def _compute_losses(self, outputs, features, pids):
+        """Returns the total, triplet and softmax losses and the time of each
+        loss (empty unless ``loss_timing`` is set).
+
+        The losses on the features share one ``LossContext``, so the
+        pairwise distances of the heads are computed once.
+        """
+        context = LossContext(features, pids, timed=self.loss_timing)
+        with context.time('distance'):
+            context.distances()
+        with context.time('triplet'):
+            loss_t = self.criterion_t.forward_context(context)
+        with context.time('softmax'):
+            loss_x = self._compute_loss(self.criterion_x, outputs, pids)
+        if self.weight_c != 0:
+            with context.time('center'):
+                loss_c = self.criterion_c.forward_context(context)
+        else:
+            self.weight_c = 0
+            loss_c = 0
+        if self.weight_r != 0:
+            with context.time('range'):
+                loss_r = self.criterion_r.forward_context(context)[0]
+        else:
+            loss_r = 0
+
+        loss = self.weight_t * loss_t + self.weight_x * loss_x + \
+            self.weight_c * loss_c + self.weight_r * loss_r
+        return loss, loss_t, loss_x, context.timings
+
+    def _micro_batch_step(self, imgs, pids):
+        """Trains on a batch in chunks of ``micro_batch_size`` images.
+
+        The outputs of all chunks are first computed without building the
+        graph and assembled, so that hard mining sees the whole batch. The
+        gradients of the losses w.r.t. the assembled outputs are then
+        backpropagated through each chunk in turn by running its forward
+        again, so only one chunk holds activations at a time. The random
+        state and the BatchNorm buffers are reset before the second forward,
+        which thus gives the same outputs and updates the running statistics
+        only once. Batch statistics are computed per chunk.
+        """
+        chunks = imgs.split(self.micro_batch_size)
+        buffers = [b.clone() for b in self.model.buffers()]
+        rng_states = []
+        chunk_outputs = []
+        with torch.no_grad():
+            for chunk in chunks:
+                rng_states.append(_get_rng_state(chunk))
+                chunk_outputs.append(self._forward_train(chunk))
+        rng_state = _get_rng_state(imgs)
+
+        outputs, features = _cat(chunk_outputs)
+        leaves = _flatten((outputs, features))
+        for leaf in leaves:
+            leaf.requires_grad_()
+        loss, loss_t, loss_x, timings = self._compute_losses(
+            outputs, features, pids)
+        self._scale_loss(loss).backward()
+
+        for buffer, saved in zip(self.model.buffers(), buffers):
+            buffer.copy_(saved)
+        start = 0
+        for chunk, chunk_rng_state in zip(chunks, rng_states):
+            end = start + chunk.size(0)
+            _set_rng_state(chunk, chunk_rng_state)
+            tensors, grads = [], []
+            for output, leaf in zip(
+                    _flatten(self._forward_train(chunk)), leaves):
+                # frozen layers (fixbase_epoch) give outputs without grad
+                if leaf.grad is not None and output.requires_grad:
+                    tensors.append(output)
+                    grads.append(leaf.grad[start:end])
+            if tensors:
+                torch.autograd.backward(tensors, grads)
+            start = end
+        _set_rng_state(imgs, rng_state)
+        self._optimizer_step()
+
+        return outputs, features, loss_t, loss_x, timings
+
+
+def _flatten(outputs):
+    if isinstance(outputs, (tuple, list)):
+        return [t for output in outputs for t in _flatten(output)]
+    return [outputs]
+
+
+def _cat(chunk_outputs):
+    """Concatenates the (nested) outputs of the chunks of a batch."""
+    first = chunk_outputs[0]
+    if isinstance(first, (tuple, list)):
+        return type(first)(
+            _cat([outputs[i] for outputs in chunk_outputs])
+            for i in range(len(first)))
+    return torch.cat(chunk_outputs)
+
+
+def _get_rng_state(input):
+    if input.is_cuda:
+        return torch.get_rng_state(), torch.cuda.get_rng_state(input.device)
+    return torch.get_rng_state(), None
+
+
+def _set_rng_state(input, state):
+    torch.set_rng_state(state[0])
+    if state[1] is not None:
+        torch.cuda.set_rng_state(state[1], input.device)
@@ -92,8 +92,10 @@ class VideoSoftmaxEngine(ImageSoftmaxEngine):
             pids = pids.contiguous().view(b * s)
         return imgs, pids
 
-    def _extract_features(self, input):
-        self.model.eval()
+    def _extract_features(self, input, model=None):
+        if model is None:
+            model = self.model
+        model.eval()
         # b: batch size
         # s: sqeuence length
         # c: channel depth
@@ -101,7 +103,7 @@ class VideoSoftmaxEngine(ImageSoftmaxEngine):
         # w: width
         b, s, c, h, w = input.size()
         input = input.view(b * s, c, h, w)
-        features = self.model(input)
+        features = model(input)
         features = features.view(b, s, -1)
         if self.pooling_method == 'avg':
             features = torch.mean(features, 1)
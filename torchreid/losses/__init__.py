@@ -2,20 +2,24 @@ from __future__ import division, print_function, absolute_import
 
 from .cross_entropy_loss import CrossEntropyLoss
 from .hard_mine_triplet_loss import TripletLoss
-from .center_loss import CenterLoss
+from .center_loss import CenterLoss, MultiHeadCenterLoss
 from .range_loss import RangeLoss
+from .loss_context import LossContext, pairwise_distances
 
 
 def DeepSupervision(criterion, xs, y):
     """DeepSupervision
 
-    Applies criterion to each element in a list.
+    Applies criterion to each element in a list. Criteria with a
+    ``forward_heads`` method compute the loss of all elements at once.
 
     Args:
         criterion: loss function
         xs: tuple of inputs
         y: ground truth
     """
+    if hasattr(criterion, 'forward_heads'):
+        return criterion.forward_heads(xs, y)
     loss = 0.
     for x in xs:
         loss += criterion(x, y)
@@ -35,22 +35,57 @@ class CenterLoss(nn.Module):
         - x: feature matrix with shape (batch_size, feat_dim).
         - labels: ground truth labels with shape (num_classes).
         """
-        batch_size = x.size(0)
-        distmat = torch.pow(x, 2).sum(dim=1, keepdim=True).expand(batch_size, self.num_classes) + \
-                  torch.pow(self.centers, 2).sum(dim=1, keepdim=True).expand(self.num_classes, batch_size).t()
-        distmat.addmm_(1, -2, x, self.centers.t())
-
-        classes = torch.arange(self.num_classes).long()
-        if self.use_gpu: classes = classes.cuda()
-        labels = labels.unsqueeze(1).expand(batch_size, self.num_classes)
-        mask = labels.eq(classes.expand(batch_size, self.num_classes))
-
-        dist = []
-        for i in range(batch_size):
-            value = distmat[i][mask[i]]
-            value = value.clamp(min=1e-12, max=1e+12) # for numerical stability
-            dist.append(value)
-        dist = torch.cat(dist)
+        # only the centers of the labels are gathered
+        dist = (x - self.centers[labels]).pow(2).sum(dim=1)
+        dist = dist.clamp(min=1e-12, max=1e+12) # for numerical stability
         loss = dist.mean()
 
         return loss
+
+
+class MultiHeadCenterLoss(nn.Module):
+    """Center loss of several embedding heads computed in one call.
+
+    The centers of all heads are stored side by side in one matrix, so the
+    features of the heads are compared with their centers in a single
+    gather and subtraction. The result is the sum of the center losses of
+    the heads.
+
+    Args:
+    - num_classes (int): number of classes.
+    - feat_dims (list): feature dimension of each head.
+    """
+    def __init__(self, num_classes=751, feat_dims=(2048,), use_gpu=True):
+        super(MultiHeadCenterLoss, self).__init__()
+        self.num_classes = num_classes
+        self.feat_dims = list(feat_dims)
+        self.use_gpu = use_gpu
+
+        centers = torch.randn(self.num_classes, sum(self.feat_dims))
+        if self.use_gpu:
+            centers = centers.cuda()
+        self.centers = nn.Parameter(centers)
+
+    def forward(self, xs, labels):
+        """
+        Args:
+        - xs: feature matrix, or list of feature matrices with shape
+          (batch_size, feat_dim) in the order of ``feat_dims``.
+        - labels: ground truth labels with shape (num_classes).
+        """
+        if isinstance(xs, (tuple, list)):
+            xs = torch.cat(xs, dim=1)
+        sq = (xs - self.centers[labels]).pow(2)
+        dist = torch.stack([d.sum(dim=1) for d in sq.split(self.feat_dims, dim=1)])
+        dist = dist.clamp(min=1e-12, max=1e+12) # for numerical stability
+        loss = dist.mean(dim=1).sum()
+
+        return loss
+
+    def forward_context(self, context):
+        """
+        Args:
+        - context: ``LossContext`` with the features of the heads.
+        """
+        return self(context.features, context.targets)
+
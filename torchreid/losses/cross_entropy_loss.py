@@ -24,3 +24,13 @@ class CrossEntropyLoss(nn.Module):
             1 - self.epsilon
         ) * targets + self.epsilon / self.num_classes
         return (-targets * log_probs).mean(0).sum()
+
+    def forward_heads(self, inputs, targets):
+        """Mean of the losses of several classifier heads, see ``forward``.
+
+        Logits of the same shape are concatenated, so that the log-softmax of
+        all heads is computed at once.
+        """
+        if len(set(x.size() for x in inputs)) > 1:
+            return sum(self(x, targets) for x in inputs) / len(inputs)
+        return self(torch.cat(inputs), targets.repeat(len(inputs)))
@@ -1,6 +1,13 @@
 from __future__ import division, absolute_import
 import torch
 import torch.nn as nn
+from torch.nn import functional as F
+
+from .loss_context import pairwise_distances
+
+
+# elements of the difference tensor of batch-all mining reduced at once
+_CHUNK_TRIPLETS = 2**24
 
 
 def normalize(x, axis=-1):
@@ -9,21 +16,51 @@ def normalize(x, axis=-1):
 
 
 class TripletLoss(nn.Module):
+    """Triplet loss with batch-hard or batch-all mining.
 
-    def __init__(self, margin=0.3):
+    Batch-hard mining is done with masked reductions over the whole
+    distance matrix, without a loop over anchors. Batch-all mining masks
+    the differences of all triplets, in chunks of anchors.
+
+    Args:
+        margin (float, optional): margin of the hinge. A margin of 0 uses the
+            soft-margin ``log(1 + exp(d_ap - d_an))`` instead. Default is 0.3.
+        mining (str, optional): "batch_hard" uses the farthest positive and
+            the closest negative of each anchor. "batch_all" uses all valid
+            triplets and averages the hinge over the triplets that violate the
+            margin (over all of them for the soft margin).
+            Default is "batch_hard".
+    """
+
+    def __init__(self, margin=0.3, mining='batch_hard'):
         super(TripletLoss, self).__init__()
+        if mining not in ('batch_hard', 'batch_all'):
+            raise ValueError(
+                'Unknown mining: {}. '
+                'Please choose either "batch_hard" or "batch_all"'.format(mining)
+            )
         self.margin = margin
+        self.mining = mining
         if self.margin > 0.0:
             self.ranking_loss = nn.MarginRankingLoss(margin=margin)
         else:
             print('soft triplet')
             self.ranking_loss = nn.SoftMarginLoss()
 
-    def forward(self, inputs, targets, normalize_feature=False):
+    def forward(self, inputs, targets, normalize_feature=False,
+                return_stats=False):
         """
         Args:
             inputs (torch.Tensor): feature matrix with shape (batch_size, feat_dim).
             targets (torch.LongTensor): ground truth labels with shape (num_classes).
+            normalize_feature (bool, optional): l2-normalize the features.
+                Default is False.
+            return_stats (bool, optional): also return a dict of mining
+                statistics, the mean positive and negative distances of the
+                mined pairs ("dist_ap", "dist_an"), the fraction of triplets
+                violating the margin ("active") and the fraction of anchors
+                whose closest negative is farther than their farthest
+                positive ("prec"). Default is False.
         """
         if normalize_feature:
             inputs = normalize(inputs, axis=-1)
@@ -33,22 +70,120 @@ class TripletLoss(nn.Module):
         # Compute pairwise distance, replace by the official when merged
         dist = torch.pow(inputs, 2).sum(dim=1, keepdim=True).expand(n, n)
         dist = dist + dist.t()
-        dist.addmm_(1, -2, inputs, inputs.t())
+        dist = dist.addmm(inputs, inputs.t(), beta=1, alpha=-2)
         dist = dist.clamp(min=1e-12).sqrt() # for numerical stability
 
+        return self._mine(dist, targets, return_stats)
+
+    def forward_heads(self, inputs, targets, normalize_feature=False,
+                      return_stats=False):
+        """Mean of the losses of several embedding heads, see ``forward``.
+
+        The features of the heads are zero-padded to the largest dimension
+        and the distance matrices of all heads are computed with one batched
+        matrix product, equivalent to a block-diagonal product, and mined
+        together.
+
+        Args:
+            inputs (list): feature matrices of the heads with shape
+                (batch_size, feat_dim), the feature dimensions may differ.
+            targets (torch.LongTensor): ground truth labels with shape (num_classes).
+        """
+        if normalize_feature:
+            inputs = [normalize(x, axis=-1) for x in inputs]
+        return self._mine(pairwise_distances(inputs), targets, return_stats)
+
+    def forward_context(self, context, return_stats=False):
+        """Mean of the losses of the heads of a ``LossContext``, mined on
+        its shared distance matrices."""
+        return self._mine(context.distances(), context.targets, return_stats)
+
+    def _mine(self, dist, targets, return_stats=False):
+        """Returns the loss of distance matrices with shape (..., n, n),
+        averaged over the leading dimensions."""
+        n = dist.size(-1)
         # For each anchor, find the hardest positive and negative
         mask = targets.expand(n, n).eq(targets.expand(n, n).t())
-        dist_ap, dist_an = [], []
-        for i in range(n):
-            dist_ap.append(dist[i][mask[i]].max().unsqueeze(0))
-            dist_an.append(dist[i][mask[i] == 0].min().unsqueeze(0))
-        dist_ap = torch.cat(dist_ap)
-        dist_an = torch.cat(dist_an)
-
-        # Compute ranking hinge loss
-        y = torch.ones_like(dist_an)
+        dist_ap = dist.masked_fill(~mask, float('-inf')).max(dim=-1)[0]
+        dist_an = dist.masked_fill(mask, float('inf')).min(dim=-1)[0]
+
+        if self.mining == 'batch_hard':
+            # Compute ranking hinge loss
+            dist_ap, dist_an = dist_ap.flatten(), dist_an.flatten()
+            y = torch.ones_like(dist_an)
+            if self.margin > 0.0:
+                loss = self.ranking_loss(dist_an, dist_ap, y)
+                active = (dist_ap - dist_an + self.margin > 0).float().mean()
+            else:
+                loss = self.ranking_loss(dist_an - dist_ap, y)
+                active = (dist_ap > dist_an).float().mean()
+        else:
+            loss, active = self._batch_all(dist, mask)
+
+        if not return_stats:
+            return loss
+        stats = {
+            'dist_ap': dist_ap.detach().mean().item(),
+            'dist_an': dist_an.detach().mean().item(),
+            'active': active.item(),
+            'prec': (dist_an > dist_ap).float().mean().item()
+        }
+        return loss, stats
+
+    def _batch_all(self, dist, mask):
+        """Returns the loss over all valid triplets and the fraction of them
+        violating the margin.
+
+        The distances to the positives and to the negatives of each anchor
+        are gathered, padded to the largest count, e.g. (k - 1) and (n - k)
+        for a PxK batch, and the differences ``d(a, p) - d(a, n)`` are
+        masked to the valid triplets. Anchors are reduced in chunks whose
+        differences hold at most ``_CHUNK_TRIPLETS`` elements.
+        """
+        n = dist.size(-1)
+        eye = torch.eye(n, dtype=torch.bool, device=dist.device)
+        positives, negatives = mask & ~eye, ~mask
+        pos_index, pos_valid = _gather_index(positives)
+        neg_index, neg_valid = _gather_index(negatives)
+        lead = dist.shape[:-2]
+        dist_ap = dist.gather(-1, pos_index.expand(lead + pos_index.shape))
+        dist_an = dist.gather(-1, neg_index.expand(lead + neg_index.shape))
+        num_triplets = (positives.sum(1) * negatives.sum(1)).sum()
+        chunk = max(1, _CHUNK_TRIPLETS // max(
+            dist_ap[..., 0, :].numel() * dist_an.size(-1), 1))
+
+        total, num_active = 0, 0
+        for start in range(0, n, chunk):
+            end = start + chunk
+            # valid[a, p, n]: the p-th positive and n-th negative of a exist
+            valid = pos_valid[start:end].unsqueeze(2) & \
+                neg_valid[start:end].unsqueeze(1)
+            diff = dist_ap[..., start:end, :].unsqueeze(-1) - \
+                dist_an[..., start:end, :].unsqueeze(-2)
+            if self.margin > 0.0:
+                losses = F.relu(diff + self.margin) * valid
+                active = losses > 0
+            else:
+                losses = F.softplus(diff) * valid
+                active = (diff > 0) & valid
+            total = total + losses.flatten(-3).sum(dim=-1)
+            num_active = num_active + active.flatten(-3).sum(dim=-1)
         if self.margin > 0.0:
-            loss = self.ranking_loss(dist_an, dist_ap, y)
+            loss = total / num_active.clamp(min=1)
         else:
-            loss = self.ranking_loss(dist_an - dist_ap, y)
-        return loss
+            loss = total / num_triplets.clamp(min=1)
+        active = num_active.float().mean() / num_triplets.clamp(min=1)
+        return loss.mean(), active
+
+
+def _gather_index(mask):
+    """Returns the column indices of the true entries of each row of an
+    (n, n) mask, padded to the largest row count, and which are not padding.
+    """
+    counts = mask.sum(1)
+    width = max(int(counts.max()), 1)
+    # stable sort keeps the true columns first and in order
+    index = torch.sort(mask.to(torch.uint8), dim=1, descending=True,
+                       stable=True)[1][:, :width]
+    valid = torch.arange(width, device=mask.device) < counts.unsqueeze(1)
+    return index, valid
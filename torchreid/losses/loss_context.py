@@ -0,0 +1,81 @@
+from __future__ import division, absolute_import
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import torch
+from torch.nn import functional as F
+
+
+def pairwise_distances(inputs):
+    """Computes the euclidean distance matrices of several embedding heads.
+
+    The features are zero-padded to the largest dimension, so the distance
+    matrices of all heads come from one batched matrix product.
+
+    Args:
+        inputs (list): feature matrices with shape (batch_size, feat_dim),
+            the feature dimensions may differ.
+
+    Returns:
+        torch.Tensor: distance matrices with shape (num_heads, batch_size, batch_size).
+    """
+    feat_dim = max(x.size(1) for x in inputs)
+    inputs = torch.stack([F.pad(x, (0, feat_dim - x.size(1))) for x in inputs])
+
+    sq = torch.pow(inputs, 2).sum(dim=2)
+    dist = sq.unsqueeze(2) + sq.unsqueeze(1)
+    dist = torch.baddbmm(dist, inputs, inputs.transpose(1, 2), beta=1, alpha=-2)
+    dist = dist.clamp(min=1e-12).sqrt() # for numerical stability
+    return dist
+
+
+class LossContext(object):
+    """Features of a training step and the quantities its losses share.
+
+    The pairwise distances of the embedding heads are computed on first use
+    and reused by every loss of the step that takes the context through its
+    ``forward_context`` method.
+
+    Args:
+        features (torch.Tensor or list): feature matrix, or one per head.
+        targets (torch.LongTensor): ground truth labels.
+        timed (bool, optional): record the time of the blocks run under
+            ``time``. On gpu this synchronizes before and after each block.
+            Default is False.
+
+    Examples::
+        >>> context = LossContext(features, pids, timed=True)
+        >>> with context.time('triplet'):
+        >>>     loss_t = criterion_t.forward_context(context)
+        >>> context.timings # {'triplet': 0.002}
+    """
+
+    def __init__(self, features, targets, timed=False):
+        if not isinstance(features, (tuple, list)):
+            features = [features]
+        self.features = list(features)
+        self.targets = targets
+        self.timed = timed
+        self.timings = OrderedDict()
+        self._distances = None
+
+    def distances(self):
+        """Returns the distance matrices of the heads, see ``pairwise_distances``."""
+        if self._distances is None:
+            self._distances = pairwise_distances(self.features)
+        return self._distances
+
+    @contextmanager
+    def time(self, name):
+        """Adds the time spent in the block to ``timings[name]``."""
+        if not self.timed:
+            yield
+            return
+        sync = self.targets.is_cuda
+        if sync:
+            torch.cuda.synchronize()
+        start = time.time()
+        yield
+        if sync:
+            torch.cuda.synchronize()
+        self.timings[name] = self.timings.get(name, 0) + time.time() - start
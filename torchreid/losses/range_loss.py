@@ -184,6 +184,80 @@ class RangeLoss(nn.Module):
         # print('intra_distace:', intra_distance)
         return torch.sum(intra_distance)
 
+    def _is_pk_batch(self, targets, ids_per_batch, imgs_per_id):
+        """
+        Args:
+            targets: ground truth labels with shape (batch_size)
+            ids_per_batch: num of different ids per batch
+            imgs_per_id: num of images per id
+        Return:
+            whether the batch is made of ids_per_batch consecutive runs of imgs_per_id same labels,
+            each of a different id
+        """
+        if targets.size(0) != ids_per_batch * imgs_per_id:
+            return False
+        targets = targets.view(ids_per_batch, imgs_per_id)
+        if not bool((targets == targets[:, :1]).all()):
+            return False
+        # an id split over two runs would be two classes of the p*k view
+        return targets[:, 0].unique().numel() == ids_per_batch
+
+    def _range_loss_pk(self, features, ids_per_batch, imgs_per_id):
+        """
+        Range loss of a p*k ordered batch with batched reductions over the (p, k, feature_dim) view
+        instead of a loop over the ids. Gives the same result as _range_loss.
+        Args:
+            features: prediction matrix (before softmax) with shape (batch_size, feature_dim)
+            ids_per_batch: num of different ids per batch
+            imgs_per_id: num of images per id
+        Return:
+             range_loss
+        """
+        features = features.view(ids_per_batch, imgs_per_id, -1)
+
+        # intra class: pairwise distances of each id, as in _pairwise_distance
+        sq = torch.pow(features, 2).sum(dim=2)
+        dist = sq.unsqueeze(2) + sq.unsqueeze(1)
+        dist = torch.baddbmm(dist, features, features.transpose(1, 2), beta=1, alpha=-2)
+        dist = dist.clamp(min=1e-12).sqrt()  # for numerical stability
+        top_k = dist.view(ids_per_batch, -1).sort(dim=1)[0][:, -self.k * 2::2]  # every pair is there twice, as in _compute_top_k
+        intra_class_loss = torch.sum(self.k / torch.sum(1.0 / top_k, dim=1))
+
+        # inter class: min distance between the centers of the ids
+        center_features = features.mean(dim=1)
+        min_inter_class_center_distance = self._compute_min_dist(center_features)
+        inter_class_loss = torch.relu(self.margin - min_inter_class_center_distance)
+
+        range_loss = self.alpha * intra_class_loss + self.beta * inter_class_loss
+        return range_loss, intra_class_loss, inter_class_loss
+
+    def forward_context(self, context):
+        """
+        Mean range loss of the heads of a LossContext. For p*k ordered batches the intra class
+        distances are the diagonal blocks of the shared distance matrices of the context.
+        Args:
+            context: LossContext with the features of the heads
+        Return:
+             range_loss, intra_class_loss, inter_class_loss
+        """
+        targets = context.targets
+        if not (self.ordered and self._is_pk_batch(targets, self.ids_per_batch, self.imgs_per_id)):
+            losses = [self(features, targets) for features in context.features]
+            return tuple(sum(parts) / len(losses) for parts in zip(*losses))
+
+        p, k = self.ids_per_batch, self.imgs_per_id
+        dist = context.distances().view(-1, p, k, p, k)
+        dist = torch.diagonal(dist, dim1=1, dim2=3).permute(0, 3, 1, 2)  # (num_heads, p, k, k)
+        top_k = dist.reshape(dist.size(0), p, -1).sort(dim=2)[0][:, :, -self.k * 2::2]  # every pair is there twice, as in _compute_top_k
+        intra_class_loss = torch.sum(self.k / torch.sum(1.0 / top_k, dim=2), dim=1).mean()
+
+        inter_class_loss = sum(
+            torch.relu(self.margin - self._compute_min_dist(features.view(p, k, -1).mean(dim=1)))
+            for features in context.features) / len(context.features)
+
+        range_loss = self.alpha * intra_class_loss + self.beta * inter_class_loss
+        return range_loss, intra_class_loss, inter_class_loss
+
     def _range_loss(self, features, targets, ordered, ids_per_batch, imgs_per_id):
         """
         Args:
@@ -206,6 +280,7 @@ class RangeLoss(nn.Module):
             features: prediction matrix (before softmax) with shape (batch_size, feature_dim)
             targets: ground truth labels with shape (batch_size)
             ordered: bool type. If the train data per batch are formed as p*k, where p is the num of ids per batch and k is the num of images per id.
+                An ordered batch that is not p*k, e.g. an id split over two runs, is computed over its actual ids as with ordered=False.
             ids_per_batch: num of different ids per batch
             imgs_per_id: num of images per id
         Return:
@@ -216,7 +291,10 @@ class RangeLoss(nn.Module):
             features = features.cuda()
             targets = targets.cuda()
 
-        range_loss, intra_class_loss, inter_class_loss = self._range_loss(features, targets, self.ordered, self.ids_per_batch, self.imgs_per_id)
+        if self.ordered and self._is_pk_batch(targets, self.ids_per_batch, self.imgs_per_id):
+            return self._range_loss_pk(features, self.ids_per_batch, self.imgs_per_id)
+        # targets[::imgs_per_id] are the classes only in a p*k batch
+        range_loss, intra_class_loss, inter_class_loss = self._range_loss(features, targets, False, self.ids_per_batch, self.imgs_per_id)
         return range_loss, intra_class_loss, inter_class_loss
 
 
@@ -1,5 +1,12 @@
 from __future__ import absolute_import
 
-from .rank import evaluate_rank
+from .rank import evaluate_rank, evaluate_rank_blockwise, rank_topk
+from .rank_torch import evaluate_rank_torch
 from .accuracy import accuracy
-from .distance import compute_distance_matrix
+from .distance import compute_distance_matrix, compute_distance_matrix_blockwise
+from .ann import IVFIndex, evaluate_recall, evaluate_rank_topk
+from .quantization import ProductQuantizer
+from .precision import (
+    PRECISIONS, encode_features, decode_features, feature_dim,
+    matmul_features, squared_norms, precision_report, print_precision_report
+)
@@ -0,0 +1,333 @@
+from __future__ import division, print_function, absolute_import
+import time
+from collections import Counter
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+from .distance import compute_distance_matrix
+
+__all__ = ['IVFIndex', 'evaluate_recall', 'evaluate_rank_topk']
+
+
+class IVFIndex(object):
+    """Inverted file index for approximate nearest neighbor search.
+
+    Gallery features are clustered with k-means into ``num_lists`` inverted
+    lists. A query only visits the ``num_probes`` lists with the closest
+    centroids, so its cost grows with ``num_probes / num_lists`` of the gallery
+    instead of the whole gallery. Distances are the same as those of
+    ``compute_distance_matrix``.
+
+    Args:
+        num_lists (int, optional): number of inverted lists. Default is None,
+            which uses the square root of the number of training samples.
+        metric (str, optional): "euclidean" or "cosine". Default is "euclidean".
+        num_probes (int, optional): default number of lists visited by a query.
+            Default is 8.
+        num_iters (int, optional): k-means iterations. Default is 10.
+        max_train_samples (int, optional): k-means is trained on at most
+            ``max_train_samples * num_lists`` samples. Default is 256.
+        seed (int, optional): random seed of k-means. Default is 0.
+
+    Examples::
+        >>> from torchreid import metrics
+        >>> index = metrics.IVFIndex(num_lists=1024)
+        >>> index.train(gf)
+        >>> index.add(gf)
+        >>> distances, indices = index.search(qf, k=10, num_probes=16)
+    """
+
+    def __init__(self,
+                 num_lists=None,
+                 metric='euclidean',
+                 num_probes=8,
+                 num_iters=10,
+                 max_train_samples=256,
+                 seed=0):
+        if metric not in ['euclidean', 'cosine']:
+            raise ValueError(
+                'Unknown distance metric: {}. '
+                'Please choose either "euclidean" or "cosine"'.format(metric)
+            )
+        self.num_lists = num_lists
+        self.metric = metric
+        self.num_probes = num_probes
+        self.num_iters = num_iters
+        self.max_train_samples = max_train_samples
+        self.seed = seed
+        self.centroids = None
+        self.features = None
+        self.ids = None
+        self.offsets = None
+
+    def __len__(self):
+        return 0 if self.ids is None else self.ids.numel()
+
+    def _coarse_features(self, features):
+        # cosine distance ranks like euclidean distance of normalized features
+        if self.metric == 'cosine':
+            return F.normalize(features, p=2, dim=1)
+        return features
+
+    def _assign(self, features):
+        return kmeans_assign(
+            self._coarse_features(features).unsqueeze(0),
+            self.centroids.unsqueeze(0)
+        )[0]
+
+    def train(self, features):
+        """Learns the centroids of the inverted lists with k-means.
+
+        Args:
+            features (torch.Tensor): training features of shape (num, feat_dim).
+        """
+        num = features.size(0)
+        if self.num_lists is None:
+            self.num_lists = max(1, int(round(np.sqrt(num))))
+        num_lists = min(self.num_lists, num)
+        generator = torch.Generator().manual_seed(self.seed)
+        samples = torch.randperm(num, generator=generator)
+        samples = samples[:self.max_train_samples * num_lists]
+        samples = self._coarse_features(features[samples.to(features.device)])
+
+        self.centroids = kmeans(samples.unsqueeze(0), num_lists,
+                                self.num_iters, generator)[0]
+        self.num_lists = num_lists
+
+    def add(self, features):
+        """Adds gallery features, which are numbered in the order they are added.
+
+        Args:
+            features (torch.Tensor): gallery features of shape (num, feat_dim).
+        """
+        assert self.centroids is not None, 'Error: the index is not trained'
+        ids = torch.arange(len(self),
+                           len(self) + features.size(0),
+                           device=features.device)
+        lists = self._assign(features)
+        if self.features is not None:
+            lists = torch.cat([self._lists(), lists])
+            features = torch.cat([self.features, features])
+            ids = torch.cat([self.ids, ids])
+
+        # group the features by inverted list
+        order = torch.sort(lists, stable=True)[1]
+        self.features, self.ids = features[order], ids[order]
+        counts = torch.bincount(lists, minlength=self.num_lists)
+        self.offsets = torch.cat([counts.new_zeros(1),
+                                  counts.cumsum(0)]).tolist()
+
+    def _lists(self):
+        counts = np.diff(self.offsets)
+        return torch.repeat_interleave(
+            torch.arange(self.num_lists, device=self.ids.device),
+            torch.as_tensor(counts, device=self.ids.device)
+        )
+
+    def search(self, queries, k, num_probes=None):
+        """Searches the k nearest gallery samples of each query.
+
+        Args:
+            queries (torch.Tensor): query features of shape (num_query, feat_dim).
+            k (int): number of neighbors.
+            num_probes (int, optional): number of lists visited by a query.
+                Default is None (use the value given at construction).
+
+        Returns:
+            tuple: ``(distances, indices)`` of shape (num_query, k), sorted by
+            distance. Missing neighbors have distance inf and index -1.
+        """
+        assert len(self) > 0, 'Error: the index is empty'
+        if num_probes is None:
+            num_probes = self.num_probes
+        num_probes = min(num_probes, self.num_lists)
+        num_q = queries.size(0)
+
+        coarse_dist = compute_distance_matrix(
+            self._coarse_features(queries), self.centroids
+        )
+        probes = torch.topk(coarse_dist, num_probes, dim=1, largest=False)[1]
+
+        # candidates of each (query, probe) pair, merged at the end
+        distances = queries.new_full((num_q, num_probes, k), float('inf'))
+        indices = self.ids.new_full((num_q, num_probes, k), -1)
+        for l in torch.unique(probes).tolist():
+            start, end = self.offsets[l], self.offsets[l + 1]
+            if start == end:
+                continue
+            query_index, probe_index = (probes == l).nonzero(as_tuple=True)
+            dist = compute_distance_matrix(
+                queries[query_index], self.features[start:end], self.metric
+            )
+            dist, index = torch.topk(dist,
+                                     min(k, end - start),
+                                     dim=1,
+                                     largest=False)
+            distances[query_index, probe_index, :dist.size(1)] = dist
+            indices[query_index, probe_index, :dist.size(1)] = \
+                self.ids[start + index]
+
+        distances, order = torch.topk(distances.view(num_q, -1),
+                                      min(k, num_probes * k),
+                                      dim=1,
+                                      largest=False)
+        indices = indices.view(num_q, -1).gather(1, order)
+        return distances, indices
+
+
+def kmeans(samples, num_clusters, num_iters=10, generator=None,
+           block_size=2048):
+    """Runs k-means independently on a batch of sample sets.
+
+    Args:
+        samples (torch.Tensor): samples of shape (batch, num, dim).
+        num_clusters (int): number of clusters of each set.
+        num_iters (int, optional): number of iterations. Default is 10.
+        generator (torch.Generator, optional): generator for initialization.
+        block_size (int, optional): number of samples assigned at once. Default is 2048.
+
+    Returns:
+        torch.Tensor: centroids of shape (batch, num_clusters, dim).
+    """
+    batch, num, dim = samples.size()
+    if num >= num_clusters:
+        init = torch.randperm(num, generator=generator)[:num_clusters]
+    else:
+        init = torch.randint(num, (num_clusters, ), generator=generator)
+    centroids = samples[:, init.to(samples.device)].clone()
+
+    for _ in range(num_iters):
+        assignments = kmeans_assign(samples, centroids, block_size)
+        sums = torch.zeros_like(centroids).scatter_add_(
+            1,
+            assignments.unsqueeze(2).expand(-1, -1, dim), samples
+        )
+        counts = torch.zeros_like(centroids[:, :, 0]).scatter_add_(
+            1, assignments, torch.ones_like(samples[:, :, 0])
+        )
+        # empty clusters keep their centroid
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty].unsqueeze(1)
+    return centroids
+
+
+def kmeans_assign(samples, centroids, block_size=2048):
+    """Returns the index of the nearest centroid of each sample, for a batch
+    of sample sets of shape (batch, num, dim)."""
+    centroids_sq = centroids.pow(2).sum(2).unsqueeze(1)
+    assignments = []
+    for i in range(0, samples.size(1), block_size):
+        distmat = torch.baddbmm(centroids_sq,
+                                samples[:, i:i + block_size],
+                                centroids.transpose(1, 2),
+                                alpha=-2)
+        assignments.append(distmat.argmin(2))
+    return torch.cat(assignments, 1)
+
+
+def evaluate_recall(index, queries, gallery, k=10, num_probes=None):
+    """Computes the recall of an index against exact search.
+
+    Recall is the fraction of the exact k nearest neighbors, found with
+    ``compute_distance_matrix``, that the index returns.
+
+    Args:
+        index (IVFIndex): index built on ``gallery``.
+        queries (torch.Tensor): query features.
+        gallery (torch.Tensor): gallery features.
+        k (int, optional): number of neighbors. Default is 10.
+        num_probes (int, optional): number of lists visited by a query.
+
+    Returns:
+        tuple: ``(recall, ann_time, exact_time)``, times in seconds.
+    """
+    start = time.time()
+    exact = compute_distance_matrix(queries, gallery, index.metric)
+    exact = torch.topk(exact, k, dim=1, largest=False)[1]
+    exact_time = time.time() - start
+
+    start = time.time()
+    indices = index.search(queries, k, num_probes)[1]
+    ann_time = time.time() - start
+
+    found = (indices.unsqueeze(2) == exact.unsqueeze(1)).any(2)
+    return found.float().mean().item(), ann_time, exact_time
+
+
+def evaluate_rank_topk(indices,
+                       q_pids,
+                       g_pids,
+                       q_camids,
+                       g_camids,
+                       max_rank=50):
+    """Evaluates CMC@k, mAP@k and mINP@k from the k nearest neighbors of each
+    query, e.g. those returned by ``IVFIndex.search``.
+
+    Gallery samples sharing both person identity and camera view with the
+    query are skipped, as in ``evaluate_rank``. The average precision of a
+    query is divided by the number of true matches it could have retrieved
+    among its k neighbors, ``min(num_rel, k - num_skipped)``. CMC ranks beyond
+    the retrieved neighbors only count the true matches among them, and the
+    inverse negative penalty is 0 when some true match was not retrieved.
+
+    Args:
+        indices (numpy.ndarray): gallery indices of shape (num_query, k),
+            ordered by increasing distance. Missing neighbors are -1.
+        q_pids (numpy.ndarray): 1-D array containing person identities
+            of each query instance.
+        g_pids (numpy.ndarray): 1-D array containing person identities
+            of each gallery instance.
+        q_camids (numpy.ndarray): 1-D array containing camera views under
+            which each query instance is captured.
+        g_camids (numpy.ndarray): 1-D array containing camera views under
+            which each gallery instance is captured.
+        max_rank (int, optional): maximum CMC rank to be computed. Default is 50.
+
+    Returns:
+        tuple: ``(cmc, mAP, mINP)``.
+
+    Examples::
+        >>> from torchreid import metrics
+        >>> indices = index.search(qf, k=100)[1].cpu().numpy()
+        >>> cmc, mAP, mINP = metrics.evaluate_rank_topk(
+        >>>     indices, q_pids, g_pids, q_camids, g_camids
+        >>> )
+    """
+    indices = np.asarray(indices)
+    q_pids, g_pids = np.asarray(q_pids), np.asarray(g_pids)
+    q_camids, g_camids = np.asarray(q_camids), np.asarray(g_camids)
+    num_q, k = indices.shape
+
+    # true matches of each query in the whole gallery
+    pid_counts = Counter(g_pids.tolist())
+    pid_cam_counts = Counter(zip(g_pids.tolist(), g_camids.tolist()))
+    num_rel = np.array([
+        pid_counts[pid] - pid_cam_counts[(pid, camid)]
+        for pid, camid in zip(q_pids.tolist(), q_camids.tolist())
+    ])
+    valid = num_rel > 0
+    assert valid.any(), 'Error: all query identities do not appear in gallery'
+
+    found = indices >= 0
+    neighbors = np.where(found, indices, 0)
+    same_pid = found & (g_pids[neighbors] == q_pids[:, np.newaxis])
+    junk = same_pid & (g_camids[neighbors] == q_camids[:, np.newaxis])
+    matches = same_pid & ~junk
+    kept_rank = np.cumsum(found & ~junk, axis=1)
+
+    first_rank = np.where(matches.any(1),
+                          kept_rank[np.arange(num_q), matches.argmax(1)],
+                          np.inf)
+    cmc = np.arange(1, max_rank + 1) >= first_rank[:, np.newaxis]
+    cmc = cmc[valid].astype(np.float32).mean(0)
+
+    precision = np.cumsum(matches, axis=1) / np.maximum(kept_rank, 1)
+    num_retrievable = np.minimum(num_rel, k - junk.sum(1))
+    AP = (precision * matches).sum(1) / np.maximum(num_retrievable, 1)
+
+    last_rank = kept_rank[np.arange(num_q), k - 1 - matches[:, ::-1].argmax(1)]
+    INP = np.where(matches.sum(1) == num_rel,
+                   num_rel / np.maximum(last_rank, 1), 0)
+    return cmc, AP[valid].mean(), INP[valid].mean()
+
@@ -2,15 +2,30 @@ from __future__ import division, print_function, absolute_import
 import torch
 from torch.nn import functional as F
 
+from .precision import (decode_features, matmul_features, squared_norms,
+                        _native_matmul)
 
-def compute_distance_matrix(input1, input2, metric='euclidean'):
+# precisions of encode_features whose distances are computed without decoding
+_ENCODED_DTYPES = (torch.float16, torch.bfloat16, torch.int8)
+
+
+def compute_distance_matrix(input1, input2, metric='euclidean', quantizer=None):
     """A wrapper function for computing distance matrix.
 
+    Features stored in int8 by ``encode_features`` are multiplied in int8
+    where ``metrics.matmul_features`` has a kernel for it, other inputs,
+    including fp16 and bf16, are decoded to float32 first. Distances are
+    always accumulated in float32.
+
     Args:
         input1 (torch.Tensor): 2-D feature matrix.
-        input2 (torch.Tensor): 2-D feature matrix.
-        metric (str, optional): "euclidean" or "cosine".
+        input2 (torch.Tensor): 2-D feature matrix, or codes of ``quantizer``
+            if metric is "pq".
+        metric (str, optional): "euclidean", "cosine" or "pq" (asymmetric
+            euclidean squared distance to product-quantized codes).
             Default is "euclidean".
+        quantizer (ProductQuantizer, optional): quantizer that encoded ``input2``,
+            required if metric is "pq".
 
     Returns:
         torch.Tensor: distance matrix.
@@ -31,6 +46,13 @@ def compute_distance_matrix(input1, input2, metric='euclidean'):
     assert input2.dim() == 2, 'Expected 2-D tensor, but got {}-D'.format(
         input2.dim()
     )
+
+    if metric == 'pq':
+        assert quantizer is not None, 'metric "pq" requires a quantizer'
+        return quantizer.asymmetric_distance(decode_features(input1), input2)
+    if not _native_matmul(input1, input2):
+        input1 = decode_features(input1)
+        input2 = decode_features(input2)
     assert input1.size(1) == input2.size(1)
 
     if metric == 'euclidean':
@@ -40,7 +62,7 @@ def compute_distance_matrix(input1, input2, metric='euclidean'):
     else:
         raise ValueError(
             'Unknown distance metric: {}. '
-            'Please choose either "euclidean" or "cosine"'.format(metric)
+            'Please choose either "euclidean", "cosine" or "pq"'.format(metric)
         )
 
     return distmat
@@ -56,6 +78,10 @@ def euclidean_squared_distance(input1, input2):
     Returns:
         torch.Tensor: distance matrix.
     """
+    if input1.dtype in _ENCODED_DTYPES:
+        distmat = matmul_features(input1, input2).mul_(-2)
+        distmat.add_(squared_norms(input1).unsqueeze(1))
+        return distmat.add_(squared_norms(input2).unsqueeze(0))
     m, n = input1.size(0), input2.size(0)
     distmat = torch.pow(input1, 2).sum(dim=1, keepdim=True).expand(m, n) + \
               torch.pow(input2, 2).sum(dim=1, keepdim=True).expand(n, m).t()
@@ -73,7 +99,77 @@ def cosine_distance(input1, input2):
     Returns:
         torch.Tensor: distance matrix.
     """
+    if input1.dtype in _ENCODED_DTYPES:
+        # as F.normalize, norms are clamped to 1e-12
+        norms1 = squared_norms(input1).sqrt().clamp(min=1e-12)
+        norms2 = squared_norms(input2).sqrt().clamp(min=1e-12)
+        distmat = matmul_features(input1, input2)
+        distmat.div_(norms1.unsqueeze(1)).div_(norms2.unsqueeze(0))
+        return distmat.neg_().add_(1)
     input1_normed = F.normalize(input1, p=2, dim=1)
     input2_normed = F.normalize(input2, p=2, dim=1)
     distmat = 1 - torch.mm(input1_normed, input2_normed.t())
     return distmat
+
+
+def compute_distance_matrix_blockwise(input1,
+                                      input2,
+                                      metric='euclidean',
+                                      max_memory=256,
+                                      quantizer=None):
+    """Computes the distance matrix block by block.
+
+    Rows of ``input1`` are split into blocks whose distances to all rows of
+    ``input2`` fit into the memory budget. Each block is filled tile by tile
+    over rows of ``input2``, so temporaries stay bounded as well. Peak memory
+    thus depends on the block size rather than on the size of the full
+    distance matrix. Features stored in a lower precision are decoded one
+    tile at a time.
+
+    Args:
+        input1 (torch.Tensor): 2-D feature matrix.
+        input2 (torch.Tensor): 2-D feature matrix.
+        metric (str, optional): "euclidean" or "cosine".
+            Default is "euclidean".
+        max_memory (float, optional): memory budget in MB for one block
+            including its temporaries. Default is 256.
+        quantizer (ProductQuantizer, optional): quantizer of ``input2`` for metric "pq".
+
+    Yields:
+        tuple: ``(start, end, distmat)`` where ``distmat`` is the distance
+        matrix between ``input1[start:end]`` and ``input2``.
+
+    Examples::
+       >>> from torchreid import metrics
+       >>> input1 = torch.rand(10, 2048)
+       >>> input2 = torch.rand(100, 2048)
+       >>> for start, end, distmat in metrics.compute_distance_matrix_blockwise(
+       >>>         input1, input2, max_memory=1):
+       >>>     distmat.size() # (end - start, 100)
+    """
+    num_rows, num_cols = input1.size(0), input2.size(0)
+    # distances are at least float32 whatever the storage precision
+    dtype = torch.promote_types(input1.dtype, torch.float32)
+    block_rows, tile_cols = _block_shape(num_rows, num_cols, max_memory,
+                                         torch.finfo(dtype).bits // 8)
+
+    for start in range(0, num_rows, block_rows):
+        end = min(start + block_rows, num_rows)
+        distmat = input1.new_empty((end - start, num_cols), dtype=dtype)
+        for g_start in range(0, num_cols, tile_cols):
+            g_end = min(g_start + tile_cols, num_cols)
+            distmat[:, g_start:g_end] = compute_distance_matrix(
+                input1[start:end], input2[g_start:g_end], metric, quantizer)
+        yield start, end, distmat
+
+
+def _block_shape(num_rows, num_cols, max_memory, element_size=4):
+    """Returns (block_rows, tile_cols) for a memory budget given in MB.
+
+    Half of the budget holds the output block, the other half the two
+    temporaries created when computing one tile.
+    """
+    budget = int(max_memory * 1024**2 / element_size)
+    block_rows = min(num_rows, max(1, budget // (2 * num_cols)))
+    tile_cols = min(num_cols, max(1, budget // (4 * block_rows)))
+    return block_rows, tile_cols
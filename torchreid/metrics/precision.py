@@ -0,0 +1,211 @@
+from __future__ import division, print_function, absolute_import
+import time
+import torch
+
+__all__ = [
+    'PRECISIONS', 'encode_features', 'decode_features', 'feature_dim',
+    'matmul_features', 'squared_norms', 'precision_report',
+    'print_precision_report'
+]
+
+PRECISIONS = ('fp32', 'fp16', 'bf16', 'int8')
+
+_DTYPES = {
+    'fp32': torch.float32,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+}
+
+
+def encode_features(features, precision='fp32'):
+    """Stores features in a lower precision.
+
+    "fp16" and "bf16" cast the features. "int8" quantizes each row
+    symmetrically with its own scale, ``round(x / scale)`` with
+    ``scale = max(|x|) / 127``; the float32 scale is packed into four
+    trailing int8 columns, so the result has shape (num, feat_dim + 4) and
+    can be sliced, moved and cached like any feature matrix.
+
+    Args:
+        features (torch.Tensor): 2-D feature matrix.
+        precision (str, optional): "fp32", "fp16", "bf16" or "int8".
+            Default is "fp32".
+
+    Returns:
+        torch.Tensor: encoded features, see ``decode_features``.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(
+            'Unknown precision: {}. Please choose from {}'.format(
+                precision, PRECISIONS
+            )
+        )
+    if precision != 'int8':
+        return features.to(_DTYPES[precision])
+    features = features.float()
+    scale = features.abs().max(dim=1, keepdim=True)[0] / 127
+    scale = scale.clamp(min=torch.finfo(torch.float32).tiny)
+    codes = torch.round(features / scale).clamp_(-127, 127).to(torch.int8)
+    return torch.cat([codes, scale.view(torch.int8)], 1)
+
+
+def decode_features(features):
+    """Returns float32 features from the output of ``encode_features``.
+
+    float64 and float32 features are returned unchanged.
+    """
+    if features.dtype == torch.int8:
+        codes, scale = _split_int8(features)
+        return codes.float() * scale
+    if features.dtype in (torch.float16, torch.bfloat16):
+        return features.float()
+    return features
+
+
+def feature_dim(features):
+    """Returns the feature dimension of the output of ``encode_features``."""
+    if features.dtype == torch.int8:
+        return features.size(1) - 4
+    return features.size(1)
+
+
+def _split_int8(features):
+    """Returns the int8 codes and the float32 row scales, of shape (num, 1),
+    of int8 encoded features."""
+    return features[:, :-4], features[:, -4:].contiguous().view(torch.float32)
+
+
+def _native_matmul(input1, input2):
+    """Whether ``matmul_features`` multiplies the features in their stored
+    precision rather than decoding them."""
+    if input1.dtype != torch.int8 or input2.dtype != torch.int8:
+        return False
+    if not hasattr(torch, '_int_mm'):
+        return False
+    if input1.is_cuda:
+        # shapes supported by the cuda kernel
+        return input1.size(0) > 16 and feature_dim(input1) % 8 == 0 \
+            and input2.size(0) % 8 == 0
+    return True
+
+
+def matmul_features(input1, input2):
+    """Returns the float32 inner products ``input1 @ input2.t()`` of features
+    encoded with ``encode_features``.
+
+    int8 codes are multiplied with an int32 matrix product and the row scales
+    are applied to the result. Other features, including fp16 and bf16, are
+    decoded to float32 first: a product returned in half precision is
+    rounded to its mantissa before ``||a||^2 + ||b||^2 - 2ab`` cancels.
+
+    Args:
+        input1 (torch.Tensor): encoded features of shape (m, ...).
+        input2 (torch.Tensor): encoded features of shape (n, ...).
+
+    Returns:
+        torch.Tensor: float32 matrix of shape (m, n).
+    """
+    if not _native_matmul(input1, input2):
+        return torch.mm(decode_features(input1), decode_features(input2).t())
+    codes1, scale1 = _split_int8(input1)
+    codes2, scale2 = _split_int8(input2)
+    products = torch._int_mm(codes1.contiguous(), codes2.t().contiguous())
+    return products.float().mul_(scale1).mul_(scale2.t())
+
+
+def squared_norms(features):
+    """Returns the float32 squared norms of the rows of encoded features."""
+    if features.dtype == torch.int8:
+        codes, scale = _split_int8(features)
+        return codes.float().pow(2).sum(1) * scale.view(-1).pow(2)
+    return decode_features(features).float().pow(2).sum(1)
+
+
+def precision_report(qf,
+                     gf,
+                     q_pids,
+                     g_pids,
+                     q_camids,
+                     g_camids,
+                     metric='euclidean',
+                     precisions=PRECISIONS,
+                     use_metric_cuhk03=False):
+    """Compares storage, distance throughput and accuracy of each precision.
+
+    Distances are computed by ``compute_distance_matrix``, whose inner
+    products run on the int8 codes where ``matmul_features`` has a kernel
+    for it. fp16 and bf16 features are decoded to float32, so they only save
+    storage.
+
+    Args:
+        qf (torch.Tensor): float32 query features.
+        gf (torch.Tensor): float32 gallery features.
+        q_pids, g_pids, q_camids, g_camids (numpy.ndarray): identities and
+            camera views as in ``evaluate_rank``.
+        metric (str, optional): "euclidean" or "cosine". Default is "euclidean".
+        precisions (tuple, optional): precisions to compare, "fp32" is the
+            reference. Default is all precisions.
+        use_metric_cuhk03 (bool, optional): use single-gallery-shot setting
+            for cuhk03. Default is False.
+
+    Returns:
+        list: one dict per precision with keys "precision", "bytes" (storage
+        of qf and gf), "time" (seconds to compute the distance matrix),
+        "rank1" and "mAP".
+    """
+    # distance.py decodes its inputs with this module
+    from .distance import compute_distance_matrix
+    from .rank import evaluate_rank
+
+    rows = []
+    for precision in precisions:
+        q_encoded = encode_features(qf, precision)
+        g_encoded = encode_features(gf, precision)
+        if qf.is_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        distmat = compute_distance_matrix(q_encoded, g_encoded, metric)
+        if qf.is_cuda:
+            torch.cuda.synchronize()
+        elapsed = time.time() - start
+        cmc, mAP, _ = evaluate_rank(
+            distmat.cpu().numpy(),
+            q_pids,
+            g_pids,
+            q_camids,
+            g_camids,
+            use_metric_cuhk03=use_metric_cuhk03
+        )
+        rows.append(
+            {
+                'precision': precision,
+                'bytes': q_encoded.numel() * q_encoded.element_size() +
+                g_encoded.numel() * g_encoded.element_size(),
+                'time': elapsed,
+                'rank1': cmc[0],
+                'mAP': mAP
+            }
+        )
+    return rows
+
+
+def print_precision_report(rows):
+    """Prints the output of ``precision_report`` relative to its first row."""
+    ref = rows[0]
+    print(
+        '{:<6} {:>10} {:>8} {:>10} {:>8} {:>8} {:>8}'.format(
+            'prec', 'memory', 'saved', 'dist time', 'speedup', 'R1 drift',
+            'mAP drift'
+        )
+    )
+    for row in rows:
+        print(
+            '{:<6} {:>8.1f}MB {:>7.1f}x {:>9.3f}s {:>7.2f}x {:>+7.2%} {:>+8.2%}'.
+            format(
+                row['precision'], row['bytes'] / 1024**2,
+                ref['bytes'] / row['bytes'], row['time'],
+                ref['time'] / max(row['time'], 1e-9),
+                row['rank1'] - ref['rank1'], row['mAP'] - ref['mAP']
+            )
+        )
+
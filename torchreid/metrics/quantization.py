@@ -0,0 +1,133 @@
+from __future__ import division, print_function, absolute_import
+import torch
+
+from .ann import kmeans, kmeans_assign
+
+__all__ = ['ProductQuantizer']
+
+
+class ProductQuantizer(object):
+    """Product quantizer with optional OPQ rotation.
+
+    Features are split into ``num_subspaces`` sub-vectors, each of which is
+    encoded by the index of its nearest centroid in a codebook of
+    ``num_centroids`` entries. With 256 centroids a feature takes
+    ``num_subspaces`` bytes. Distances from (unquantized) queries to codes are
+    asymmetric distances computed from per-query lookup tables, and
+    approximate the euclidean squared distance.
+
+    With ``opq=True`` an orthogonal rotation applied before splitting is
+    learned jointly with the codebooks to reduce the quantization error.
+
+    Args:
+        num_subspaces (int, optional): number of sub-vectors, must divide the
+            feature dimension. Default is 32.
+        num_centroids (int, optional): codebook size, at most 256. Default is 256.
+        opq (bool, optional): learn an OPQ rotation. Default is False.
+        num_iters (int, optional): k-means iterations. Default is 20.
+        opq_iters (int, optional): alternating OPQ iterations. Default is 10.
+        seed (int, optional): random seed. Default is 0.
+
+    Examples::
+        >>> from torchreid import metrics
+        >>> quantizer = metrics.ProductQuantizer(num_subspaces=32, opq=True)
+        >>> quantizer.train(train_features)
+        >>> codes = quantizer.encode(gf) # uint8 of shape (num_gallery, 32)
+        >>> distmat = metrics.compute_distance_matrix(qf, codes, 'pq', quantizer)
+    """
+
+    def __init__(self,
+                 num_subspaces=32,
+                 num_centroids=256,
+                 opq=False,
+                 num_iters=20,
+                 opq_iters=10,
+                 seed=0):
+        assert num_centroids <= 256, 'codes are stored as uint8'
+        self.num_subspaces = num_subspaces
+        self.num_centroids = num_centroids
+        self.opq = opq
+        self.num_iters = num_iters
+        self.opq_iters = opq_iters
+        self.seed = seed
+        self.rotation = None
+        self.codebooks = None
+
+    def _split(self, features):
+        """Rotates and splits features into (num_subspaces, num, sub_dim)."""
+        if self.rotation is not None:
+            features = features.mm(self.rotation.to(features.device))
+        num = features.size(0)
+        return features.view(num, self.num_subspaces, -1).transpose(0, 1)
+
+    def _train_codebooks(self, features, num_iters, generator):
+        self.codebooks = kmeans(self._split(features).contiguous(),
+                                self.num_centroids, num_iters, generator)
+
+    def train(self, features):
+        """Learns the codebooks (and the OPQ rotation).
+
+        Args:
+            features (torch.Tensor): training features of shape (num, feat_dim).
+        """
+        feat_dim = features.size(1)
+        assert feat_dim % self.num_subspaces == 0, \
+            'feature dimension {} is not divisible by num_subspaces={}'.format(
+                feat_dim, self.num_subspaces)
+        generator = torch.Generator().manual_seed(self.seed)
+        features = features.float()
+
+        self.rotation = None
+        if self.opq:
+            self.rotation = torch.eye(feat_dim, device=features.device)
+            for _ in range(self.opq_iters):
+                self._train_codebooks(features, 2, generator)
+                reconstructions = self.decode(self.encode(features))
+                # orthogonal Procrustes: the rotation best mapping features
+                # onto their reconstructions
+                U, _, V = torch.svd(features.t().mm(reconstructions))
+                self.rotation = U.mm(V.t())
+        self._train_codebooks(features, self.num_iters, generator)
+
+    def encode(self, features):
+        """Returns the uint8 codes of shape (num, num_subspaces)."""
+        codebooks = self.codebooks.to(features.device)
+        codes = kmeans_assign(self._split(features.float()).contiguous(),
+                              codebooks)
+        return codes.t().to(torch.uint8)
+
+    def decode(self, codes):
+        """Returns the reconstructed features, in the rotated space if OPQ is used."""
+        codebooks = self.codebooks.to(codes.device)
+        codes = codes.long().t()
+        subspaces = torch.arange(self.num_subspaces, device=codes.device)
+        reconstructions = codebooks[subspaces.unsqueeze(1), codes]
+        return reconstructions.transpose(0, 1).reshape(codes.size(1), -1)
+
+    def lookup_tables(self, queries):
+        """Returns the euclidean squared distances from each query sub-vector
+        to each centroid, of shape (num_subspaces, num_query, num_centroids)."""
+        codebooks = self.codebooks.to(queries.device)
+        subvectors = self._split(queries.float())
+        tables = torch.baddbmm(codebooks.pow(2).sum(2).unsqueeze(1),
+                               subvectors,
+                               codebooks.transpose(1, 2),
+                               alpha=-2)
+        return tables + subvectors.pow(2).sum(2, keepdim=True)
+
+    def asymmetric_distance(self, queries, codes):
+        """Computes the asymmetric distance matrix between queries and codes.
+
+        Args:
+            queries (torch.Tensor): query features of shape (num_query, feat_dim).
+            codes (torch.Tensor): codes of shape (num_gallery, num_subspaces).
+
+        Returns:
+            torch.Tensor: distance matrix of shape (num_query, num_gallery).
+        """
+        tables = self.lookup_tables(queries)
+        codes = codes.to(queries.device).long()
+        distmat = tables[0].index_select(1, codes[:, 0])
+        for m in range(1, self.num_subspaces):
+            distmat += tables[m].index_select(1, codes[:, m])
+        return distmat
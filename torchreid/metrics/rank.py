@@ -57,7 +57,7 @@ def eval_cuhk03(distmat, q_pids, g_pids, q_camids, g_camids, max_rank):
 
         cmc = 0.
         for repeat_idx in range(num_repeats):
-            mask = np.zeros(len(raw_cmc), dtype=np.bool)
+            mask = np.zeros(len(raw_cmc), dtype=bool)
             for _, idxs in g_pids_dict.items():
                 # randomly sample one image for each gallery person
                 rnd_idx = np.random.choice(idxs)
@@ -133,7 +133,10 @@ def eval_market1501(distmat, q_pids, g_pids, q_camids, g_camids, max_rank):
 
         cmc[cmc > 1] = 1
 
-        all_cmc.append(cmc[:max_rank])
+        cmc = cmc[:max_rank]
+        # fewer kept samples than max_rank, cmc is 1 past the last of them
+        all_cmc.append(np.pad(cmc, (0, max_rank - len(cmc)), 'constant',
+                              constant_values=1))
         num_valid_q += 1.
 
         # compute average precision
@@ -155,14 +158,222 @@ def eval_market1501(distmat, q_pids, g_pids, q_camids, g_camids, max_rank):
     return all_cmc, mAP, mINP
 
 
+def eval_market1501_vectorized(distmat,
+                               q_pids,
+                               g_pids,
+                               q_camids,
+                               g_camids,
+                               max_rank,
+                               block_size=None):
+    """Evaluation with market1501 metric, vectorized over blocks of queries.
+
+    Gives the same results as ``eval_market1501`` but replaces the per-query
+    loop with 2-D array operations on ``block_size`` queries at a time.
+    Gallery samples sharing pid and camid with the query are not removed
+    from the sorted rows but skipped through their kept rank, i.e. the
+    cumulative count of kept samples.
+
+    Args:
+        block_size (int, optional): number of queries evaluated at once.
+            Default is None, which keeps each block at about 128K elements.
+    """
+    num_q, num_g = distmat.shape
+
+    if num_g < max_rank:
+        max_rank = num_g
+        print('Note: number of gallery samples is quite small, got {}'.format(
+            num_g))
+
+    if block_size is None:
+        block_size = max(1, 2**17 // num_g)
+
+    all_cmc = []
+    all_AP = []
+    all_INP = []
+
+    for start in range(0, num_q, block_size):
+        end = min(start + block_size, num_q)
+        indices = np.argsort(distmat[start:end], axis=1)
+        same_pid = g_pids[indices] == q_pids[start:end, np.newaxis]
+        same_camid = g_camids[indices] == q_camids[start:end, np.newaxis]
+
+        # remove gallery samples that have the same pid and camid with query
+        keep = ~(same_pid & same_camid)
+        raw_cmc = same_pid & keep
+        num_rel = raw_cmc.sum(1)
+        valid = num_rel > 0
+        if not np.any(valid):
+            # this condition is true when query identity does not appear in gallery
+            continue
+        raw_cmc, keep, num_rel = raw_cmc[valid], keep[valid], num_rel[valid]
+
+        # 1-based rank of each position among the kept gallery samples
+        kept_rank = keep.cumsum(1)
+        first_pos_idx = raw_cmc.argmax(1)
+        last_pos_idx = num_g - 1 - raw_cmc[:, ::-1].argmax(1)
+        rows = np.arange(len(num_rel))
+
+        first_rank = kept_rank[rows, first_pos_idx]
+        all_cmc.append(np.arange(1, max_rank + 1) >= first_rank[:, np.newaxis])
+
+        # compute mean inverse negative penalty
+        all_INP.append(num_rel / kept_rank[rows, last_pos_idx].astype(np.float64))
+
+        # compute average precision, positions before the first kept sample
+        # are junk and do not contribute
+        precision = raw_cmc.cumsum(1) / np.maximum(kept_rank, 1).astype(np.float64)
+        all_AP.append((precision * raw_cmc).sum(1) / num_rel)
+
+    assert len(all_cmc) > 0, 'Error: all query identities do not appear in gallery'
+
+    all_cmc = np.concatenate(all_cmc).astype(np.float32)
+    num_valid_q = len(all_cmc)
+    all_cmc = all_cmc.sum(0) / num_valid_q
+    mAP = np.mean(np.concatenate(all_AP))
+    mINP = np.mean(np.concatenate(all_INP))
+
+    return all_cmc, mAP, mINP
+
+
+def eval_cuhk03_partial(distmat, q_pids, g_pids, q_camids, g_camids,
+                        max_rank):
+    """Evaluation with cuhk03 metric without sorting the gallery.
+
+    Same protocol as ``eval_cuhk03``. The rank of the sampled true match is
+    the number of sampled gallery images closer to the query, and AP is
+    computed by ``_positive_ranks``.
+    """
+    num_repeats = 10
+    num_q, num_g = distmat.shape
+
+    if num_g < max_rank:
+        max_rank = num_g
+        print('Note: number of gallery samples is quite small, got {}'.format(
+            num_g))
+
+    # group gallery samples by identity once for all queries
+    g_order = np.argsort(g_pids, kind='mergesort')
+    unique_pids, g_starts, g_sizes = np.unique(g_pids[g_order],
+                                               return_index=True,
+                                               return_counts=True)
+
+    all_cmc = []
+    all_AP = []
+    num_valid_q = 0.  # number of valid query
+
+    for q_idx in range(num_q):
+        # get query pid and camid
+        q_pid = q_pids[q_idx]
+        q_camid = q_camids[q_idx]
+        dist = distmat[q_idx]
+
+        # remove gallery samples that have the same pid and camid with query
+        keep = (g_pids != q_pid) | (g_camids != q_camid)
+        matches = g_pids == q_pid
+        pos_idxs = np.where(matches & keep)[0]
+        if pos_idxs.size == 0:
+            # this condition is true when query identity does not appear in gallery
+            continue
+
+        # randomly sample one image for each gallery person
+        others = unique_pids != q_pid
+        offsets = np.random.rand(num_repeats, others.sum()) * g_sizes[others]
+        sampled = g_order[g_starts[others] + offsets.astype(np.int64)]
+        sampled_pos = np.random.choice(pos_idxs, size=num_repeats)
+        first_rank = (dist[sampled] < dist[sampled_pos, np.newaxis]).sum(1)
+        cmc = (np.arange(max_rank) >= first_rank[:, np.newaxis]).astype(
+            np.float32).mean(0)
+        all_cmc.append(cmc)
+
+        pos_rank = _positive_ranks(dist[keep], matches[keep])
+        all_AP.append(_average_precision(pos_rank))
+        num_valid_q += 1.
+
+    assert num_valid_q > 0, 'Error: all query identities do not appear in gallery'
+
+    all_cmc = np.asarray(all_cmc).astype(np.float32)
+    all_cmc = all_cmc.sum(0) / num_valid_q
+    mAP = np.mean(all_AP)
+
+    return all_cmc, mAP
+
+
+def eval_market1501_partial(distmat, q_pids, g_pids, q_camids, g_camids,
+                            max_rank):
+    """Evaluation with market1501 metric without sorting the gallery.
+
+    Same protocol as ``eval_market1501``. Only the ranks of the true matches
+    are needed for CMC, AP and INP, and they are obtained by counting the
+    gallery samples closer to the query than each true match.
+    """
+    num_q, num_g = distmat.shape
+
+    if num_g < max_rank:
+        max_rank = num_g
+        print('Note: number of gallery samples is quite small, got {}'.format(
+            num_g))
+
+    all_cmc = []
+    all_AP = []
+    all_INP = []
+    num_valid_q = 0.  # number of valid query
+
+    for q_idx in range(num_q):
+        # get query pid and camid
+        q_pid = q_pids[q_idx]
+        q_camid = q_camids[q_idx]
+
+        # remove gallery samples that have the same pid and camid with query
+        keep = (g_pids != q_pid) | (g_camids != q_camid)
+        matches = g_pids[keep] == q_pid
+        if not np.any(matches):
+            # this condition is true when query identity does not appear in gallery
+            continue
+
+        pos_rank = _positive_ranks(distmat[q_idx][keep], matches)
+        all_cmc.append(np.arange(max_rank) >= pos_rank[0])
+        all_AP.append(_average_precision(pos_rank))
+        all_INP.append(len(pos_rank) / (pos_rank[-1] + 1.))
+        num_valid_q += 1.
+
+    assert num_valid_q > 0, 'Error: all query identities do not appear in gallery'
+
+    all_cmc = np.asarray(all_cmc).astype(np.float32)
+    all_cmc = all_cmc.sum(0) / num_valid_q
+    mAP = np.mean(all_AP)
+    mINP = np.mean(all_INP)
+
+    return all_cmc, mAP, mINP
+
+
+def _positive_ranks(dist, matches):
+    """Returns the 0-based ranks of the true matches in ascending order.
+
+    Each rank is the number of true matches plus the number of wrong matches
+    closer to the query, which costs a sort of the true matches and a binary
+    search per wrong match instead of a sort of the gallery. Ties are
+    resolved in favour of the true match.
+    """
+    pos_dist = np.sort(dist[matches])
+    num_pos = len(pos_dist)
+    # a wrong match precedes the true matches that are farther than itself
+    precede = np.searchsorted(pos_dist, dist[~matches], side='right')
+    num_neg_before = np.bincount(precede, minlength=num_pos + 1).cumsum()
+    return np.arange(num_pos) + num_neg_before[:num_pos]
+
+
+def _average_precision(pos_rank):
+    # reference: https://en.wikipedia.org/wiki/Evaluation_measures_(information_retrieval)#Average_precision
+    return np.mean((np.arange(len(pos_rank)) + 1.) / (pos_rank + 1.))
+
+
 def evaluate_py(distmat, q_pids, g_pids, q_camids, g_camids, max_rank,
-                use_metric_cuhk03):
+                use_metric_cuhk03, partial_rank=False):
     if use_metric_cuhk03:
-        return eval_cuhk03(distmat, q_pids, g_pids, q_camids, g_camids,
-                           max_rank)
+        eval_func = eval_cuhk03_partial if partial_rank else eval_cuhk03
     else:
-        return eval_market1501(distmat, q_pids, g_pids, q_camids, g_camids,
-                               max_rank)
+        eval_func = eval_market1501_partial if partial_rank else eval_market1501_vectorized
+    return eval_func(distmat, q_pids, g_pids, q_camids, g_camids, max_rank)
 
 
 def evaluate_rank(distmat,
@@ -172,7 +383,9 @@ def evaluate_rank(distmat,
                   g_camids,
                   max_rank=50,
                   use_metric_cuhk03=False,
-                  use_cython=True):
+                  use_cython=True,
+                  partial_rank=False,
+                  num_threads=1):
     """Evaluates CMC rank.
 
     Args:
@@ -191,10 +404,138 @@ def evaluate_rank(distmat,
         use_cython (bool, optional): use cython code for evaluation. Default is True.
             This is highly recommended as the cython code can speed up the cmc computation
             by more than 10x. This requires Cython to be installed.
+        partial_rank (bool, optional): compute the metrics from the ranks of the
+            true matches instead of sorting each gallery row. Default is False.
+            This scales to very large galleries, results only differ when distances
+            tie.
+        num_threads (int, optional): number of threads of the cython evaluation.
+            Default is 1. Values other than 1 split queries across OpenMP threads,
+            0 uses all cores. Each thread sorts its gallery rows with a stable radix
+            sort, which orders distance ties by gallery index, so results only
+            differ from a single thread when distances tie. The cuhk03 metric
+            samples the gallery from its own random stream.
     """
     if use_cython and IS_CYTHON_AVAI:
         return evaluate_cy(distmat, q_pids, g_pids, q_camids, g_camids,
-                           max_rank, use_metric_cuhk03)
+                           max_rank, use_metric_cuhk03, partial_rank,
+                           num_threads)
     else:
         return evaluate_py(distmat, q_pids, g_pids, q_camids, g_camids,
-                           max_rank, use_metric_cuhk03)
+                           max_rank, use_metric_cuhk03, partial_rank)
+
+
+def evaluate_rank_blockwise(dist_blocks,
+                            q_pids,
+                            g_pids,
+                            q_camids,
+                            g_camids,
+                            max_rank=50,
+                            use_metric_cuhk03=False,
+                            use_cython=True,
+                            partial_rank=False,
+                            num_threads=1):
+    """Evaluates CMC rank from a stream of query blocks of the distance matrix.
+
+    Each block is evaluated on its own and the results are averaged over
+    the valid queries of all blocks, so only one block of the distance
+    matrix needs to be held in memory at a time.
+
+    Args:
+        dist_blocks (iterable): yields ``(start, end, distmat)`` where ``distmat``
+            (numpy.ndarray or torch.Tensor) holds the rows ``start:end`` of the
+            distance matrix, e.g. ``metrics.compute_distance_matrix_blockwise``.
+        q_pids (numpy.ndarray): 1-D array containing person identities
+            of each query instance.
+        g_pids (numpy.ndarray): 1-D array containing person identities
+            of each gallery instance.
+        q_camids (numpy.ndarray): 1-D array containing camera views under
+            which each query instance is captured.
+        g_camids (numpy.ndarray): 1-D array containing camera views under
+            which each gallery instance is captured.
+        max_rank (int, optional): maximum CMC rank to be computed. Default is 50.
+        use_metric_cuhk03 (bool, optional): use single-gallery-shot setting for cuhk03.
+            Default is False.
+        use_cython (bool, optional): use cython code for evaluation. Default is True.
+        partial_rank (bool, optional): compute the metrics from the ranks of the
+            true matches instead of sorting each gallery row. Default is False.
+        num_threads (int, optional): number of threads of the cython evaluation.
+            Default is 1.
+    """
+    num_g = len(g_pids)
+    if num_g < max_rank:
+        max_rank = num_g
+        print('Note: number of gallery samples is quite small, got {}'.format(
+            num_g))
+
+    sums = None
+    num_valid_q = 0
+    for start, end, distmat in dist_blocks:
+        distmat = np.asarray(distmat)
+        valid = _valid_queries(q_pids[start:end], g_pids, q_camids[start:end],
+                               g_camids)
+        num_valid = valid.sum()
+        if num_valid == 0:
+            continue
+        results = evaluate_rank(distmat[valid],
+                                q_pids[start:end][valid],
+                                g_pids,
+                                q_camids[start:end][valid],
+                                g_camids,
+                                max_rank=max_rank,
+                                use_metric_cuhk03=use_metric_cuhk03,
+                                use_cython=use_cython,
+                                partial_rank=partial_rank,
+                                num_threads=num_threads)
+        if sums is None:
+            sums = [r * num_valid for r in results]
+        else:
+            sums = [s + r * num_valid for s, r in zip(sums, results)]
+        num_valid_q += num_valid
+
+    assert num_valid_q > 0, 'Error: all query identities do not appear in gallery'
+
+    return tuple(s / num_valid_q for s in sums)
+
+
+def rank_topk(distmat, q_pids, g_pids, q_camids, g_camids, k):
+    """Returns the k nearest gallery indices for each query.
+
+    Gallery samples sharing both person identity and camera view with the
+    query are skipped, as in evaluation. Only the first k columns are
+    sorted, the rest of each row is partitioned.
+
+    Args:
+        distmat (numpy.ndarray): distance matrix of shape (num_query, num_gallery).
+        q_pids (numpy.ndarray): 1-D array containing person identities
+            of each query instance.
+        g_pids (numpy.ndarray): 1-D array containing person identities
+            of each gallery instance.
+        q_camids (numpy.ndarray): 1-D array containing camera views under
+            which each query instance is captured.
+        g_camids (numpy.ndarray): 1-D array containing camera views under
+            which each gallery instance is captured.
+        k (int): number of gallery samples to return for each query.
+
+    Returns:
+        numpy.ndarray: gallery indices of shape (num_query, k), ordered by
+        increasing distance.
+    """
+    distmat = np.array(distmat, dtype=np.float32)
+    junk = (g_pids == q_pids[:, np.newaxis]) & \
+           (g_camids == q_camids[:, np.newaxis])
+    distmat[junk] = np.inf
+
+    k = min(k, distmat.shape[1])
+    if k < distmat.shape[1]:
+        indices = np.argpartition(distmat, k - 1, axis=1)[:, :k]
+    else:
+        indices = np.tile(np.arange(k), (distmat.shape[0], 1))
+    order = np.argsort(np.take_along_axis(distmat, indices, axis=1), axis=1)
+    return np.take_along_axis(indices, order, axis=1)
+
+
+def _valid_queries(q_pids, g_pids, q_camids, g_camids):
+    """Returns a mask of queries whose identity appears in the gallery
+    under a different camera view."""
+    return ((g_pids == q_pids[:, np.newaxis]) &
+            (g_camids != q_camids[:, np.newaxis])).any(axis=1)
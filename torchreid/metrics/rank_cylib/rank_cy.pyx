@@ -4,7 +4,10 @@
 import cython
 import numpy as np
 cimport numpy as np
+import os
 from collections import defaultdict
+from libc.stdlib cimport qsort
+from cython.parallel cimport prange, threadid
 
 
 """
@@ -17,14 +20,27 @@ Credit to https://github.com/luzai
 
 
 # Main interface
-cpdef evaluate_cy(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, use_metric_cuhk03=False):
+cpdef evaluate_cy(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, use_metric_cuhk03=False,
+                  partial_rank=False, num_threads=1):
     distmat = np.asarray(distmat, dtype=np.float32)
     q_pids = np.asarray(q_pids, dtype=np.int64)
     g_pids = np.asarray(g_pids, dtype=np.int64)
     q_camids = np.asarray(q_camids, dtype=np.int64)
     g_camids = np.asarray(g_camids, dtype=np.int64)
+    if num_threads <= 0:
+        num_threads = os.cpu_count() or 1
+    if num_threads != 1:
+        if use_metric_cuhk03:
+            return eval_cuhk03_parallel_cy(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, num_threads,
+                                           not partial_rank)
+        return eval_market1501_parallel_cy(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, num_threads,
+                                           not partial_rank)
     if use_metric_cuhk03:
+        if partial_rank:
+            return eval_cuhk03_partial_cy(distmat, q_pids, g_pids, q_camids, g_camids, max_rank)
         return eval_cuhk03_cy(distmat, q_pids, g_pids, q_camids, g_camids, max_rank)
+    if partial_rank:
+        return eval_market1501_partial_cy(distmat, q_pids, g_pids, q_camids, g_camids, max_rank)
     return eval_market1501_cy(distmat, q_pids, g_pids, q_camids, g_camids, max_rank)
 
 
@@ -219,8 +235,9 @@ cpdef eval_market1501_cy(float[:,:] distmat, long[:] q_pids, long[:]g_pids,
             if cmc[g_idx] > 1:
                 cmc[g_idx] = 1
 
+        # fewer kept samples than max_rank, cmc is 1 past the last of them
         for rank_idx in range(max_rank):
-            all_cmc[q_idx, rank_idx] = cmc[rank_idx]
+            all_cmc[q_idx, rank_idx] = cmc[rank_idx] if rank_idx < num_g_real else 1
         num_valid_q += 1.
 
         # compute average precision
@@ -253,9 +270,424 @@ cpdef eval_market1501_cy(float[:,:] distmat, long[:] q_pids, long[:]g_pids,
     return np.asarray(avg_cmc).astype(np.float32), mAP, mINP
 
 
+cpdef eval_cuhk03_partial_cy(float[:,:] distmat, long[:] q_pids, long[:]g_pids,
+                             long[:]q_camids, long[:]g_camids, long max_rank):
+
+    cdef long num_q = distmat.shape[0]
+    cdef long num_g = distmat.shape[1]
+
+    if num_g < max_rank:
+        max_rank = num_g
+        print('Note: number of gallery samples is quite small, got {}'.format(num_g))
+
+    # group gallery samples by identity once for all queries
+    g_order_np = np.argsort(g_pids, kind='mergesort')
+    unique_pids_np, g_starts_np, g_sizes_np = np.unique(
+        np.asarray(g_pids)[g_order_np], return_index=True, return_counts=True)
+
+    cdef:
+        long num_repeats = 10
+        long[:] g_order = g_order_np.astype(np.int64)
+        long[:] unique_pids = unique_pids_np.astype(np.int64)
+        long[:] g_starts = g_starts_np.astype(np.int64)
+        long[:] g_sizes = g_sizes_np.astype(np.int64)
+        long num_groups = unique_pids.shape[0]
+
+        float[:,:] all_cmc = np.zeros((num_q, max_rank), dtype=np.float32)
+        float[:] all_AP = np.zeros(num_q, dtype=np.float32)
+        float num_valid_q = 0. # number of valid query
+
+        long q_idx, q_pid, rank_idx, repeat_idx, group_idx, first_rank, num_pos
+        float[:] pos_dist = np.zeros(num_g, dtype=np.float32)
+        long[:] pos_rank = np.zeros(num_g, dtype=np.int64)
+        double[:,:] rnd
+        float sampled_pos_dist
+
+    for q_idx in range(num_q):
+        q_pid = q_pids[q_idx]
+        num_pos = function_positive_ranks(distmat[q_idx], g_pids, g_camids, q_pid, q_camids[q_idx],
+                                          pos_dist, pos_rank)
+        if num_pos == 0:
+            # this condition is true when query identity does not appear in gallery
+            continue
+
+        # cuhk03-specific setting: randomly sample one image for each gallery person,
+        # the rank of the sampled true match is the number of sampled images closer to the query
+        rnd = np.random.rand(num_repeats, num_groups + 1)
+        for repeat_idx in range(num_repeats):
+            sampled_pos_dist = pos_dist[<long>(rnd[repeat_idx, num_groups] * num_pos)]
+            first_rank = 0
+            for group_idx in range(num_groups):
+                if unique_pids[group_idx] == q_pid:
+                    continue
+                if distmat[q_idx, g_order[g_starts[group_idx] + <long>(rnd[repeat_idx, group_idx] * g_sizes[group_idx])]] < sampled_pos_dist:
+                    first_rank += 1
+            for rank_idx in range(first_rank, max_rank):
+                all_cmc[q_idx, rank_idx] += 1. / num_repeats
+
+        all_AP[q_idx] = function_average_precision(pos_rank, num_pos)
+        num_valid_q += 1.
+
+    assert num_valid_q > 0, 'Error: all query identities do not appear in gallery'
+
+    # compute averaged cmc
+    cdef float[:] avg_cmc = np.zeros(max_rank, dtype=np.float32)
+    for rank_idx in range(max_rank):
+        for q_idx in range(num_q):
+            avg_cmc[rank_idx] += all_cmc[q_idx, rank_idx]
+        avg_cmc[rank_idx] /= num_valid_q
+
+    cdef float mAP = 0
+    for q_idx in range(num_q):
+        mAP += all_AP[q_idx]
+    mAP /= num_valid_q
+
+    return np.asarray(avg_cmc).astype(np.float32), mAP
+
+
+cpdef eval_market1501_partial_cy(float[:,:] distmat, long[:] q_pids, long[:]g_pids,
+                                 long[:]q_camids, long[:]g_camids, long max_rank):
+
+    cdef long num_q = distmat.shape[0]
+    cdef long num_g = distmat.shape[1]
+
+    if num_g < max_rank:
+        max_rank = num_g
+        print('Note: number of gallery samples is quite small, got {}'.format(num_g))
+
+    cdef:
+        float[:,:] all_cmc = np.zeros((num_q, max_rank), dtype=np.float32)
+        float[:] all_AP = np.zeros(num_q, dtype=np.float32)
+        float[:] all_INP = np.zeros(num_q, dtype=np.float32)
+        float num_valid_q = 0. # number of valid query
+
+        long q_idx, rank_idx, num_pos
+        float[:] pos_dist = np.zeros(num_g, dtype=np.float32)
+        long[:] pos_rank = np.zeros(num_g, dtype=np.int64)
+
+    for q_idx in range(num_q):
+        num_pos = function_positive_ranks(distmat[q_idx], g_pids, g_camids, q_pids[q_idx], q_camids[q_idx],
+                                          pos_dist, pos_rank)
+        if num_pos == 0:
+            # this condition is true when query identity does not appear in gallery
+            continue
+
+        # cmc is a step function starting at the first true match
+        for rank_idx in range(pos_rank[0], max_rank):
+            all_cmc[q_idx, rank_idx] = 1
+        all_AP[q_idx] = function_average_precision(pos_rank, num_pos)
+        all_INP[q_idx] = num_pos / (pos_rank[num_pos - 1] + 1.0)
+        num_valid_q += 1.
+
+    assert num_valid_q > 0, 'Error: all query identities do not appear in gallery'
+
+    # compute averaged cmc
+    cdef float[:] avg_cmc = np.zeros(max_rank, dtype=np.float32)
+    for rank_idx in range(max_rank):
+        for q_idx in range(num_q):
+            avg_cmc[rank_idx] += all_cmc[q_idx, rank_idx]
+        avg_cmc[rank_idx] /= num_valid_q
+
+    cdef float mAP = 0
+    cdef float mINP = 0
+    for q_idx in range(num_q):
+        mAP += all_AP[q_idx]
+        mINP += all_INP[q_idx]
+    mAP /= num_valid_q
+    mINP /= num_valid_q
+
+    return np.asarray(avg_cmc).astype(np.float32), mAP, mINP
+
+
+# Multithreaded evaluation: queries are split across OpenMP threads, each thread
+# accumulates cmc/AP/INP into its own row and the rows are reduced at the end.
+# With sort, each thread sorts the gallery of its queries with a radix sort, ties are
+# ordered by gallery index; otherwise true matches are ranked by counting as in the partial_rank
+# functions.
+cpdef eval_cuhk03_parallel_cy(float[:,:] distmat, long[:] q_pids, long[:]g_pids,
+                              long[:]q_camids, long[:]g_camids, long max_rank, int num_threads,
+                              bint sort=False):
+
+    cdef long num_q = distmat.shape[0]
+    cdef long num_g = distmat.shape[1]
+
+    if num_g < max_rank:
+        max_rank = num_g
+        print('Note: number of gallery samples is quite small, got {}'.format(num_g))
+
+    # group gallery samples by identity once for all queries
+    g_order_np = np.argsort(g_pids, kind='mergesort')
+    unique_pids_np, g_starts_np, g_sizes_np = np.unique(
+        np.asarray(g_pids)[g_order_np], return_index=True, return_counts=True)
+
+    cdef:
+        long num_repeats = 10
+        long[:] g_order = g_order_np.astype(np.int64)
+        long[:] unique_pids = unique_pids_np.astype(np.int64)
+        long[:] g_starts = g_starts_np.astype(np.int64)
+        long[:] g_sizes = g_sizes_np.astype(np.int64)
+        long num_groups = unique_pids.shape[0]
+        # seeded from numpy so that np.random.seed() makes the sampling reproducible
+        unsigned long long seed = np.random.randint(0, 2**62, dtype=np.int64)
+
+        double[:,:] thread_cmc = np.zeros((num_threads, max_rank), dtype=np.float64)
+        double[:] thread_AP = np.zeros(num_threads, dtype=np.float64)
+        double[:] thread_valid_q = np.zeros(num_threads, dtype=np.float64)
+        float[:,:] pos_dist = np.zeros((num_threads, num_g), dtype=np.float32)
+        long[:,:] pos_rank = np.zeros((num_threads, num_g), dtype=np.int64)
+        long[:,:] pos_position = np.zeros((num_threads, num_g), dtype=np.int64)
+        long[:,:] g_position = np.zeros((num_threads, num_g if sort else 1), dtype=np.int64)
+        unsigned int[:,:,:] sort_keys = np.zeros((num_threads, 2, num_g if sort else 1), dtype=np.uint32)
+        long[:,:,:] sort_indices = np.zeros((num_threads, 2, num_g if sort else 1), dtype=np.int64)
+
+        long q_idx, q_pid, rank_idx, repeat_idx, group_idx, first_rank, num_pos, sampled_idx, sampled_pos
+        int tid
+        unsigned long long rng_state
+        float sampled_pos_dist
+
+    for q_idx in prange(num_q, nogil=True, num_threads=num_threads, schedule='dynamic'):
+        tid = threadid()
+        q_pid = q_pids[q_idx]
+        if sort:
+            num_pos = function_sorted_ranks(distmat[q_idx], g_pids, g_camids, q_pid, q_camids[q_idx],
+                                            sort_keys[tid], sort_indices[tid], g_position[tid],
+                                            pos_position[tid], pos_rank[tid])
+        else:
+            num_pos = function_positive_ranks(distmat[q_idx], g_pids, g_camids, q_pid, q_camids[q_idx],
+                                              pos_dist[tid], pos_rank[tid])
+        if num_pos == 0:
+            # this condition is true when query identity does not appear in gallery
+            continue
+
+        # cuhk03-specific setting: randomly sample one image for each gallery person,
+        # the random stream only depends on the query so results do not depend on scheduling
+        rng_state = seed + <unsigned long long>q_idx * 0x9E3779B97F4A7C15ULL
+        for repeat_idx in range(num_repeats):
+            sampled_idx = <long>(function_rand_uniform(&rng_state) * num_pos)
+            sampled_pos = pos_position[tid, sampled_idx]
+            sampled_pos_dist = pos_dist[tid, sampled_idx]
+            first_rank = 0
+            for group_idx in range(num_groups):
+                sampled_idx = g_order[g_starts[group_idx] + <long>(function_rand_uniform(&rng_state) * g_sizes[group_idx])]
+                if unique_pids[group_idx] == q_pid:
+                    continue
+                if sort:
+                    if g_position[tid, sampled_idx] < sampled_pos:
+                        first_rank = first_rank + 1
+                elif distmat[q_idx, sampled_idx] < sampled_pos_dist:
+                    first_rank = first_rank + 1
+            for rank_idx in range(first_rank, max_rank):
+                thread_cmc[tid, rank_idx] += 1. / num_repeats
+
+        thread_AP[tid] += function_average_precision(pos_rank[tid], num_pos)
+        thread_valid_q[tid] += 1.
+
+    cdef double num_valid_q = np.sum(thread_valid_q)
+    assert num_valid_q > 0, 'Error: all query identities do not appear in gallery'
+
+    avg_cmc = np.sum(thread_cmc, axis=0) / num_valid_q
+    mAP = np.sum(thread_AP) / num_valid_q
+
+    return avg_cmc.astype(np.float32), mAP
+
+
+cpdef eval_market1501_parallel_cy(float[:,:] distmat, long[:] q_pids, long[:]g_pids,
+                                  long[:]q_camids, long[:]g_camids, long max_rank, int num_threads,
+                                  bint sort=False):
+
+    cdef long num_q = distmat.shape[0]
+    cdef long num_g = distmat.shape[1]
+
+    if num_g < max_rank:
+        max_rank = num_g
+        print('Note: number of gallery samples is quite small, got {}'.format(num_g))
+
+    cdef:
+        double[:,:] thread_cmc = np.zeros((num_threads, max_rank), dtype=np.float64)
+        double[:] thread_AP = np.zeros(num_threads, dtype=np.float64)
+        double[:] thread_INP = np.zeros(num_threads, dtype=np.float64)
+        double[:] thread_valid_q = np.zeros(num_threads, dtype=np.float64)
+        float[:,:] pos_dist = np.zeros((num_threads, num_g), dtype=np.float32)
+        long[:,:] pos_rank = np.zeros((num_threads, num_g), dtype=np.int64)
+        long[:,:] pos_position = np.zeros((num_threads, num_g if sort else 1), dtype=np.int64)
+        long[:,:] g_position = np.zeros((num_threads, num_g if sort else 1), dtype=np.int64)
+        unsigned int[:,:,:] sort_keys = np.zeros((num_threads, 2, num_g if sort else 1), dtype=np.uint32)
+        long[:,:,:] sort_indices = np.zeros((num_threads, 2, num_g if sort else 1), dtype=np.int64)
+
+        long q_idx, rank_idx, num_pos
+        int tid
+
+    for q_idx in prange(num_q, nogil=True, num_threads=num_threads, schedule='dynamic'):
+        tid = threadid()
+        if sort:
+            num_pos = function_sorted_ranks(distmat[q_idx], g_pids, g_camids, q_pids[q_idx], q_camids[q_idx],
+                                            sort_keys[tid], sort_indices[tid], g_position[tid],
+                                            pos_position[tid], pos_rank[tid])
+        else:
+            num_pos = function_positive_ranks(distmat[q_idx], g_pids, g_camids, q_pids[q_idx], q_camids[q_idx],
+                                              pos_dist[tid], pos_rank[tid])
+        if num_pos == 0:
+            # this condition is true when query identity does not appear in gallery
+            continue
+
+        # cmc is a step function starting at the first true match
+        for rank_idx in range(pos_rank[tid, 0], max_rank):
+            thread_cmc[tid, rank_idx] += 1.
+        thread_AP[tid] += function_average_precision(pos_rank[tid], num_pos)
+        thread_INP[tid] += num_pos / (pos_rank[tid, num_pos - 1] + 1.0)
+        thread_valid_q[tid] += 1.
+
+    cdef double num_valid_q = np.sum(thread_valid_q)
+    assert num_valid_q > 0, 'Error: all query identities do not appear in gallery'
+
+    avg_cmc = np.sum(thread_cmc, axis=0) / num_valid_q
+    mAP = np.sum(thread_AP) / num_valid_q
+    mINP = np.sum(thread_INP) / num_valid_q
+
+    return avg_cmc.astype(np.float32), mAP, mINP
+
+
+# Sort the gallery of a query by distance, ties by gallery index, and compute the 0-based ranks
+# of the true matches among the samples that are kept (not same pid and camid as the query).
+# Stores the ranks in pos_rank, the sorted positions of the true matches in pos_position and
+# the sorted position of every gallery sample in g_position, returns the number of true matches
+cdef long function_sorted_ranks(float[:] dist, long[:] g_pids, long[:] g_camids, long q_pid, long q_camid,
+                                unsigned int[:,:] keys, long[:,:] indices, long[:] g_position,
+                                long[:] pos_position, long[:] pos_rank) noexcept nogil:
+    cdef long num_g = dist.shape[0]
+    cdef long num_pos = 0
+    cdef long kept_rank = 0
+    cdef long g_idx, sorted_idx
+
+    function_radix_argsort(dist, keys, indices)
+    for sorted_idx in range(num_g):
+        g_idx = indices[0, sorted_idx]
+        g_position[g_idx] = sorted_idx
+        if g_pids[g_idx] == q_pid:
+            # remove gallery samples that have the same pid and camid with query
+            if g_camids[g_idx] == q_camid:
+                continue
+            pos_rank[num_pos] = kept_rank
+            pos_position[num_pos] = sorted_idx
+            num_pos += 1
+        kept_rank += 1
+    return num_pos
+
+
+# Stable argsort of dist into indices[0] by a least significant digit radix sort of the float bits,
+# so ties are ordered by index. keys and indices are buffers of shape (2, len(dist))
+cdef void function_radix_argsort(float[:] dist, unsigned int[:,:] keys, long[:,:] indices) noexcept nogil:
+    cdef long n = dist.shape[0]
+    cdef long i, digit, total, count
+    cdef long counts[256]
+    cdef int shift, src, dst
+    cdef unsigned int key
+
+    for i in range(n):
+        # order-preserving map of the float bits to unsigned integers
+        key = (<unsigned int*>&dist[i])[0]
+        if key & 0x80000000U:
+            key = ~key
+        else:
+            key = key | 0x80000000U
+        keys[0, i] = key
+        indices[0, i] = i
+
+    src = 0
+    for shift in range(0, 32, 8):
+        dst = 1 - src
+        for digit in range(256):
+            counts[digit] = 0
+        for i in range(n):
+            counts[(keys[src, i] >> shift) & 0xFF] += 1
+        total = 0
+        for digit in range(256):
+            count = counts[digit]
+            counts[digit] = total
+            total += count
+        for i in range(n):
+            digit = (keys[src, i] >> shift) & 0xFF
+            keys[dst, counts[digit]] = keys[src, i]
+            indices[dst, counts[digit]] = indices[src, i]
+            counts[digit] += 1
+        src = dst
+
+
+# Compute the 0-based ranks of the true matches of a query without sorting the gallery,
+# stores them in pos_rank and the sorted true match distances in pos_dist,
+# returns the number of true matches (ties are resolved in favour of the true match)
+cdef long function_positive_ranks(float[:] dist, long[:] g_pids, long[:] g_camids, long q_pid, long q_camid,
+                                  float[:] pos_dist, long[:] pos_rank) noexcept nogil:
+    cdef long num_g = dist.shape[0]
+    cdef long num_pos = 0
+    cdef long g_idx, lo, half, n, num_neg_before
+    cdef float d
+
+    for g_idx in range(num_g):
+        if (g_pids[g_idx] == q_pid) and (g_camids[g_idx] != q_camid):
+            pos_dist[num_pos] = dist[g_idx]
+            num_pos += 1
+    if num_pos == 0:
+        return 0
+    qsort(&pos_dist[0], num_pos, sizeof(float), compare_float)
+
+    # count the wrong matches in front of each true match
+    for g_idx in range(num_pos):
+        pos_rank[g_idx] = 0
+    for g_idx in range(num_g):
+        d = dist[g_idx]
+        if (d < pos_dist[num_pos - 1]) and (g_pids[g_idx] != q_pid):
+            # number of true matches not farther than this wrong match (branchless binary search)
+            lo = 0
+            n = num_pos
+            while n > 1:
+                half = n // 2
+                if pos_dist[lo + half] <= d:
+                    lo += half
+                n -= half
+            if pos_dist[lo] <= d:
+                lo += 1
+            pos_rank[lo] += 1
+
+    num_neg_before = 0
+    for g_idx in range(num_pos):
+        num_neg_before += pos_rank[g_idx]
+        pos_rank[g_idx] = g_idx + num_neg_before
+    return num_pos
+
+
+# Compute average precision from the 0-based ranks of the true matches
+# reference: https://en.wikipedia.org/wiki/Evaluation_measures_(information_retrieval)#Average_precision
+cdef float function_average_precision(long[:] pos_rank, long num_pos) noexcept nogil:
+    cdef long i
+    cdef float precision_sum = 0
+    for i in range(num_pos):
+        precision_sum += (i + 1.) / (pos_rank[i] + 1.)
+    return precision_sum / num_pos
+
+
+# splitmix64 generator, returns a uniform sample in [0, 1)
+cdef inline double function_rand_uniform(unsigned long long* state) noexcept nogil:
+    cdef unsigned long long z
+    state[0] += 0x9E3779B97F4A7C15ULL
+    z = state[0]
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL
+    z = z ^ (z >> 31)
+    return (z >> 11) * (1.0 / 9007199254740992.0)
+
+
+# qsort comparator, which must not raise
+cdef int compare_float(const void* a, const void* b) noexcept nogil:
+    cdef float x = (<float*>a)[0]
+    cdef float y = (<float*>b)[0]
+    return (x > y) - (x < y)
+
+
+
 # Compute the cumulative sum
 cdef void function_cumsum(cython.numeric[:] src, cython.numeric[:] dst, long n):
     cdef long i
     dst[0] = src[0]
     for i in range(1, n):
-        dst[i] = src[i] + dst[i - 1]
\ No newline at end of file
+        dst[i] = src[i] + dst[i - 1]
\ No newline at end of file
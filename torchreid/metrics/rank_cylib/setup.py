@@ -1,5 +1,9 @@
+import os
+import tempfile
 from distutils.core import setup
+from distutils.errors import CompileError
 from distutils.extension import Extension
+from distutils.command.build_ext import build_ext
 
 import numpy as np
 from Cython.Build import cythonize
@@ -13,6 +17,36 @@ def numpy_include():
     return numpy_include
 
 
+def openmp_flags(compiler):
+    """Returns the compile and link flags of OpenMP for the compiler.
+
+    Without OpenMP, e.g. with Apple clang, the multithreaded evaluation
+    runs on a single thread.
+    """
+    if compiler.compiler_type == 'msvc':
+        return ['/openmp'], []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        src = os.path.join(tmp_dir, 'openmp_test.c')
+        with open(src, 'w') as f:
+            f.write('#include <omp.h>\nint main(void) { return omp_get_max_threads(); }\n')
+        try:
+            compiler.compile([src], output_dir=tmp_dir, extra_postargs=['-fopenmp'])
+        except CompileError:
+            print('Note: the compiler does not support OpenMP, building without it')
+            return [], []
+    return ['-fopenmp'], ['-fopenmp']
+
+
+class BuildExt(build_ext):
+
+    def build_extensions(self):
+        compile_args, link_args = openmp_flags(self.compiler)
+        for ext in self.extensions:
+            ext.extra_compile_args += compile_args
+            ext.extra_link_args += link_args
+        build_ext.build_extensions(self)
+
+
 ext_modules = [
     Extension(
         'rank_cy',
@@ -23,5 +57,6 @@ ext_modules = [
 
 setup(
     name='Cython-based reid evaluation code',
-    ext_modules=cythonize(ext_modules)
+    ext_modules=cythonize(ext_modules),
+    cmdclass={'build_ext': BuildExt}
 )
@@ -4,9 +4,9 @@ import numpy as np
 import timeit
 import os.path as osp
 
-from torchreid import metrics
-
 sys.path.insert(0, osp.dirname(osp.abspath(__file__)) + '/../../..')
+from torchreid import metrics
+from torchreid.metrics import rank
 """
 Test the speed of cython-based evaluation code. The speed improvements
 can be much bigger when using the real reid data, which contains a larger
@@ -17,6 +17,8 @@ Note: you might encounter the following error:
 This is normal because the inputs are random numbers. Just try again.
 """
 
+num_threads = 4
+
 print('*** Compare running time ***')
 
 setup = '''
@@ -64,20 +66,55 @@ cytime = timeit.timeit(
 print('Python time: {} s'.format(pytime))
 print('Cython time: {} s'.format(cytime))
 print('Cython is {} times faster than python\n'.format(pytime / cytime))
-"""
-print("=> Check precision")
+print('=> Using market1501\'s metric with {} threads'.format(num_threads))
+pytime = timeit.timeit(
+    'metrics.evaluate_rank(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, use_cython=False)',
+    setup=setup,
+    number=20
+)
+cytime = timeit.timeit(
+    'metrics.evaluate_rank(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, num_threads={})'.format(num_threads),
+    setup=setup,
+    number=20
+)
+print('Python time: {} s'.format(pytime))
+print('Cython time: {} s'.format(cytime))
+print('Cython is {} times faster than python\n'.format(pytime / cytime))
+
+print('=> Check precision of the multithreaded evaluation')
 
 num_q = 30
 num_g = 300
-max_rank = 5
+max_rank = 50
 distmat = np.random.rand(num_q, num_g) * 20
 q_pids = np.random.randint(0, num_q, size=num_q)
-g_pids = np.random.randint(0, num_g, size=num_g)
+g_pids = np.random.randint(0, num_q, size=num_g)
 q_camids = np.random.randint(0, 5, size=num_q)
 g_camids = np.random.randint(0, 5, size=num_g)
 
-cmc, mAP = evaluate(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, use_cython=False)
-print("Python:\nmAP = {} \ncmc = {}\n".format(mAP, cmc))
-cmc, mAP = evaluate(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, use_cython=True)
-print("Cython:\nmAP = {} \ncmc = {}\n".format(mAP, cmc))
-"""
+for partial_rank in [False, True]:
+    py_results = rank.evaluate_py(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, False,
+                                  partial_rank=partial_rank)
+    cy_results = rank.evaluate_cy(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, False,
+                                  partial_rank=partial_rank, num_threads=num_threads)
+    for name, py_value, cy_value in zip(['cmc', 'mAP', 'mINP'], py_results, cy_results):
+        print('{} (partial_rank={}): max difference = {}'.format(
+            name, partial_rank, np.max(np.abs(py_value - cy_value))))
+        assert np.allclose(py_value, cy_value, atol=1e-5)
+
+# one gallery image per identity makes the cuhk03 sampling deterministic
+g_pids = np.arange(num_g)
+g_camids = np.random.randint(0, 2, size=num_g)
+q_pids = np.random.randint(0, num_g, size=num_q)
+q_camids = 1 - g_camids[q_pids]
+
+for partial_rank in [False, True]:
+    py_results = rank.evaluate_py(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, True,
+                                  partial_rank=partial_rank)
+    cy_results = rank.evaluate_cy(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, True,
+                                  partial_rank=partial_rank, num_threads=num_threads)
+    for name, py_value, cy_value in zip(['cmc', 'mAP'], py_results, cy_results):
+        print('{} (cuhk03, partial_rank={}): max difference = {}'.format(
+            name, partial_rank, np.max(np.abs(py_value - cy_value))))
+        assert np.allclose(py_value, cy_value, atol=1e-5)
+print('Multithreaded cython evaluation matches python evaluation')
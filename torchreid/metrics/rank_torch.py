@@ -0,0 +1,210 @@
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import torch
+
+
+def evaluate_rank_torch(distmat,
+                        q_pids,
+                        g_pids,
+                        q_camids,
+                        g_camids,
+                        max_rank=50,
+                        use_metric_cuhk03=False,
+                        block_size=None):
+    """Evaluates CMC rank with torch operations.
+
+    Everything is computed on the device holding ``distmat``, in blocks of
+    queries, so the distance matrix is never copied to the host and the
+    device is only synchronized once, for the final sums. Results are the
+    same as ``evaluate_rank``. Sums are accumulated in float64, or in float32
+    on devices without float64 (mps).
+
+    Args:
+        distmat (torch.Tensor or iterable): distance matrix of shape
+            (num_query, num_gallery), or an iterable yielding ``(start, end, distmat)``
+            blocks of its rows, e.g. ``metrics.compute_distance_matrix_blockwise``.
+        q_pids (numpy.ndarray): 1-D array containing person identities
+            of each query instance.
+        g_pids (numpy.ndarray): 1-D array containing person identities
+            of each gallery instance.
+        q_camids (numpy.ndarray): 1-D array containing camera views under
+            which each query instance is captured.
+        g_camids (numpy.ndarray): 1-D array containing camera views under
+            which each gallery instance is captured.
+        max_rank (int, optional): maximum CMC rank to be computed. Default is 50.
+        use_metric_cuhk03 (bool, optional): use single-gallery-shot setting for cuhk03.
+            Default is False.
+        block_size (int, optional): number of queries evaluated at once. Default is
+            None, which keeps each block at about 1M elements.
+
+    Examples::
+        >>> from torchreid import metrics
+        >>> distmat = metrics.compute_distance_matrix(qf.cuda(), gf.cuda())
+        >>> cmc, mAP, mINP = metrics.evaluate_rank_torch(
+        >>>     distmat, q_pids, g_pids, q_camids, g_camids
+        >>> )
+    """
+    if isinstance(distmat, torch.Tensor):
+        dist_blocks = [(0, distmat.size(0), distmat)]
+    else:
+        dist_blocks = distmat
+
+    num_g = len(g_pids)
+    if num_g < max_rank:
+        max_rank = num_g
+        print('Note: number of gallery samples is quite small, got {}'.format(
+            num_g))
+
+    if block_size is None:
+        block_size = max(1, 2**20 // num_g)
+        if use_metric_cuhk03:
+            block_size = max(1, block_size // 10)
+
+    device = None
+    sums = None
+    for start, end, block in dist_blocks:
+        if device is None:
+            device = block.device
+            g_pids_t = torch.as_tensor(np.asarray(g_pids), device=device)
+            g_camids_t = torch.as_tensor(np.asarray(g_camids), device=device)
+            q_pids_t = torch.as_tensor(np.asarray(q_pids), device=device)
+            q_camids_t = torch.as_tensor(np.asarray(q_camids), device=device)
+            sums = torch.zeros(max_rank + 3,
+                               dtype=_accumulation_dtype(device),
+                               device=device)
+            if use_metric_cuhk03:
+                g_groups = _group_by_pid(g_pids_t)
+
+        for s in range(start, end, block_size):
+            e = min(s + block_size, end)
+            if use_metric_cuhk03:
+                sums += _eval_cuhk03_block(block[s - start:e - start],
+                                           q_pids_t[s:e], q_camids_t[s:e],
+                                           g_pids_t, g_camids_t, g_groups,
+                                           max_rank)
+            else:
+                sums += _eval_market1501_block(block[s - start:e - start],
+                                               q_pids_t[s:e], q_camids_t[s:e],
+                                               g_pids_t, g_camids_t, max_rank)
+
+    if sums is None:
+        raise ValueError('Error: the distance matrix has no query rows')
+    sums = sums.cpu().numpy()
+    num_valid_q = sums[-1]
+    assert num_valid_q > 0, 'Error: all query identities do not appear in gallery'
+
+    all_cmc = (sums[:max_rank] / num_valid_q).astype(np.float32)
+    mAP = sums[max_rank] / num_valid_q
+    mINP = sums[max_rank + 1] / num_valid_q
+    if use_metric_cuhk03:
+        return all_cmc, mAP
+    return all_cmc, mAP, mINP
+
+
+def _accumulation_dtype(device):
+    """Returns the dtype of the sums, float64 unless the device lacks it."""
+    # mps has no float64
+    return torch.float32 if device.type == 'mps' else torch.float64
+
+
+def _ranked_matches(distmat, q_pids, q_camids, g_pids, g_camids):
+    """Sorts gallery rows and returns (raw_cmc, kept_rank, num_rel, valid).
+
+    ``raw_cmc`` marks the true matches in the sorted rows, ``kept_rank`` is the
+    1-based rank of each position once gallery samples sharing pid and camid
+    with the query are removed. Invalid queries, without true match, are kept
+    and flagged by ``valid``; selecting the valid rows would synchronize the
+    device.
+    """
+    indices = torch.argsort(distmat, dim=1)
+    same_pid = g_pids[indices] == q_pids.unsqueeze(1)
+    same_camid = g_camids[indices] == q_camids.unsqueeze(1)
+
+    # remove gallery samples that have the same pid and camid with query
+    keep = ~(same_pid & same_camid)
+    raw_cmc = same_pid & keep
+    num_rel = raw_cmc.sum(1)
+    valid = num_rel > 0
+    return raw_cmc, keep.cumsum(1), num_rel, valid
+
+
+def _average_precision(raw_cmc, kept_rank, num_rel):
+    # reference: https://en.wikipedia.org/wiki/Evaluation_measures_(information_retrieval)#Average_precision
+    # the AP of invalid queries is 0
+    dtype = _accumulation_dtype(raw_cmc.device)
+    precision = raw_cmc.cumsum(1).to(dtype) / kept_rank.to(dtype)
+    return precision.masked_fill(~raw_cmc, 0).sum(1) / \
+        num_rel.clamp(min=1).to(dtype)
+
+
+def _eval_market1501_block(distmat, q_pids, q_camids, g_pids, g_camids,
+                           max_rank):
+    """Returns the sums of cmc, AP and INP and the number of valid queries
+    of a block, concatenated into one tensor."""
+    raw_cmc, kept_rank, num_rel, valid = _ranked_matches(distmat, q_pids,
+                                                         q_camids, g_pids,
+                                                         g_camids)
+    num_g = distmat.size(1)
+    # invalid queries have no first match within max_rank <= num_g and an
+    # INP of 0
+    first_rank = kept_rank.masked_fill(~raw_cmc, num_g + 1).min(1)[0]
+    last_rank = kept_rank.masked_fill(~raw_cmc, 0).max(1)[0]
+
+    dtype = _accumulation_dtype(distmat.device)
+    ranks = torch.arange(1, max_rank + 1, device=distmat.device)
+    cmc = (ranks >= first_rank.unsqueeze(1)).to(dtype).sum(0)
+    AP = _average_precision(raw_cmc, kept_rank, num_rel).sum()
+    INP = (num_rel.to(dtype) / last_rank.clamp(min=1).to(dtype)).sum()
+    num_valid = torch.stack([AP, INP, valid.sum().to(dtype)])
+    return torch.cat([cmc, num_valid])
+
+
+def _group_by_pid(g_pids):
+    """Returns (order, group_pids, starts, sizes) grouping gallery indices by pid."""
+    g_pids_sorted, order = torch.sort(g_pids)
+    group_pids, sizes = torch.unique_consecutive(g_pids_sorted,
+                                                 return_counts=True)
+    starts = sizes.cumsum(0) - sizes
+    return order, group_pids, starts, sizes
+
+
+def _eval_cuhk03_block(distmat,
+                       q_pids,
+                       q_camids,
+                       g_pids,
+                       g_camids,
+                       g_groups,
+                       max_rank,
+                       num_repeats=10):
+    """Returns the sums of cmc and AP and the number of valid queries of a
+    block with cuhk03 metric, concatenated into one tensor."""
+    raw_cmc, kept_rank, num_rel, valid = _ranked_matches(
+        distmat, q_pids, q_camids, g_pids, g_camids)
+    AP = _average_precision(raw_cmc, kept_rank, num_rel).sum()
+
+    num_q = distmat.size(0)
+    order, group_pids, starts, sizes = g_groups
+    dtype = _accumulation_dtype(distmat.device)
+
+    # randomly sample one image for each gallery person, the rank of the sampled
+    # true match is the number of sampled images closer to the query
+    positive = (g_pids == q_pids.unsqueeze(1)) & \
+               (g_camids != q_camids.unsqueeze(1))
+    # invalid queries sample any image and are masked out of the cmc
+    weights = positive.to(dtype) + (~valid).to(dtype).unsqueeze(1)
+    sampled_pos = torch.multinomial(weights, num_repeats, replacement=True)
+    sampled_pos_dist = distmat.gather(1, sampled_pos)
+
+    offsets = torch.rand(num_q, num_repeats, len(sizes),
+                         device=distmat.device) * sizes.to(dtype)
+    sampled = order[starts + offsets.long()]
+    sampled_dist = distmat.gather(1, sampled.view(num_q, -1)).view_as(sampled)
+    closer = (sampled_dist < sampled_pos_dist.unsqueeze(2)) & \
+             (group_pids != q_pids.view(-1, 1, 1))
+    first_rank = closer.sum(2)
+
+    ranks = torch.arange(max_rank, device=distmat.device)
+    cmc = (ranks >= first_rank.unsqueeze(2)).to(dtype).mean(1)
+    cmc = (cmc * valid.to(dtype).unsqueeze(1)).sum(0)
+    num_valid = torch.stack([AP, torch.zeros_like(AP), valid.sum().to(dtype)])
+    return torch.cat([cmc, num_valid])
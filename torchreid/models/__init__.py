@@ -4,6 +4,7 @@ import torch
 from .osnet import *
 from .osnet_ain import *
 from .pfh_osnet import *
+from .inference import *
 
 __model_factory = {
     # image classification models
@@ -30,7 +31,9 @@ def build_model(name,
                 loss='softmax',
                 pretrained=True,
                 with_attention=True,
-                use_gpu=True):
+                use_gpu=True,
+                heads=None,
+                head_weights=None):
     """A function wrapper for building a model.
 
     Args:
@@ -41,6 +44,10 @@ def build_model(name,
         pretrained (bool, optional): whether to load ImageNet-pretrained weights.
             Default is True.
         use_gpu (bool, optional): whether to use gpu. Default is True.
+        heads (tuple, optional): embedding heads of pfh_osnet, see
+            ``OSNet.set_heads``. Default is None (all heads).
+        head_weights (tuple, optional): weights of the heads in the eval
+            descriptor. Default is None (all ones).
 
     Returns:
         nn.Module
@@ -53,8 +60,13 @@ def build_model(name,
     if name not in avai_models:
         raise KeyError('Unknown model: {}. Must be one of {}'.format(
             name, avai_models))
+    kwargs = {}
+    if heads is not None:
+        kwargs['heads'] = tuple(heads)
+        kwargs['head_weights'] = head_weights
     return __model_factory[name](num_classes=num_classes,
                                  loss=loss,
                                  pretrained=pretrained,
                                  with_attention=with_attention,
-                                 use_gpu=use_gpu)
+                                 use_gpu=use_gpu,
+                                 **kwargs)
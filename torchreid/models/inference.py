@@ -0,0 +1,193 @@
+from __future__ import division, print_function, absolute_import
+import copy
+import warnings
+import torch
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+__all__ = ['fuse_conv_bn', 'optimize_for_inference', 'CPUInferenceModel']
+
+# conv followed by the bn of the basic layers shared by the osnet variants
+_FUSIBLE_LAYERS = {
+    'ConvLayer': 'conv',
+    'Conv1x1': 'conv',
+    'Conv1x1Linear': 'conv',
+    'Conv3x3': 'conv',
+    'LightConv3x3': 'conv2',
+}
+
+
+def fuse_conv_bn(model):
+    """Returns a copy of a model in eval mode with BatchNorm folded into convs.
+
+    The BatchNorm of ``ConvLayer``, ``Conv1x1``, ``Conv1x1Linear``,
+    ``Conv3x3`` and ``LightConv3x3`` is folded into the weights and bias of
+    the convolution that precedes it and replaced by ``nn.Identity``.
+    InstanceNorm layers are kept. The input model is left unchanged.
+
+    Args:
+        model (nn.Module): network model.
+
+    Examples::
+        >>> from torchreid import models
+        >>> fused = models.fuse_conv_bn(model)
+        >>> features = fused(imgs)
+    """
+    model = copy.deepcopy(model).eval()
+    for module in model.modules():
+        conv_name = _FUSIBLE_LAYERS.get(type(module).__name__)
+        bn = getattr(module, 'bn', None)
+        if conv_name is None or not isinstance(bn, nn.BatchNorm2d):
+            continue
+        setattr(module, conv_name,
+                fuse_conv_bn_eval(getattr(module, conv_name), bn))
+        module.bn = nn.Identity()
+    return model
+
+
+def optimize_for_inference(model, example_input=None, channels_last=True):
+    """Returns a traced copy of a model for feature extraction.
+
+    BatchNorm is folded into convs (see ``fuse_conv_bn``), the classifier
+    heads, which the eval path never uses, are dropped, and the eval-mode
+    forward is traced with ``torch.jit.trace`` and frozen. The traced module
+    only returns the embeddings of the eval path. The input model is left
+    unchanged.
+
+    Args:
+        model (nn.Module): network model.
+        example_input (torch.Tensor, optional): input used for tracing.
+            Default is None, which uses a single 256x128 image on the device
+            of the model.
+        channels_last (bool, optional): trace with the channels_last memory
+            format. Default is True.
+
+    Examples::
+        >>> from torchreid import models
+        >>> model = models.build_model('pfh_osnet', 751)
+        >>> optimized = models.optimize_for_inference(model)
+        >>> features = optimized(imgs)
+    """
+    model = fuse_conv_bn(model)
+    for name, module in list(model.named_children()):
+        if name.startswith('classifier'):
+            setattr(model, name, nn.Identity())
+    if example_input is None:
+        device = next(model.parameters()).device
+        example_input = torch.randn(1, 3, 256, 128, device=device)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+        example_input = example_input.contiguous(
+            memory_format=torch.channels_last
+        )
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example_input)
+    return torch.jit.freeze(traced)
+
+
+_worker_model = None
+
+
+def _init_worker(model, num_threads):
+    global _worker_model
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    _worker_model = model
+
+
+def _worker_forward(input):
+    with torch.inference_mode():
+        output = _worker_model(
+            input.contiguous(memory_format=torch.channels_last)
+        )
+    # inference tensors cannot be moved to shared memory
+    return output.clone()
+
+
+class CPUInferenceModel(nn.Module):
+    """Wraps a model for feature extraction on cpu.
+
+    The wrapped model has its BatchNorm folded into convs (see
+    ``fuse_conv_bn``), uses the channels_last memory format and runs under
+    ``torch.inference_mode``. Batches can be split over a pool of worker
+    processes, each of which holds a copy of the model.
+
+    Args:
+        model (nn.Module): network model, which is left unchanged.
+        num_threads (int, optional): intra-op threads of the main process, or
+            of each worker. Default is 0 (keep the torch default).
+        num_interop_threads (int, optional): inter-op threads. It can only be
+            set before any inter-op parallel work has started. Default is 0
+            (keep the torch default).
+        num_workers (int, optional): number of worker processes a batch is
+            split over. Default is 0 (run in the main process).
+        fuse (bool, optional): fold BatchNorm into convs. Default is True.
+
+    Examples::
+        >>> from torchreid import models
+        >>> model = models.build_model('pfh_osnet', 751, use_gpu=False)
+        >>> cpu_model = models.CPUInferenceModel(model, num_threads=4)
+        >>> features = cpu_model(imgs)
+        >>> cpu_model.close()
+    """
+
+    def __init__(self,
+                 model,
+                 num_threads=0,
+                 num_interop_threads=0,
+                 num_workers=0,
+                 fuse=True):
+        super(CPUInferenceModel, self).__init__()
+        if fuse:
+            model = fuse_conv_bn(model)
+        else:
+            model = copy.deepcopy(model).eval()
+        self.model = model.to(memory_format=torch.channels_last)
+        self.num_threads = num_threads
+        self.num_workers = num_workers
+        self._pool = None
+        if num_interop_threads > 0:
+            try:
+                torch.set_num_interop_threads(num_interop_threads)
+            except RuntimeError as e:
+                warnings.warn(
+                    'Cannot set inter-op threads: {} '
+                    '(** ignored and continue **)'.format(e)
+                )
+
+    def _get_pool(self):
+        if self._pool is None:
+            # spawn rather than fork: forking after torch has started its
+            # thread pools can deadlock
+            context = torch.multiprocessing.get_context('spawn')
+            self._pool = context.Pool(
+                self.num_workers,
+                initializer=_init_worker,
+                initargs=(self.model, self.num_threads)
+            )
+        return self._pool
+
+    def forward(self, input):
+        if self.num_workers > 1 and input.size(0) > 1:
+            chunks = input.chunk(self.num_workers)
+            return torch.cat(self._get_pool().map(_worker_forward, chunks))
+
+        num_threads = torch.get_num_threads()
+        if self.num_threads > 0:
+            torch.set_num_threads(self.num_threads)
+        try:
+            with torch.inference_mode():
+                output = self.model(
+                    input.contiguous(memory_format=torch.channels_last)
+                )
+        finally:
+            torch.set_num_threads(num_threads)
+        return output
+
+    def close(self):
+        """Terminates the worker processes."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
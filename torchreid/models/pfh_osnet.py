@@ -6,6 +6,21 @@ from torch.nn import functional as F
 
 __all__ = ['pfh_osnet']
 
+# embedding heads: the global one and the pyramid heads after stage 2/3/4
+HEADS = ('global', 'a', 'b', 'c')
+HEAD_DIMS = {'global': 512, 'a': 64, 'b': 96, 'c': 128}
+# modules (conv, bn, classifier) of each head
+_HEAD_MODULES = {
+    'global': ('conv5', 'bn', 'classifier'),
+    'a': ('conv_a', 'bn_a', 'classifier_a'),
+    'b': ('conv_b', 'bn_b', 'classifier_b'),
+    'c': ('conv_c', 'bn_c', 'classifier_c'),
+}
+
+# stages of OSNet.stage_embeddings, from the cheapest, and their heads
+EMBEDDING_STAGES = ('a', 'b', 'full')
+_STAGE_HEADS = {'a': ('a', ), 'b': ('a', 'b'), 'full': HEADS}
+
 pretrained_urls = {
     'osnet_x1_0':
     'https://drive.google.com/uc?id=1LaG1EJpHrxdAxKnSCJ_i0u-nbxSAeiFY',
@@ -186,9 +201,7 @@ class ChannelGate(nn.Module):
             raise RuntimeError(
                 "Unknown gate activation: {}".format(gate_activation))
 
-    def forward(self, x):
-        input = x
-        x = self.global_avgpool(x)
+    def _gates(self, x):
         x = self.fc1(x)
         if self.norm1 is not None:
             x = self.norm1(x)
@@ -196,10 +209,90 @@ class ChannelGate(nn.Module):
         x = self.fc2(x)
         if self.gate_activation is not None:
             x = self.gate_activation(x)
+        return x
+
+    def forward(self, x):
+        input = x
+        x = self._gates(self.global_avgpool(x))
         if self.return_gates:
             return x
         return input * x
 
+    def forward_streams(self, streams):
+        """Gates streams of the same shape and sums them.
+
+        Same as ``sum(self(x) for x in streams)``, but the pooled streams go
+        through fc1/fc2 as one batch.
+        """
+        pooled = torch.cat([self.global_avgpool(x) for x in streams], 0)
+        gates = self._gates(pooled).chunk(len(streams))
+        if self.return_gates:
+            return sum(gates)
+        out = streams[0] * gates[0]
+        for x, gate in zip(streams[1:], gates[1:]):
+            out = out + x * gate
+        return out
+
+
+def _light_conv3x3_group(layers, x):
+    """Runs LightConv3x3 layers of the same width as one grouped conv.
+
+    ``x`` is either the input shared by all layers or their inputs stacked
+    along channels. Returns their outputs stacked along channels. The
+    weights are concatenated on the fly, so the layers and the state dict
+    are unchanged.
+    """
+    if len(layers) == 1:
+        return layers[0](x)
+    groups = 1 if x.size(1) == layers[0].conv1.in_channels else len(layers)
+    x = F.conv2d(x, torch.cat([l.conv1.weight for l in layers]),
+                 groups=groups)
+    bias = None
+    if layers[0].conv2.bias is not None:
+        # bn folded by models.fuse_conv_bn
+        bias = torch.cat([l.conv2.bias for l in layers])
+    x = F.conv2d(x,
+                 torch.cat([l.conv2.weight for l in layers]),
+                 bias,
+                 padding=1,
+                 groups=x.size(1))
+    if isinstance(layers[0].bn, nn.BatchNorm2d):
+        x = _batch_norm_group([l.bn for l in layers], x)
+    return F.relu(x, inplace=True)
+
+
+def _batch_norm_group(bns, x):
+    """Applies BatchNorm2d layers to their inputs stacked along channels.
+
+    Same as ``nn.BatchNorm2d.forward``, including the update of the running
+    statistics of each layer.
+    """
+    bn = bns[0]
+    momentum = 0.0 if bn.momentum is None else bn.momentum
+    running_mean = running_var = None
+    if bn.track_running_stats:
+        if bn.training:
+            for b in bns:
+                b.num_batches_tracked += 1
+            if bn.momentum is None:
+                momentum = 1.0 / float(bn.num_batches_tracked)
+        running_mean = torch.cat([b.running_mean for b in bns])
+        running_var = torch.cat([b.running_var for b in bns])
+    weight = bias = None
+    if bn.affine:
+        weight = torch.cat([b.weight for b in bns])
+        bias = torch.cat([b.bias for b in bns])
+    x = F.batch_norm(x, running_mean, running_var, weight, bias,
+                     bn.training or not bn.track_running_stats, momentum,
+                     bn.eps)
+    if bn.training and bn.track_running_stats:
+        # write the statistics updated in the concatenated buffers back
+        for b, mean, var in zip(bns, running_mean.chunk(len(bns)),
+                                running_var.chunk(len(bns))):
+            b.running_mean.copy_(mean)
+            b.running_var.copy_(var)
+    return x
+
 
 class OSBlock(nn.Module):
     """Omni-scale feature learning block."""
@@ -237,14 +330,35 @@ class OSBlock(nn.Module):
         if IN:
             self.IN = nn.InstanceNorm2d(out_channels, affine=True)
 
+    def _grouped_streams(self, x1):
+        """Runs the four streams depth by depth, the layers of one depth as
+        one grouped conv: the first layers share their input x1, the
+        following ones read the stacked outputs of the deeper streams."""
+        mid_channels = x1.size(1)
+        x2 = _light_conv3x3_group(
+            [self.conv2a, self.conv2b[0], self.conv2c[0], self.conv2d[0]], x1)
+        x2a, x2 = x2[:, :mid_channels], x2[:, mid_channels:]
+        x2 = _light_conv3x3_group(
+            [self.conv2b[1], self.conv2c[1], self.conv2d[1]], x2)
+        x2b, x2 = x2[:, :mid_channels], x2[:, mid_channels:]
+        x2 = _light_conv3x3_group([self.conv2c[2], self.conv2d[2]], x2)
+        x2c, x2 = x2[:, :mid_channels], x2[:, mid_channels:]
+        x2d = self.conv2d[3](x2)
+        return x2a, x2b, x2c, x2d
+
     def forward(self, x):
         identity = x
         x1 = self.conv1(x)
-        x2a = self.conv2a(x1)
-        x2b = self.conv2b(x1)
-        x2c = self.conv2c(x1)
-        x2d = self.conv2d(x1)
-        x2 = self.gate(x2a) + self.gate(x2b) + self.gate(x2c) + self.gate(x2d)
+        if x1.is_cuda:
+            x2a, x2b, x2c, x2d = self._grouped_streams(x1)
+        else:
+            # on cpu the per-channel kernels are not launch bound, and the
+            # grouped convs measured slower than separate ones
+            x2a = self.conv2a(x1)
+            x2b = self.conv2b(x1)
+            x2c = self.conv2c(x1)
+            x2d = self.conv2d(x1)
+        x2 = self.gate.forward_streams([x2a, x2b, x2c, x2d])
         x3 = self.conv3(x2)
         if self.downsample is not None:
             identity = self.downsample(identity)
@@ -266,12 +380,15 @@ class OSNet(nn.Module):
                  feature_dim=512,
                  loss='softmax',
                  IN=False,
+                 heads=HEADS,
+                 head_weights=None,
                  **kwargs):
         super(OSNet, self).__init__()
         num_blocks = len(blocks)
         assert num_blocks == len(layers)
         assert num_blocks == len(channels) - 1
         self.loss = loss
+        self.set_heads(heads, head_weights)
 
         self.conv1 = ConvLayer(3, channels[0], 7, stride=2, padding=3, IN=IN)
         self.maxpool = nn.MaxPool2d(3, stride=2, padding=1)
@@ -309,6 +426,36 @@ class OSNet(nn.Module):
 
         self._init_params()
 
+    def set_heads(self, heads=HEADS, head_weights=None):
+        """Sets the heads computed by ``forward``.
+
+        Branches of the other heads are not run. In eval mode the descriptor
+        concatenates the L2-normalized embeddings of the heads, each scaled
+        by its weight; in training mode the outputs are lists over the heads.
+        ``heads``, ``head_weights`` and ``head_dims`` (the embedding dimension
+        of each head) are kept as attributes.
+
+        Args:
+            heads (tuple, optional): subset of "global" (512-d), "a" (64-d),
+                "b" (96-d) and "c" (128-d), always ordered as listed here.
+                Default is all heads.
+            head_weights (tuple, optional): weight of each head in the eval
+                descriptor. Default is None (all ones).
+        """
+        unknown = set(heads) - set(HEADS)
+        if not heads or unknown:
+            raise ValueError('Unknown heads: {}. Please choose from {}'.format(
+                list(heads), HEADS))
+        if head_weights is None or len(head_weights) == 0:
+            head_weights = [1.] * len(heads)
+        if len(head_weights) != len(heads):
+            raise ValueError('Expected {} head weights, but got {}'.format(
+                len(heads), len(head_weights)))
+        weights = dict(zip(heads, head_weights))
+        self.heads = tuple(h for h in HEADS if h in weights)
+        self.head_weights = tuple(float(weights[h]) for h in self.heads)
+        self.head_dims = tuple(HEAD_DIMS[h] for h in self.heads)
+
     def _construct_fc_layer(self, fc_dims, input_dim, dropout_p=None):
         if fc_dims is None or fc_dims < 0:
             self.feature_dim = input_dim
@@ -352,66 +499,122 @@ class OSNet(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
-    def featuremaps(self, x):
+    def _stage_a(self, x):
         x = self.conv1(x)  # [B, 64, 128, 64]
         x = self.maxpool(x)  # [B, 64, 64, 32]
         x, _ = self.conv2_0(x)  # [B, 256, 64, 32]
         # print('a0.shape:', a0.shape) # [B, 64, 64, 32]
         x, a1 = self.conv2_1(x)  # [B, 256, 64, 32]
         # print('a1.shape:', a1.shape) # [B, 64, 64, 32]
+        return x, a1
+
+    def _stage_b(self, x):
         x = self.conv2_2(x)  # [B, 256, 64, 32]
         x = self.conv2_3(x)  # [B, 256, 32, 16]
         x, _ = self.conv3_0(x)  # [B, 384, 32, 16]
         # print('b0.shape:', b0.shape)  # [B, 96, 32, 16]
         x, b1 = self.conv3_1(x)  # [B, 384, 32, 16]
         # print('b1.shape:', b1.shape)  # [B, 96, 32, 16]
+        return x, b1
+
+    def _stage_c(self, x):
         x = self.conv3_2(x)  # [B, 384, 32, 16]
         x = self.conv3_3(x)  # [B, 384, 16, 8]
         x, _ = self.conv4_0(x)  # [B, 512, 16, 8]
         # print('c0.shape:', c0.shape)  # [B, 128, 16, 8]
         x, c1 = self.conv4_1(x)  # [B, 512, 16, 8]
         # print('c1.shape:', c1.shape)  # [B, 128, 16, 8]
+        return x, c1
+
+    def featuremaps(self, x):
+        x, a1 = self._stage_a(x)
+        x, b1 = self._stage_b(x)
+        x, c1 = self._stage_c(x)
         a1 = self.conv_a(a1)
         b1 = self.conv_b(b1)
         c1 = self.conv_c(c1)
         x = self.conv5(x)  # [B, 512, 16, 8]
         return x, a1, b1, c1
 
+    def _head_featuremaps(self, x, heads):
+        """Returns the feature maps of the heads, running only the stages and
+        branches they need."""
+        maps = {}
+        x, maps['a'] = self._stage_a(x)
+        if heads != ('a', ):
+            x, maps['b'] = self._stage_b(x)
+            if 'global' in heads or 'c' in heads:
+                x, maps['c'] = self._stage_c(x)
+                maps['global'] = x
+        return [getattr(self, _HEAD_MODULES[h][0])(maps[h]) for h in heads]
+
+    def _head_vectors(self, x, heads):
+        vectors = []
+        for featuremap in self._head_featuremaps(x, heads):
+            v = self.global_avgpool(featuremap)
+            vectors.append(v.view(v.size(0), -1))
+        return vectors
+
+    def _descriptor(self, vectors, heads, head_weights):
+        embeddings = []
+        for h, w, v in zip(heads, head_weights, vectors):
+            v = F.normalize(getattr(self, _HEAD_MODULES[h][1])(v), p=2, dim=1)
+            embeddings.append(v if w == 1 else w * v)
+        return torch.cat(embeddings, dim=1)
+
+    def stage_embeddings(self, x, stage='full', with_descriptor=False):
+        """Returns eval-mode embeddings, running the network only up to a stage.
+
+        Stage "a" stops after conv2_1 and returns the 64-d pyramid embedding
+        of ``bn_a``, stage "b" stops after conv3_1 and returns the 160-d
+        concatenation of the ``bn_a`` and ``bn_b`` embeddings, and stage
+        "full" returns the 800-d descriptor of all heads. Each part is
+        L2-normalized as in ``forward``, head weights are not applied.
+
+        Args:
+            x (torch.Tensor): input images.
+            stage (str, optional): "a", "b" or "full". Default is "full".
+            with_descriptor (bool, optional): also return the eval-mode output
+                of ``forward``, computed in the same pass through the network.
+                Default is False.
+
+        Returns:
+            torch.Tensor: the embeddings, or a tuple ``(embeddings, descriptor)``
+            with ``with_descriptor``.
+        """
+        if stage not in EMBEDDING_STAGES:
+            raise ValueError('Unknown stage: {}. Please choose from {}'.format(
+                stage, EMBEDDING_STAGES))
+        heads = _STAGE_HEADS[stage]
+        if not with_descriptor:
+            return self._descriptor(self._head_vectors(x, heads), heads,
+                                    [1.] * len(heads))
+        all_heads = tuple(h for h in HEADS if h in heads or h in self.heads)
+        vectors = dict(zip(all_heads, self._head_vectors(x, all_heads)))
+        embeddings = self._descriptor([vectors[h] for h in heads], heads,
+                                      [1.] * len(heads))
+        descriptor = self._descriptor([vectors[h] for h in self.heads],
+                                      self.heads, self.head_weights)
+        return embeddings, descriptor
+
     def forward(self, x, return_featuremaps=False):
-        x, a, b, c = self.featuremaps(x)
         if return_featuremaps:
-            return c
-        v = self.global_avgpool(x)
-        va = self.global_avgpool(a)
-        vb = self.global_avgpool(b)
-        vc = self.global_avgpool(c)
+            return self.featuremaps(x)[3]
+        v_ = self._head_vectors(x, self.heads)
         # v = self.global_maxpool(x)
         # v = self.gem(x)
-        v = v.view(v.size(0), -1)
-        va = va.view(va.size(0), -1)
-        vb = vb.view(vb.size(0), -1)
-        vc = vc.view(vc.size(0), -1)
-
-        v_ = [v, va, vb, vc]
-
-        v = self.bn(v)
-        va = self.bn_a(va)
-        vb = self.bn_b(vb)
-        vc = self.bn_c(vc)
 
         if not self.training:
-            v = F.normalize(v, p=2, dim=1)
-            va = F.normalize(va, p=2, dim=1)
-            vb = F.normalize(vb, p=2, dim=1)
-            vc = F.normalize(vc, p=2, dim=1)
             # return v, va, vb, vc
-            return torch.cat([v, va, vb, vc], dim=1)
-        y = self.classifier(v)
-        ya = self.classifier_a(va)
-        yb = self.classifier_b(vb)
-        yc = self.classifier_c(vc)
-        y = [y, ya, yb, yc]
-        v = [v, va, vb, vc]
+            return self._descriptor(v_, self.heads, self.head_weights)
+        v = [
+            getattr(self, _HEAD_MODULES[h][1])(vector)
+            for h, vector in zip(self.heads, v_)
+        ]
+        y = [
+            getattr(self, _HEAD_MODULES[h][2])(vector)
+            for h, vector in zip(self.heads, v)
+        ]
         if self.loss == 'softmax':
             return y
         elif self.loss == 'triplet':
@@ -1,10 +1,11 @@
 from __future__ import absolute_import
 
 from .tools import *
-from .rerank import re_ranking
+from .rerank import re_ranking, re_ranking_sparse, re_ranking_torch, ReRanker
 from .loggers import *
 from .avgmeter import *
 from .reidtools import *
 from .torchtools import *
 from .model_complexity import compute_model_complexity
+from .feature_cache import FeatureCache, state_dict_hash
 from .batch_augment import batch_augment, BatchDrop
@@ -0,0 +1,152 @@
+from __future__ import division, print_function, absolute_import
+import os
+import shutil
+import hashlib
+import os.path as osp
+import numpy as np
+import torch
+
+from .tools import mkdir_if_missing
+
+__all__ = ['FeatureCache', 'state_dict_hash']
+
+
+def state_dict_hash(model):
+    """Returns the sha1 hex digest of the parameters and buffers of a model.
+
+    Args:
+        model (nn.Module): network model.
+    """
+    sha1 = hashlib.sha1()
+    for name, value in model.state_dict().items():
+        sha1.update(name.encode('utf-8'))
+        value = value.detach().cpu().contiguous().view(-1)
+        sha1.update(value.view(torch.uint8).numpy().tobytes())
+    return sha1.hexdigest()
+
+
+def _paths_array(paths):
+    """Returns a string array of paths, or a 1-D object array if a path is
+    not a string, which keeps tuples and lists of paths intact."""
+    paths = list(paths)
+    if all(isinstance(p, str) for p in paths):
+        return np.asarray(paths, dtype=str)
+    array = np.empty(len(paths), dtype=object)
+    for i, p in enumerate(paths):
+        array[i] = p
+    return array
+
+
+class FeatureCache(object):
+    """On-disk cache of extracted features.
+
+    Each entry stores the features, pids, camids and image paths of a split as
+    ``.npy`` files. Features are loaded memory-mapped (copy-on-write), so a
+    cached split is available without reading it into memory.
+
+    Args:
+        cache_dir (str): root directory of the cache.
+
+    Examples::
+        >>> from torchreid.utils import FeatureCache, state_dict_hash
+        >>> cache = FeatureCache('log/feature_cache')
+        >>> key = cache.make_key(state_dict_hash(model), 'market1501', 'query',
+        >>>                      (256, 128), datamanager.transform_te)
+        >>> cached = cache.load(key)
+        >>> if cached is None:
+        >>>     cache.save(key, qf, q_pids, q_camids, q_img_paths)
+        >>> else:
+        >>>     qf, q_pids, q_camids, q_img_paths = cached
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def make_key(model_hash,
+                 dataset_name,
+                 split,
+                 image_size,
+                 transforms,
+                 extractor='',
+                 precision='fp32'):
+        """Returns the key of an entry.
+
+        Args:
+            model_hash (str): hash of the model weights, see ``state_dict_hash``.
+            dataset_name (str): dataset name.
+            split (str): "query", "gallery" or "train".
+            image_size (tuple): (height, width) of the input images.
+            transforms: transforms applied to the images, identified by their
+                ``repr``.
+            extractor (str, optional): anything else that changes the features,
+                e.g. the engine class. Default is "".
+            precision (str, optional): storage precision of the features, see
+                ``metrics.encode_features``. Default is "fp32".
+        """
+        fields = [
+            model_hash, dataset_name, split,
+            'x'.join(str(s) for s in image_size),
+            repr(transforms), extractor
+        ]
+        if precision != 'fp32':
+            fields.append(precision)
+        description = '|'.join(fields)
+        digest = hashlib.sha1(description.encode('utf-8')).hexdigest()
+        return '{}_{}_{}'.format(dataset_name, split, digest[:16])
+
+    def _path(self, key):
+        return osp.join(self.cache_dir, key)
+
+    def load(self, key):
+        """Returns (features, pids, camids, paths) of an entry, or None if
+        the entry does not exist."""
+        path = self._path(key)
+        if not osp.isdir(path):
+            return None
+        if osp.isfile(osp.join(path, 'features_bf16.npy')):
+            # numpy has no bfloat16, the raw bits are stored as int16
+            features = np.load(osp.join(path, 'features_bf16.npy'),
+                               mmap_mode='c')
+            features = torch.from_numpy(features).view(torch.bfloat16)
+        else:
+            features = np.load(osp.join(path, 'features.npy'), mmap_mode='c')
+            features = torch.from_numpy(features)
+        pids = np.load(osp.join(path, 'pids.npy'))
+        camids = np.load(osp.join(path, 'camids.npy'))
+        # paths other than strings, e.g. the image paths of a tracklet, are
+        # pickled, see save
+        paths = np.load(osp.join(path, 'paths.npy'), allow_pickle=True)
+        paths = paths.tolist()
+        return features, pids, camids, paths
+
+    def save(self, key, features, pids, camids, paths):
+        """Saves an entry.
+
+        Args:
+            key (str): key given by ``make_key``.
+            features (torch.Tensor): 2-D feature matrix of any precision
+                given by ``metrics.encode_features``.
+            pids (numpy.ndarray): person identities.
+            camids (numpy.ndarray): camera views.
+            paths (list): image paths, a path may also be a tuple or list of
+                paths, e.g. of a tracklet.
+        """
+        path = self._path(key)
+        # write to a temporary directory first so that an interrupted run
+        # never leaves a partial entry behind
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        mkdir_if_missing(tmp_path)
+        features = features.cpu()
+        if features.dtype == torch.bfloat16:
+            np.save(osp.join(tmp_path, 'features_bf16.npy'),
+                    features.view(torch.int16).numpy())
+        else:
+            np.save(osp.join(tmp_path, 'features.npy'), features.numpy())
+        np.save(osp.join(tmp_path, 'pids.npy'), np.asarray(pids))
+        np.save(osp.join(tmp_path, 'camids.npy'), np.asarray(camids))
+        np.save(osp.join(tmp_path, 'paths.npy'), _paths_array(paths))
+        if osp.isdir(path):
+            shutil.rmtree(tmp_path)
+        else:
+            os.rename(tmp_path, path)
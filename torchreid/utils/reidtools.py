@@ -7,6 +7,8 @@ import cv2
 import matplotlib.pyplot as plt
 from sklearn import manifold
 
+from torchreid.metrics.rank import rank_topk
+
 from .tools import mkdir_if_missing
 
 __all__ = ['visualize_ranked_results', 'tsne']
@@ -19,7 +21,14 @@ RED = (0, 0, 255)
 
 
 def visualize_ranked_results(
-    distmat, dataset, data_type, width=128, height=256, save_dir='', topk=10
+    distmat,
+    dataset,
+    data_type,
+    width=128,
+    height=256,
+    save_dir='',
+    topk=10,
+    indices=None
 ):
     """Visualizes ranked results.
 
@@ -38,8 +47,15 @@ def visualize_ranked_results(
         save_dir (str): directory to save output images.
         topk (int, optional): denoting top-k images in the rank list to be visualized.
             Default is 10.
+        indices (numpy.ndarray, optional): precomputed ranked gallery indices of shape
+            (num_query, k), e.g. from ``metrics.rank_topk`` or ``IVFIndex.search``,
+            where missing neighbors are -1. If given, ``distmat`` is not used and
+            can be None. Default is None.
     """
-    num_q, num_g = distmat.shape
+    if indices is None:
+        num_q, num_g = distmat.shape
+    else:
+        num_q, num_g = indices.shape[0], len(dataset[1])
     mkdir_if_missing(save_dir)
 
     print('# query: {}\n# gallery {}'.format(num_q, num_g))
@@ -49,7 +65,14 @@ def visualize_ranked_results(
     assert num_q == len(query)
     assert num_g == len(gallery)
 
-    indices = np.argsort(distmat, axis=1)
+    if indices is None:
+        # only the top-k ranks are needed, so the gallery is not fully sorted
+        indices = rank_topk(
+            distmat, np.asarray([q[1] for q in query]),
+            np.asarray([g[1] for g in gallery]),
+            np.asarray([q[2] for q in query]),
+            np.asarray([g[2] for g in gallery]), topk
+        )
 
     def _cp_img_to(src, dst, rank, prefix, matched=False):
         """
@@ -110,6 +133,9 @@ def visualize_ranked_results(
 
         rank_idx = 1
         for g_idx in indices[q_idx, :]:
+            if g_idx < 0:
+                # missing neighbors of approximate search
+                break
             gimg_path, gpid, gcamid = gallery[g_idx]
             invalid = (qpid == gpid) & (qcamid == gcamid)
 